@@ -1,8 +1,18 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from app.models.printer import Printer, Filament
 from app.models.printjob import PrintJob
 from app.raft.store import RaftNode
-from typing import List, Optional
+from app.raft.fsm import (ADMISSION_ERRORS, JOB_NOT_FOUND, INVALID_TRANSITION, PRINTER_BUSY, FILAMENT_IN_USE,
+                          IDEMPOTENCY_MISMATCH)
+from app.raft.records import JOB_STATUSES
+from app.raft.watch import ChangeFeed, WatchFilter, WATCH_KINDS
+from app.monitoring.metrics import idempotent_replays_total
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, Literal, Optional
+import json
+import hashlib
 import logging
 
 logger = logging.getLogger("raft3d")
@@ -20,73 +30,426 @@ def get_raft_node() -> RaftNode:
         raise HTTPException(status_code=500, detail="RaftNode not initialized")
     return _raft_node
 
+# Change feed for GET /watch (set in main.py once the event loop runs)
+_change_feed: Optional[ChangeFeed] = None
+
+def set_change_feed(feed: Optional[ChangeFeed]):
+    global _change_feed
+    _change_feed = feed
+
+def get_change_feed() -> ChangeFeed:
+    if _change_feed is None:
+        raise HTTPException(status_code=503, detail="Change feed not started")
+    return _change_feed
+
+# Lines are grouped into chunks of about this many bytes when streaming NDJSON
+STREAM_CHUNK_BYTES = 64 * 1024
+# An idle watch stream gets a comment line this often, so proxies keep it open
+WATCH_KEEPALIVE_SECONDS = 15.0
+
+def _parse_fields(model, fields: Optional[str]) -> Optional[List[str]]:
+    if not fields:
+        return None
+    keys = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in keys if f not in model.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return keys
+
+def _ndjson(records: Iterator, encode: Callable) -> Iterator[bytes]:
+    # A sync generator, so Starlette runs it in its threadpool rather than
+    # on the event loop; only one chunk is held in memory at a time
+    chunk = []
+    size = 0
+    for record in records:
+        line = json.dumps(encode(record), separators=(",", ":")) + "\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= STREAM_CHUNK_BYTES:
+            yield "".join(chunk).encode()
+            chunk = []
+            size = 0
+    if chunk:
+        yield "".join(chunk).encode()
+
+async def _read_barrier(raft_node: RaftNode, response: Response, consistency: str,
+                        min_index: Optional[int], max_staleness_ms: Optional[int]) -> int:
+    # "local" serves whatever this node has applied; "linearizable" is only
+    # answered by the leader while it holds its lease; "bounded" waits until
+    # this node has applied min_index and is within max_staleness_ms of the leader.
+    # Returns the applied index the read is served at, also set as X-Raft-Index.
+    if consistency == "linearizable":
+        if not await raft_node.wait_linearizable():
+            leader = raft_node.leader()
+            raise HTTPException(status_code=503, detail=f"Not the leader; linearizable reads go to {leader}")
+    elif consistency == "bounded":
+        max_staleness = max_staleness_ms / 1000 if max_staleness_ms is not None else None
+        if not await raft_node.wait_bounded(min_index, max_staleness):
+            raise HTTPException(status_code=503, detail="Node is not caught up with the leader")
+    index = raft_node.fsm.applied_index
+    response.headers["X-Raft-Index"] = str(index)
+    return index
+
+def _listing(model, open_records: Callable[[], Iterator], response: Response, limit: Optional[int],
+             fields: Optional[str], format: str, raft_index: int):
+    # Shared by the list endpoints: `after` is applied by open_records, then
+    # `limit` caps the page and `fields` projects each record. In JSON mode the
+    # cursor for the next page is returned in the X-Next-After header. A
+    # streamed response replaces the injected one, so it carries raft_index
+    # (from _read_barrier) itself.
+    keys = _parse_fields(model, fields)
+    try:
+        records = open_records()
+    except KeyError:
+        raise HTTPException(status_code=400, detail="Unknown cursor in 'after'")
+    if keys:
+        encode = lambda record: {k: getattr(record, k) for k in keys}
+    else:
+        encode = lambda record: record.to_dict()
+    if format == "ndjson":
+        page = islice(records, limit) if limit else records
+        return StreamingResponse(_ndjson(page, encode), media_type="application/x-ndjson",
+                                 headers={"X-Raft-Index": str(raft_index)})
+    if not limit:
+        return [encode(record) for record in records]
+    page = list(islice(records, limit))
+    if len(page) == limit and next(records, None) is not None:
+        response.headers["X-Next-After"] = page[-1].id
+    return [encode(record) for record in page]
+
+async def _read_items(request: Request) -> List[Any]:
+    # Bulk bodies are either a JSON array or NDJSON, one object per line
+    body = await request.body()
+    try:
+        if "ndjson" in request.headers.get("content-type", ""):
+            return [json.loads(line) for line in body.splitlines() if line.strip()]
+        items = json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid request body: {str(e)}")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON array or NDJSON")
+    return items
+
+async def _bulk_create(request: Request, response: Response, raft_node: RaftNode, model, op: str,
+                       admit: Callable[[Any], Optional[str]]) -> Dict[str, Any]:
+    # Validates every item in one pass, runs admit (which returns an error or
+    # None) against the FSM plus the items admitted before it, and replicates
+    # the admitted items as multi-op log entries. Results are per item, in
+    # order; a conditional command the FSM refused reports its reason.
+    items = await _read_items(request)
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    accepted = []
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[position] = {"id": None, "error": "Item must be a JSON object"}
+            continue
+        try:
+            record = model(**item)
+        except ValidationError as e:
+            results[position] = {"id": item.get("id"), "error": str(e)}
+            continue
+        error = admit(record)
+        if error:
+            results[position] = {"id": record.id, "error": error}
+            continue
+        accepted.append((position, record))
+
+    outcomes = await raft_node.apply_batch_async([(op, record.dict()) for _, record in accepted]) if accepted else []
+    for (position, record), outcome in zip(accepted, outcomes):
+        if outcome is True:
+            results[position] = {"id": record.id, "ok": True}
+        else:
+            results[position] = {"id": record.id, "error": outcome if isinstance(outcome, str) else "Failed to apply"}
+    succeeded = sum(1 for result in results if result.get("ok"))
+    logger.info("Bulk %s: %s of %s items applied", op, succeeded, len(items))
+    response.headers["X-Raft-Index"] = str(raft_node.write_index())
+    return {"succeeded": succeeded, "failed": len(items) - succeeded, "results": results}
+
+async def _command(raft_node: RaftNode, op: str, value: dict, idempotency_key: Optional[str],
+                   precheck: Optional[Callable[[], None]] = None) -> Any:
+    # Proposes one command and returns the FSM's result. With an
+    # Idempotency-Key, a retry of a write that already went through gets the
+    # original result from the FSM's table, without precheck or another
+    # consensus round; the key must come with the same request each time.
+    if idempotency_key is None:
+        if precheck is not None:
+            precheck()
+        return await raft_node.command_async(op, value)
+    fingerprint = hashlib.sha256(json.dumps([op, value], sort_keys=True).encode()).hexdigest()[:32]
+    entry = raft_node.get_idempotent_result(idempotency_key)
+    if entry is not None:
+        if entry.fingerprint != fingerprint:
+            raise HTTPException(status_code=422, detail=IDEMPOTENCY_MISMATCH)
+        idempotent_replays_total.inc()
+        return json.loads(entry.result)
+    if precheck is not None:
+        precheck()
+    result = await raft_node.command_async(op, value, (idempotency_key, fingerprint))
+    if result == IDEMPOTENCY_MISMATCH:
+        raise HTTPException(status_code=422, detail=result)
+    return result
+
 @router.post("/printers")
-async def create_printer(printer: Printer, raft_node: RaftNode = Depends(get_raft_node)):
-    if printer.id in raft_node.get_printers():
-        raise HTTPException(status_code=400, detail="Printer ID already exists")
-    success = raft_node.apply("add_printer", printer.dict())
-    if not success:
+async def create_printer(
+    printer: Printer, response: Response, idempotency_key: Optional[str] = Header(None, max_length=255),
+    raft_node: RaftNode = Depends(get_raft_node)
+):
+    def precheck():
+        if printer.id in raft_node.get_printers():
+            raise HTTPException(status_code=400, detail="Printer ID already exists")
+
+    if await _command(raft_node, "add_printer", printer.dict(), idempotency_key, precheck) is not True:
         raise HTTPException(status_code=500, detail="Failed to create printer")
-    logger.info(f"Created printer {printer.id}")
+    logger.info("Created printer %s", printer.id)
+    response.headers["X-Raft-Index"] = str(raft_node.write_index())
     return printer
 
 @router.get("/printers")
-async def list_printers(raft_node: RaftNode = Depends(get_raft_node)):
-    return list(raft_node.get_printers().values())
+async def list_printers(
+    response: Response, limit: Optional[int] = Query(None, ge=1), after: Optional[str] = None,
+    fields: Optional[str] = None, format: Literal["json", "ndjson"] = "json",
+    consistency: Literal["local", "linearizable", "bounded"] = "local",
+    min_index: Optional[int] = None, max_staleness_ms: Optional[int] = Query(None, ge=0),
+    raft_node: RaftNode = Depends(get_raft_node)
+):
+    index = await _read_barrier(raft_node, response, consistency, min_index, max_staleness_ms)
+    return _listing(Printer, lambda: raft_node.iter_printers(after), response, limit, fields, format, index)
 
 @router.post("/filaments")
-async def create_filament(filament: Filament, raft_node: RaftNode = Depends(get_raft_node)):
-    if filament.id in raft_node.get_filaments():
-        raise HTTPException(status_code=400, detail="Filament ID already exists")
-    success = raft_node.apply("add_filament", filament.dict())
-    if not success:
+async def create_filament(
+    filament: Filament, response: Response, idempotency_key: Optional[str] = Header(None, max_length=255),
+    raft_node: RaftNode = Depends(get_raft_node)
+):
+    def precheck():
+        if filament.id in raft_node.get_filaments():
+            raise HTTPException(status_code=400, detail="Filament ID already exists")
+
+    if await _command(raft_node, "add_filament", filament.dict(), idempotency_key, precheck) is not True:
         raise HTTPException(status_code=500, detail="Failed to create filament")
-    logger.info(f"Created filament {filament.id}")
+    logger.info("Created filament %s", filament.id)
+    response.headers["X-Raft-Index"] = str(raft_node.write_index())
     return filament
 
 @router.get("/filaments")
-async def list_filaments(raft_node: RaftNode = Depends(get_raft_node)):
-    return list(raft_node.get_filaments().values())
+async def list_filaments(
+    response: Response, limit: Optional[int] = Query(None, ge=1), after: Optional[str] = None,
+    fields: Optional[str] = None, format: Literal["json", "ndjson"] = "json",
+    consistency: Literal["local", "linearizable", "bounded"] = "local",
+    min_index: Optional[int] = None, max_staleness_ms: Optional[int] = Query(None, ge=0),
+    raft_node: RaftNode = Depends(get_raft_node)
+):
+    index = await _read_barrier(raft_node, response, consistency, min_index, max_staleness_ms)
+    return _listing(Filament, lambda: raft_node.iter_filaments(after), response, limit, fields, format, index)
 
-@router.post("/print_jobs")
-async def create_print_job(job: PrintJob, raft_node: RaftNode = Depends(get_raft_node)):
-    if job.id in raft_node.get_print_jobs():
-        raise HTTPException(status_code=400, detail="Print job ID already exists")
-    if job.printer_id not in raft_node.get_printers():
-        raise HTTPException(status_code=400, detail="Invalid printer ID")
-    if job.filament_id not in raft_node.get_filaments():
-        raise HTTPException(status_code=400, detail="Invalid filament ID")
-    
-    filament = raft_node.get_filaments()[job.filament_id]
-    queued_running_weight = sum(
-        j.print_weight_in_grams for j in raft_node.get_print_jobs().values()
-        if j.filament_id == job.filament_id and j.status in ["Queued", "Running"]
-    )
-    if job.print_weight_in_grams > filament.remaining_weight_in_grams - queued_running_weight:
-        raise HTTPException(status_code=400, detail="Insufficient filament weight")
+@router.get("/filaments/{filament_id}/ledger")
+async def get_filament_ledger(
+    filament_id: str, response: Response, consistency: Literal["local", "linearizable", "bounded"] = "local",
+    min_index: Optional[int] = None, max_staleness_ms: Optional[int] = Query(None, ge=0),
+    raft_node: RaftNode = Depends(get_raft_node)
+):
+    await _read_barrier(raft_node, response, consistency, min_index, max_staleness_ms)
+    filament = raft_node.get_filaments().get(filament_id)
+    if filament is None:
+        raise HTTPException(status_code=404, detail="Filament not found")
+    reserved = raft_node.get_reserved_weight(filament_id)
+    return {
+        "filament_id": filament_id,
+        "remaining_weight_in_grams": filament.remaining_weight_in_grams,
+        "reserved_grams": reserved,
+        "consumed_grams": raft_node.get_consumed_weight(filament_id),
+        "available_grams": filament.remaining_weight_in_grams - reserved,
+    }
 
+@router.post("/print_jobs")
+async def create_print_job(
+    job: PrintJob, response: Response, idempotency_key: Optional[str] = Header(None, max_length=255),
+    raft_node: RaftNode = Depends(get_raft_node)
+):
+    # Admission (IDs and filament capacity) is decided by the FSM when the
+    # command is applied, not from this node's possibly stale state
     job.status = "Queued"
-    success = raft_node.apply("add_print_job", job.dict())
-    if not success:
+    result = await _command(raft_node, "submit_print_job", job.dict(), idempotency_key)
+    if result in ADMISSION_ERRORS:
+        raise HTTPException(status_code=400, detail=result)
+    if result is not True:
         raise HTTPException(status_code=500, detail="Failed to create print job")
-    logger.info(f"Created print job {job.id}")
+    logger.info("Created print job %s", job.id)
+    response.headers["X-Raft-Index"] = str(raft_node.write_index())
     return job
 
 @router.get("/print_jobs")
-async def list_print_jobs(status: Optional[str] = None, raft_node: RaftNode = Depends(get_raft_node)):
-    return list(raft_node.get_print_jobs(status).values())
+async def list_print_jobs(
+    response: Response, status: Optional[str] = None, limit: Optional[int] = Query(None, ge=1),
+    after: Optional[str] = None, fields: Optional[str] = None, format: Literal["json", "ndjson"] = "json",
+    consistency: Literal["local", "linearizable", "bounded"] = "local",
+    min_index: Optional[int] = None, max_staleness_ms: Optional[int] = Query(None, ge=0),
+    raft_node: RaftNode = Depends(get_raft_node)
+):
+    index = await _read_barrier(raft_node, response, consistency, min_index, max_staleness_ms)
+    return _listing(PrintJob, lambda: raft_node.iter_print_jobs(status, after), response, limit, fields, format, index)
+
+@router.get("/archive/print_jobs")
+async def list_archived_print_jobs(
+    response: Response, status: Optional[str] = None, printer_id: Optional[str] = None,
+    filament_id: Optional[str] = None, limit: Optional[int] = Query(None, ge=1), after: Optional[str] = None,
+    fields: Optional[str] = None, format: Literal["json", "ndjson"] = "json",
+    raft_node: RaftNode = Depends(get_raft_node)
+):
+    # Finished jobs moved out of the FSM, oldest first, from this node's
+    # archive. Archived IDs can repeat, so the X-Next-After cursor names a
+    # place in the archive rather than a job.
+    index = str(raft_node.fsm.applied_index)
+    response.headers["X-Raft-Index"] = index
+    keys = _parse_fields(PrintJob, fields)
+    try:
+        entries = raft_node.iter_archived_jobs(after)
+    except KeyError:
+        raise HTTPException(status_code=400, detail="Unknown cursor in 'after'")
+    entries = (entry for entry in entries
+               if (status is None or entry[1].status == status) and
+               (printer_id is None or entry[1].printer_id == printer_id) and
+               (filament_id is None or entry[1].filament_id == filament_id))
+    if keys:
+        encode = lambda entry: {k: getattr(entry[1], k) for k in keys}
+    else:
+        encode = lambda entry: entry[1].to_dict()
+    if format == "ndjson":
+        return StreamingResponse(_ndjson(islice(entries, limit) if limit else entries, encode),
+                                 media_type="application/x-ndjson", headers={"X-Raft-Index": index})
+    page = list(islice(entries, limit) if limit else entries)
+    if limit and len(page) == limit and next(entries, None) is not None:
+        response.headers["X-Next-After"] = page[-1][0]
+    return [encode(entry) for entry in page]
+
+@router.get("/archive/print_jobs/{job_id}")
+async def get_archived_print_job(job_id: str, raft_node: RaftNode = Depends(get_raft_node)):
+    job = raft_node.get_archived_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Archived print job not found")
+    return job.to_dict()
 
 @router.post("/print_jobs/{job_id}/status")
 async def update_print_job_status(
-    job_id: str, status: str, raft_node: RaftNode = Depends(get_raft_node)
+    job_id: str, status: str, response: Response, idempotency_key: Optional[str] = Header(None, max_length=255),
+    raft_node: RaftNode = Depends(get_raft_node)
 ):
-    if job_id not in raft_node.get_print_jobs():
-        raise HTTPException(status_code=404, detail="Print job not found")
     if status not in ["Running", "Done", "Cancelled"]:
         raise HTTPException(status_code=400, detail="Invalid status")
 
-    success = raft_node.apply("update_print_job_status", {"job_id": job_id, "status": status})
-    if not success:
+    def precheck():
+        if job_id not in raft_node.get_print_jobs():
+            raise HTTPException(status_code=404, detail="Print job not found")
+
+    # The FSM refuses a transition the job's status does not allow, or
+    # starting a job on a printer that is already running one or with a
+    # spool that is running on another printer
+    result = await _command(raft_node, "transition_print_job", {"job_id": job_id, "status": status},
+                            idempotency_key, precheck)
+    if result == JOB_NOT_FOUND:
+        raise HTTPException(status_code=404, detail=result)
+    if result == INVALID_TRANSITION:
+        raise HTTPException(status_code=400, detail=result)
+    if result in (PRINTER_BUSY, FILAMENT_IN_USE):
+        raise HTTPException(status_code=409, detail=result)
+    if result is not True:
         raise HTTPException(status_code=500, detail="Failed to update print job status")
-    logger.info(f"Updated print job {job_id} to status {status}")
-    return {"job_id": job_id, "status": status}
\ No newline at end of file
+    logger.info("Updated print job %s to status %s", job_id, status)
+    response.headers["X-Raft-Index"] = str(raft_node.write_index())
+    return {"job_id": job_id, "status": status}
+
+@router.post("/printers/batch")
+async def create_printers_batch(request: Request, response: Response, raft_node: RaftNode = Depends(get_raft_node)):
+    printers = raft_node.get_printers()
+    seen = set()
+
+    def admit(printer: Printer) -> Optional[str]:
+        if printer.id in printers or printer.id in seen:
+            return "Printer ID already exists"
+        seen.add(printer.id)
+        return None
+
+    return await _bulk_create(request, response, raft_node, Printer, "add_printer", admit)
+
+@router.post("/filaments/batch")
+async def create_filaments_batch(request: Request, response: Response, raft_node: RaftNode = Depends(get_raft_node)):
+    filaments = raft_node.get_filaments()
+    seen = set()
+
+    def admit(filament: Filament) -> Optional[str]:
+        if filament.id in filaments or filament.id in seen:
+            return "Filament ID already exists"
+        seen.add(filament.id)
+        return None
+
+    return await _bulk_create(request, response, raft_node, Filament, "add_filament", admit)
+
+@router.post("/print_jobs/batch")
+async def create_print_jobs_batch(request: Request, response: Response, raft_node: RaftNode = Depends(get_raft_node)):
+    # Each job is admitted by the FSM in order, so jobs earlier in the batch
+    # count against the filament for later ones
+    def admit(job: PrintJob) -> Optional[str]:
+        job.status = "Queued"
+        return None
+
+    return await _bulk_create(request, response, raft_node, PrintJob, "submit_print_job", admit)
+
+@router.get("/watch")
+async def watch(
+    request: Request, since: Optional[int] = Query(None, ge=0), type: Optional[str] = None,
+    status: Optional[str] = None, printer_id: Optional[str] = None,
+    raft_node: RaftNode = Depends(get_raft_node), feed: ChangeFeed = Depends(get_change_feed)
+):
+    # Server-Sent Events stream of committed changes, each carrying the log
+    # index of its entry. `since` (or Last-Event-ID on reconnect) resumes after
+    # that index; list with X-Raft-Index first, then watch from it to miss
+    # nothing. `type` takes a comma-separated list of printer, filament, print_job.
+    kinds = [k.strip() for k in type.split(",") if k.strip()] if type else []
+    unknown = [k for k in kinds if k not in WATCH_KINDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown types: {', '.join(unknown)}")
+    if status is not None and status not in JOB_STATUSES:
+        raise HTTPException(status_code=400, detail="Invalid status")
+    if since is None and request.headers.get("last-event-id", "").isdigit():
+        since = int(request.headers["last-event-id"])
+    # A client resuming on a node that trails the one it came from gets a
+    # moment for this node to catch up
+    if since is not None and since > raft_node.fsm.applied_index:
+        await raft_node.wait_bounded(since, None)
+    try:
+        subscription = feed.watch(since, WatchFilter(kinds, status, printer_id))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if subscription is None:
+        raise HTTPException(status_code=410, detail=f"Changes after index {since} are no longer kept; "
+                                                    f"list again and watch from its X-Raft-Index")
+
+    async def stream():
+        try:
+            yield b"retry: 1000\n\n"
+            while True:
+                events = await subscription.next(WATCH_KEEPALIVE_SECONDS)
+                if events:
+                    yield b"".join(event.encode() for event in events)
+                if subscription.overflowed:
+                    # Resume from the last id received, as EventSource does
+                    yield b"event: overflow\ndata: {}\n\n"
+                    return
+                if subscription.reset:
+                    # Resuming is not possible; the client lists again
+                    yield b"event: reset\ndata: {}\n\n"
+                    return
+                if not events:
+                    yield b": keepalive\n\n"
+        finally:
+            feed.cancel(subscription)
+
+    headers = {"Cache-Control": "no-cache", "X-Raft-Index": str(raft_node.fsm.applied_index)}
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=headers)
+
+@router.post("/raft/transfer_leadership")
+async def transfer_leadership(target: Optional[str] = None, raft_node: RaftNode = Depends(get_raft_node)):
+    # Hands leadership to `target` (a raft address) or the most caught-up peer
+    if raft_node.leader() is None or not await raft_node.transfer_leadership(target):
+        raise HTTPException(status_code=409, detail=f"Leadership not transferred; the leader is {raft_node.leader()}")
+    logger.info("Leadership transferred away from this node")
+    return {"transferred": True}
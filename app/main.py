@@ -1,17 +1,62 @@
 import os
+import asyncio
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from app.api.handlers import router, set_raft_node
+from app.api.handlers import router, set_raft_node, set_change_feed
+from app.raft.watch import ChangeFeed
 from app.raft.store import RaftNode
-from app.monitoring.metrics import setup_metrics, is_leader
+from app.monitoring.metrics import setup_metrics, set_owner_metrics, is_leader
+from app.monitoring.logs import setup_logging
 import logging
 
-# Configure logging with DEBUG level
+# Queue-based logging configured from LOG_LEVEL and friends; see app/monitoring/logs.py
+setup_logging()
 logger = logging.getLogger("raft3d")
-logger.setLevel(logging.DEBUG)  # Changed from INFO to DEBUG
-logger.handlers = [logging.StreamHandler()]
 
-app = FastAPI(title="Raft3D API")
+# Seconds uvicorn waits for open requests on shutdown; watch streams never
+# finish on their own, so they are cut off after this
+SHUTDOWN_TIMEOUT = 5
+
+
+def start_change_feed(fsm) -> ChangeFeed:
+    # WATCH_HISTORY changes are kept for resuming; a watcher more than
+    # WATCH_BUFFER changes behind is cut off
+    feed = ChangeFeed(fsm, asyncio.get_running_loop(), int(os.getenv("WATCH_HISTORY", "10000")),
+                      int(os.getenv("WATCH_BUFFER", "1000")))
+    set_change_feed(feed)
+    return feed
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # In an HTTP worker process (HTTP_WORKERS > 1) the API is served from a
+    # replica of the owner process's FSM; see app/raft/replica.py
+    socket_path = os.getenv("REPLICA_SOCKET")
+    if not socket_path:
+        raft_node = getattr(app.state, "raft_node", None)
+        feed = start_change_feed(raft_node.fsm) if raft_node is not None else None
+        yield
+        if feed is not None:
+            feed.close()
+        # uvicorn re-raises SIGTERM once it has shut down, so the node is
+        # stopped here; stepping down lets a peer take over at once instead
+        # of after an election timeout
+        if raft_node is not None:
+            await asyncio.to_thread(raft_node.stop)
+        return
+    from app.raft.replica import ReplicaNode
+    replica = ReplicaNode(socket_path, os.getenv("NODE_ID"))
+    await replica.start()
+    set_raft_node(replica)
+    set_owner_metrics(replica.owner_metrics)
+    feed = start_change_feed(replica.fsm)
+    yield
+    feed.close()
+    await replica.stop()
+
+
+app = FastAPI(title="Raft3D API", lifespan=lifespan)
 app.include_router(router, prefix="/api/v1")
 setup_metrics(app)
 
@@ -21,17 +66,32 @@ def main():
     http_port = int(os.getenv("HTTP_PORT", "8080"))
     raft_dir = os.getenv("RAFT_DIR")
     cluster = os.getenv("CLUSTER")
+    workers = int(os.getenv("HTTP_WORKERS", "1"))
 
     raft_node = RaftNode(node_id, raft_port, raft_dir, cluster)
-    set_raft_node(raft_node)
 
     # Set initial leader status
     leader_status = 1 if raft_node.raft.is_leader else 0
     is_leader.labels(node_id=node_id).set(leader_status)
-    logger.info(f"Set initial raft3d_is_leader for {node_id} to {leader_status}")
+    logger.info("Set initial raft3d_is_leader for %s to %s", node_id, leader_status)
 
-    logger.info(f"Starting Raft3D node {node_id} on HTTP port {http_port} and Raft port {raft_port}")
-    uvicorn.run(app, host="0.0.0.0", port=http_port)
+    logger.info("Starting Raft3D node %s on HTTP port %s and Raft port %s", node_id, http_port, raft_port)
+    if workers > 1:
+        # This process keeps Raft and the FSM; uvicorn's worker processes
+        # serve HTTP from replicas fed over a Unix socket in RAFT_DIR
+        from app.raft.replica import ReplicaServer
+        socket_path = os.path.join(raft_dir, "replica.sock")
+        ReplicaServer(raft_node, socket_path).start()
+        os.environ["REPLICA_SOCKET"] = socket_path
+        logger.info("Serving HTTP from %s worker processes", workers)
+        uvicorn.run("app.main:app", host="0.0.0.0", port=http_port, workers=workers, log_config=None,
+                    timeout_graceful_shutdown=SHUTDOWN_TIMEOUT)
+        raft_node.stop()
+    else:
+        set_raft_node(raft_node)
+        app.state.raft_node = raft_node
+        uvicorn.run(app, host="0.0.0.0", port=http_port, log_config=None,
+                    timeout_graceful_shutdown=SHUTDOWN_TIMEOUT)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
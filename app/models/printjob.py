@@ -7,4 +7,5 @@ class PrintJob(BaseModel):
     filament_id: str
     filepath: str
     print_weight_in_grams: int
-    status: Literal["Queued", "Running", "Done", "Cancelled"]
\ No newline at end of file
+    status: Literal["Queued", "Running", "Done", "Cancelled"]
+    priority: int = 0
\ No newline at end of file
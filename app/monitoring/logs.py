@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import time
+import queue
+import random
+import atexit
+import logging
+import threading
+import urllib.request
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Tuple
+from app.monitoring.metrics import log_dropped_total
+
+# Logging pipeline. Calls on the request and apply paths only run the filter
+# below and put the record on a bounded queue; formatting (including the
+# %-style message arguments), JSON encoding and all I/O happen on the
+# listener thread. Configured from the environment:
+#
+#   LOG_LEVEL            level for the raft3d logger and root (default INFO)
+#   LOG_FORMAT           json or text (default json)
+#   LOG_RATE, LOG_BURST  per message type below WARNING: records per second,
+#                        bucket size (default 20 and 100; LOG_RATE=0 turns
+#                        limits off)
+#   LOG_SAMPLE           "message prefix=probability,..." sampling of records
+#                        below WARNING whose message template starts with prefix
+#   LOG_QUEUE_SIZE       records buffered before new ones are dropped
+#   LOKI_URL             ship logs to a Loki-compatible push API as well
+#   LOKI_LABELS          extra stream labels, "key=value,..."
+#   LOKI_BATCH_SIZE, LOKI_FLUSH_INTERVAL  batching for the Loki shipper
+#
+# A message type is the unformatted template (record.msg), so log calls pass
+# arguments separately instead of building f-strings.
+
+_listener: Optional[QueueListener] = None
+_dropped = {reason: log_dropped_total.labels(reason=reason)
+            for reason in ("sampled", "rate_limited", "queue_full", "loki")}
+
+
+class RateLimitFilter(logging.Filter):
+    # Token bucket per message template plus optional sampling, for records
+    # below WARNING; warnings and errors always pass. Counters are
+    # updated without a lock; a race can let an extra record through, which
+    # is cheaper than contending on every log call. When records of a type
+    # were dropped, the next one to pass carries the count as `suppressed`.
+    def __init__(self, rate: float, burst: float, samples: List[Tuple[str, float]]):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.samples = samples
+        self.buckets: Dict[str, List[float]] = {}
+        self.probabilities: Dict[str, float] = {}
+
+    def _probability(self, template: str) -> float:
+        probability = self.probabilities.get(template)
+        if probability is None:
+            probability = next((p for prefix, p in self.samples if template.startswith(prefix)), 1.0)
+            self.probabilities[template] = probability
+        return probability
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        template = str(record.msg)
+        if self.samples:
+            probability = self._probability(template)
+            if probability < 1.0 and random.random() >= probability:
+                _dropped["sampled"].inc()
+                return False
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.get(template)
+        if bucket is None:
+            # tokens, last refill, records dropped since the last one passed
+            bucket = self.buckets[template] = [self.burst, now, 0]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            bucket[2] += 1
+            _dropped["rate_limited"].inc()
+            return False
+        bucket[0] = tokens - 1
+        if bucket[2]:
+            record.suppressed = bucket[2]
+            bucket[2] = 0
+        return True
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The stock handler formats here, on the caller's thread; records stay
+        # unformatted until the listener thread handles them
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped["queue_full"].inc()
+
+
+class JSONFormatter(logging.Formatter):
+    def __init__(self, node_id: Optional[str] = None):
+        super().__init__()
+        self.node_id = node_id
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "node": self.node_id,
+        }
+        suppressed = getattr(record, "suppressed", None)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        suppressed = getattr(record, "suppressed", None)
+        return f"{line} ({suppressed} similar suppressed)" if suppressed else line
+
+
+class LokiShipper(logging.Handler):
+    # Batches formatted lines and POSTs them to a Loki push endpoint
+    # (/loki/api/v1/push) from its own thread, every flush_interval seconds or
+    # as soon as batch_size lines are waiting. A failed push is retried with
+    # the next batch; past max_pending lines the oldest are dropped.
+    def __init__(self, url: str, labels: Dict[str, str], batch_size: int = 500,
+                 flush_interval: float = 1.0, max_pending: int = 10000, timeout: float = 5.0):
+        super().__init__()
+        self.url = url.rstrip("/")
+        if not self.url.endswith("/loki/api/v1/push"):
+            self.url += "/loki/api/v1/push"
+        self.labels = labels
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending: List[List[str]] = []
+        self.pending_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="loki-shipper", daemon=True)
+        self.thread.start()
+
+    def emit(self, record: logging.LogRecord):
+        line = self.format(record)
+        with self.pending_lock:
+            self.pending.append([str(int(record.created * 1e9)), line])
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wake.set()
+
+    def _run(self):
+        while self.running:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.pending_lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return
+        body = json.dumps({"streams": [{"stream": self.labels, "values": batch}]}).encode()
+        request = urllib.request.Request(self.url, data=body, method="POST",
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except Exception:
+            with self.pending_lock:
+                self.pending = batch + self.pending
+                excess = len(self.pending) - self.max_pending
+                if excess > 0:
+                    del self.pending[:excess]
+                    _dropped["loki"].inc(excess)
+
+    def close(self):
+        self.running = False
+        self.wake.set()
+        self.thread.join(self.timeout)
+        self.flush()
+        super().close()
+
+
+def _pairs(value: str) -> List[Tuple[str, str]]:
+    pairs = []
+    for part in value.split(","):
+        key, sep, item = part.rpartition("=")
+        if sep and key.strip():
+            pairs.append((key.strip(), item.strip()))
+    return pairs
+
+
+def setup_logging():
+    global _listener
+    if _listener is not None:
+        return
+    level = os.getenv("LOG_LEVEL", "INFO").upper()
+    node_id = os.getenv("NODE_ID")
+    formatter = TextFormatter() if os.getenv("LOG_FORMAT", "json").lower() == "text" else JSONFormatter(node_id)
+
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(formatter)
+    handlers: List[logging.Handler] = [stream]
+    loki_url = os.getenv("LOKI_URL")
+    if loki_url:
+        labels = {"app": "raft3d", "node": node_id or "unknown"}
+        labels.update(_pairs(os.getenv("LOKI_LABELS", "")))
+        loki = LokiShipper(loki_url, labels, int(os.getenv("LOKI_BATCH_SIZE", "500")),
+                           float(os.getenv("LOKI_FLUSH_INTERVAL", "1.0")))
+        loki.setFormatter(JSONFormatter(node_id))
+        handlers.append(loki)
+
+    # Records are never formatted with caller, thread or process details, so
+    # skip collecting them (the switches the logging docs list for this)
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    log_queue: queue.Queue = queue.Queue(int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+    handler = _NonBlockingQueueHandler(log_queue)
+    rate = float(os.getenv("LOG_RATE", "20"))
+    samples = [(prefix, float(p)) for prefix, p in _pairs(os.getenv("LOG_SAMPLE", ""))]
+    handler.addFilter(RateLimitFilter(rate, float(os.getenv("LOG_BURST", "100")), samples))
+
+    # Everything (uvicorn's loggers included) goes through the root logger's
+    # queue handler
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    logger = logging.getLogger("raft3d")
+    logger.handlers = []
+    logger.setLevel(level)
+    logger.propagate = True
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    # Drains the queue and flushes the shippers
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
@@ -1,18 +1,155 @@
-from prometheus_client import Counter, Gauge, generate_latest
+import os
+import time
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
 from fastapi import FastAPI, Response
 import logging
 
 logger = logging.getLogger("raft3d")
 
+# Buckets for in-process work (FSM apply, lock wait and hold) that is usually
+# measured in microseconds, and for request paths that include a Raft commit
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+REQUEST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
 # Metrics
 requests_total = Counter('raft3d_requests_total', 'Total HTTP requests', ['method', 'endpoint'])
+request_duration_seconds = Histogram('raft3d_request_duration_seconds', 'HTTP request latency by route',
+                                     ['method', 'endpoint'], buckets=REQUEST_BUCKETS)
+apply_duration_seconds = Histogram('raft3d_apply_duration_seconds',
+                                   'Time from proposing a command to its result, by op', ['op'],
+                                   buckets=REQUEST_BUCKETS)
+fsm_apply_duration_seconds = Histogram('raft3d_fsm_apply_duration_seconds',
+                                       'Time to apply one log entry to the FSM, by op', ['op'],
+                                       buckets=FAST_BUCKETS)
+fsm_lock_wait_seconds = Histogram('raft3d_fsm_lock_wait_seconds', 'Time spent waiting for the FSM lock',
+                                  ['caller'], buckets=FAST_BUCKETS)
+fsm_lock_hold_seconds = Histogram('raft3d_fsm_lock_hold_seconds', 'Time the FSM lock is held',
+                                  ['caller'], buckets=FAST_BUCKETS)
+log_append_duration_seconds = Histogram('raft3d_log_append_duration_seconds',
+                                        'Time to append and sync one batch of proposals to the log',
+                                        buckets=FAST_BUCKETS)
+proposal_batch_size = Histogram('raft3d_proposal_batch_size', 'Proposals appended per log write',
+                                buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
 snapshots_total = Counter('raft3d_snapshots_total', 'Total snapshots taken')
+snapshot_duration_seconds = Histogram('raft3d_snapshot_duration_seconds', 'Time to take and write a snapshot')
+snapshot_bytes = Gauge('raft3d_snapshot_bytes', 'Size of the most recent snapshot in bytes')
+restore_duration_seconds = Histogram('raft3d_snapshot_restore_duration_seconds',
+                                     'Time to load a snapshot into the FSM')
+snapshot_installs_total = Counter('raft3d_snapshot_installs_total', 'Snapshots received from the leader and loaded')
+snapshot_send_duration_seconds = Histogram('raft3d_snapshot_send_duration_seconds',
+                                           'Time to stream a snapshot to a follower and have it loaded')
 is_leader = Gauge('raft3d_is_leader', 'Whether the node is the leader', ['node_id'])
+raft_term = Gauge('raft3d_term', 'Current Raft term')
+elections_total = Counter('raft3d_elections_total', 'Pre-votes and elections started by this node', ['kind'])
+leader_changes_total = Counter('raft3d_leader_changes_total', 'Times this node learned of a new leader')
+time_to_elect_seconds = Histogram('raft3d_time_to_elect_seconds',
+                                  'Time from losing the leader to knowing the next one',
+                                  buckets=(0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0))
+archived_jobs_total = Counter('raft3d_archived_jobs_total', 'Finished jobs written to this node\'s archive')
+idempotent_replays_total = Counter('raft3d_idempotent_replays_total',
+                                   'Retried writes answered from the idempotency table without a proposal')
+watch_subscribers = Gauge('raft3d_watch_subscribers', 'Open watch streams')
+watch_overflows_total = Counter('raft3d_watch_overflows_total', 'Watch streams cut off for falling behind')
+log_dropped_total = Counter('raft3d_log_dropped_total', 'Log records dropped before output', ['reason'])
+
+
+class FSMCollector:
+    # Entity counts and estimated sizes, computed when /metrics is scraped
+    # rather than maintained on every apply
+    def __init__(self):
+        self.fsm = None
+
+    def collect(self):
+        if self.fsm is None:
+            return
+        entities = GaugeMetricFamily('raft3d_fsm_entities', 'Records held by the FSM', labels=['kind'])
+        size = GaugeMetricFamily('raft3d_fsm_estimated_bytes', 'Estimated memory held by FSM records',
+                                 labels=['kind'])
+        for kind, (count, estimate) in self.fsm.stats().items():
+            entities.add_metric([kind], count)
+            size.add_metric([kind], estimate)
+        yield entities
+        yield size
+
+
+fsm_collector = FSMCollector()
+REGISTRY.register(fsm_collector)
+
+
+def watch_fsm(fsm):
+    fsm_collector.fsm = fsm
+
+
+# With HTTP_WORKERS > 1 these families are owned by the consensus process;
+# worker processes fetch them from it and serve the rest from their own registry
+OWNER_METRICS = {
+    'raft3d_fsm_apply_duration_seconds', 'raft3d_fsm_lock_wait_seconds', 'raft3d_fsm_lock_hold_seconds',
+    'raft3d_log_append_duration_seconds', 'raft3d_proposal_batch_size', 'raft3d_snapshots',
+    'raft3d_snapshot_duration_seconds', 'raft3d_snapshot_bytes', 'raft3d_snapshot_restore_duration_seconds',
+    'raft3d_snapshot_installs', 'raft3d_snapshot_send_duration_seconds', 'raft3d_archived_jobs',
+    'raft3d_is_leader', 'raft3d_term', 'raft3d_elections', 'raft3d_leader_changes',
+    'raft3d_time_to_elect_seconds',
+}
+
+
+class _Families:
+    # Registry view limited to the metric families `keep` accepts
+    def __init__(self, keep):
+        self.keep = keep
+
+    def collect(self):
+        return (family for family in REGISTRY.collect() if self.keep(family.name))
+
+
+def owner_metrics() -> bytes:
+    return generate_latest(_Families(lambda name: name in OWNER_METRICS))
+
+
+_owner_source = None
+
+
+def set_owner_metrics(source):
+    # source is an async callable returning the owner process's owner_metrics()
+    global _owner_source
+    _owner_source = source
+
+
+class LatencyMiddleware:
+    # Plain ASGI middleware: times each request through to the last body
+    # chunk and labels it with the matched route template, so path parameters
+    # do not multiply the label sets
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get("route")
+            endpoint = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            request_duration_seconds.labels(method=method, endpoint=endpoint).observe(time.perf_counter() - start)
+            requests_total.labels(method=method, endpoint=endpoint).inc()
+
 
 def setup_metrics(app: FastAPI):
     logger.info("Setting up Prometheus metrics")
+    app.add_middleware(LatencyMiddleware)
+
     @app.get("/metrics")
     async def metrics():
-        logger.info("Serving metrics endpoint")
-        requests_total.labels(method="GET", endpoint="/metrics").inc()
-        return Response(content=generate_latest(), media_type="text/plain")
\ No newline at end of file
+        logger.debug("Serving metrics endpoint")
+        if _owner_source is None:
+            return Response(content=generate_latest(), media_type="text/plain")
+        local = generate_latest(_Families(lambda name: name not in OWNER_METRICS))
+        return Response(content=local + await _owner_source(), media_type="text/plain")
+
+    if os.getenv("ENABLE_PROFILER", "").lower() in ("1", "true", "yes"):
+        from app.monitoring.profiler import setup_profiler
+        setup_profiler(app)
@@ -0,0 +1,63 @@
+import sys
+import time
+import asyncio
+import threading
+import logging
+from collections import Counter
+from typing import Dict, Tuple
+from fastapi import FastAPI, HTTPException, Query, Response
+
+logger = logging.getLogger("raft3d")
+
+# Sampling profiler for a live node. A background thread reads every thread's
+# current stack at a fixed interval; nothing is traced between samples, so
+# the node runs at full speed outside a profiling window and only one window
+# runs at a time.
+_profile_lock = threading.Lock()
+
+
+def _stack(frame) -> Tuple[str, ...]:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+def sample_stacks(seconds: float, interval: float) -> Tuple[Counter, int]:
+    names: Dict[int, str] = {t.ident: t.name for t in threading.enumerate()}
+    me = threading.get_ident()
+    counts: Counter = Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                counts[(names.get(ident, str(ident)),) + _stack(frame)] += 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+
+def collapsed(counts: Counter, limit: int) -> str:
+    # One line per distinct stack, "thread;outer;...;inner count", hottest
+    # first; the format flamegraph tools read directly
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in counts.most_common(limit))
+
+
+def setup_profiler(app: FastAPI):
+    logger.info("Sampling profiler enabled at /debug/profile")
+
+    @app.get("/debug/profile")
+    async def profile(seconds: float = Query(5.0, gt=0, le=60),
+                      interval_ms: float = Query(10.0, ge=1, le=1000),
+                      limit: int = Query(200, ge=1, le=10000)):
+        if not _profile_lock.acquire(blocking=False):
+            raise HTTPException(status_code=409, detail="A profile is already running")
+        try:
+            counts, samples = await asyncio.to_thread(sample_stacks, seconds, interval_ms / 1000)
+        finally:
+            _profile_lock.release()
+        return Response(content=collapsed(counts, limit), media_type="text/plain",
+                        headers={"X-Profile-Samples": str(samples)})
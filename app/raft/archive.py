@@ -0,0 +1,331 @@
+import os
+import json
+import zlib
+import struct
+import asyncio
+import hashlib
+import logging
+import threading
+from bisect import bisect_right
+from collections import deque
+from itertools import islice
+from typing import Deque, Iterator, List, Optional, Tuple
+from app.raft.fsm import TERMINAL_STATUSES
+from app.raft.records import JobRecord
+from app.monitoring.metrics import archived_jobs_total
+
+logger = logging.getLogger("raft3d")
+
+# Finished jobs moved out of the FSM by archive_jobs commands. Each node
+# writes the jobs of every such command it applies as one block: the jobs as
+# JSON lines, zlib-compressed, appended to jobs.dat. jobs.idx holds one small
+# entry per block (the command's log index, where the block is and a Bloom
+# filter of its job IDs), so finding a job by ID only decompresses the
+# blocks that may hold it. Both files are framed like the WAL (payload
+# length and CRC32, then the payload) and only ever appended to. A follower
+# caught up by InstallSnapshot is sent the leader's blocks along with it
+# (see Raft._send_archive), so every node ends up with the same archive.
+
+ARCHIVE_DATA = "jobs.dat"
+ARCHIVE_INDEX = "jobs.idx"
+RECORD_HEADER = struct.Struct(">II")
+BLOCK = struct.Struct(">QQII")
+BLOOM_BITS_PER_JOB = 10
+BLOOM_HASHES = 7
+
+
+def _frame(payload: bytes) -> bytes:
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _bloom_bits(job_id: str, size: int) -> Iterator[int]:
+    # Double hashing over one 64-bit digest
+    digest = hashlib.blake2b(job_id.encode(), digest_size=8).digest()
+    h1 = int.from_bytes(digest[:4], "big")
+    h2 = int.from_bytes(digest[4:], "big") | 1
+    return ((h1 + i * h2) % size for i in range(BLOOM_HASHES))
+
+
+class ArchiveBlock:
+    __slots__ = ("index", "offset", "length", "count", "bloom")
+
+    def __init__(self, index: int, offset: int, length: int, count: int, bloom: bytes):
+        self.index = index
+        self.offset = offset
+        self.length = length
+        self.count = count
+        self.bloom = bloom
+
+    def may_hold(self, job_id: str) -> bool:
+        bloom = self.bloom
+        return all(bloom[bit >> 3] & (1 << (bit & 7)) for bit in _bloom_bits(job_id, len(bloom) * 8))
+
+
+class JobArchive:
+    # One writer, the process that applies the log; HTTP worker processes
+    # open the same directory read-only and pick up new blocks from the
+    # index as they query. The FSM hands blocks over under its lock and a
+    # writer thread compresses, writes and syncs them, so the lock is never
+    # held across an fsync; flush() waits for them before a snapshot.
+    def __init__(self, path: str, writable: bool = True):
+        self.path = path
+        self.data_path = os.path.join(path, ARCHIVE_DATA)
+        self.index_path = os.path.join(path, ARCHIVE_INDEX)
+        self.writable = writable
+        self.blocks: List[ArchiveBlock] = []
+        # Bytes of the index file read so far
+        self.index_size = 0
+        self.lock = threading.Lock()
+        # Blocks handed over and not yet on disk, oldest first, as (log
+        # index, jobs, encoded block); written wakes flush() and the writer
+        self.queue: Deque[Tuple[int, Optional[List[JobRecord]], Optional[Tuple[bytes, int, bytes]]]] = deque()
+        self.written = threading.Condition(self.lock)
+        self.closing = False
+        self.writer = None
+        if writable:
+            os.makedirs(path, exist_ok=True)
+        self._load_index()
+        # Log index of the newest block written or queued
+        self.queued_index = self.last_index
+        if writable:
+            self._trim()
+            self.writer = threading.Thread(target=self._run, name="archive-writer", daemon=True)
+            self.writer.start()
+
+    @property
+    def last_index(self) -> int:
+        return self.blocks[-1].index if self.blocks else 0
+
+    def _load_index(self):
+        # Reads index entries appended since the last call; a torn entry at
+        # the end (a crash mid-append, or the writer still writing) is left
+        # for the next call
+        try:
+            with open(self.index_path, "rb") as f:
+                f.seek(self.index_size)
+                buf = f.read()
+        except FileNotFoundError:
+            return
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(buf):
+            length, crc = RECORD_HEADER.unpack_from(buf, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + length
+            if end > len(buf) or zlib.crc32(buf[start:end]) != crc:
+                break
+            index, data_offset, data_length, count = BLOCK.unpack_from(buf, start)
+            self.blocks.append(ArchiveBlock(index, data_offset, data_length, count, buf[start + BLOCK.size:end]))
+            offset = end
+        self.index_size += offset
+
+    def _trim(self):
+        # Drops whatever a crash left after the last complete block, so
+        # appends continue from a clean end
+        data_end = self.blocks[-1].offset + self.blocks[-1].length if self.blocks else 0
+        for path, size in ((self.index_path, self.index_size), (self.data_path, data_end)):
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                logger.warning("Truncating archive file %s to %s bytes", path, size)
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+
+    def append(self, index: int, jobs: List[JobRecord]):
+        # Called by the FSM under its lock as it applies the archive_jobs
+        # entry at log index. Entries replayed after a restart were written
+        # before and are skipped.
+        self._enqueue(index, jobs, None)
+
+    def receive_block(self, index: int, data: bytes, count: int, bloom: bytes):
+        # A block as read_raw() returned it on the leader. Raises ValueError
+        # if it was damaged on the way.
+        length, crc = RECORD_HEADER.unpack_from(data)
+        if length != len(data) - RECORD_HEADER.size or zlib.crc32(data[RECORD_HEADER.size:]) != crc:
+            raise ValueError(f"Archive block at index {index} failed its CRC check")
+        self._enqueue(index, None, (data, count, bloom))
+
+    def _enqueue(self, index: int, jobs: Optional[List[JobRecord]], encoded: Optional[Tuple[bytes, int, bytes]]):
+        with self.lock:
+            if index <= self.queued_index:
+                return
+            self.queue.append((index, jobs, encoded))
+            self.queued_index = index
+            self.written.notify_all()
+
+    def flush(self, index: Optional[int] = None):
+        # Waits until the blocks queued at or below index (all of them if
+        # None) are on disk
+        with self.lock:
+            while self.queue and (index is None or self.queue[0][0] <= index):
+                self.written.wait()
+
+    def close(self):
+        # Writes what is queued and stops the writer
+        with self.lock:
+            self.closing = True
+            self.written.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.closing:
+                    self.written.wait()
+                if not self.queue:
+                    return
+                index, jobs, encoded = self.queue[0]
+            written = self._write(index, jobs, encoded)
+            with self.lock:
+                self.queue.popleft()
+                if written is not None:
+                    block, entry_size = written
+                    self.blocks.append(block)
+                    self.index_size += entry_size
+                self.written.notify_all()
+            if written is not None:
+                archived_jobs_total.inc(written[0].count)
+
+    def _write(self, index: int, jobs: Optional[List[JobRecord]],
+               encoded: Optional[Tuple[bytes, int, bytes]]) -> Optional[Tuple[ArchiveBlock, int]]:
+        try:
+            if encoded is None:
+                payload = zlib.compress("\n".join(json.dumps(job.to_dict(), separators=(",", ":"))
+                                                  for job in jobs).encode())
+                bloom = bytearray(max(1, len(jobs) * BLOOM_BITS_PER_JOB // 8))
+                for job in jobs:
+                    for bit in _bloom_bits(job.id, len(bloom) * 8):
+                        bloom[bit >> 3] |= 1 << (bit & 7)
+                encoded = (_frame(payload), len(jobs), bytes(bloom))
+            data, count, bloom = encoded
+            with open(self.data_path, "ab") as f:
+                offset = f.tell()
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            entry = _frame(BLOCK.pack(index, offset, len(data), count) + bloom)
+            with open(self.index_path, "ab") as f:
+                f.write(entry)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            # The FSM has dropped the jobs on every node either way; this
+            # node's archive goes without them
+            logger.error("Failed to archive the jobs at index %s: %s", index, e)
+            return None
+        return ArchiveBlock(index, offset, len(data), count, bloom), len(entry)
+
+    def _refresh(self) -> List[ArchiveBlock]:
+        with self.lock:
+            if not self.writable:
+                self._load_index()
+            return list(self.blocks)
+
+    def blocks_between(self, after: int, upto: int) -> List[ArchiveBlock]:
+        # Blocks of the log indexes in (after, upto]
+        blocks = self._refresh()
+        indexes = [block.index for block in blocks]
+        return blocks[bisect_right(indexes, after):bisect_right(indexes, upto)]
+
+    def read_raw(self, block: ArchiveBlock) -> bytes:
+        # The block as stored, CRC-checked
+        with open(self.data_path, "rb") as f:
+            f.seek(block.offset)
+            buf = f.read(block.length)
+        length, crc = RECORD_HEADER.unpack_from(buf)
+        if length != len(buf) - RECORD_HEADER.size or zlib.crc32(buf[RECORD_HEADER.size:]) != crc:
+            raise ValueError(f"Archive block at index {block.index} failed its CRC check")
+        return buf
+
+    def _read_block(self, block: ArchiveBlock) -> List[JobRecord]:
+        payload = self.read_raw(block)[RECORD_HEADER.size:]
+        return [JobRecord.from_value(json.loads(line)) for line in zlib.decompress(payload).split(b"\n")]
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        # The most recently archived job with this ID; IDs of archived jobs
+        # can be submitted again
+        for block in reversed(self._refresh()):
+            if block.may_hold(job_id):
+                for job in reversed(self._read_block(block)):
+                    if job.id == job_id:
+                        return job
+        return None
+
+    def iter_jobs(self, after: Optional[str] = None) -> Iterator[Tuple[str, JobRecord]]:
+        # Archived jobs, oldest first, each with the cursor that resumes
+        # after it: the log index of its block and its place in the block.
+        # Raises KeyError for a malformed cursor.
+        blocks = self._refresh()
+        start, skip = 0, 0
+        if after is not None:
+            try:
+                index, position = (int(part) for part in after.split("."))
+            except ValueError:
+                raise KeyError(after)
+            start = bisect_right([block.index for block in blocks], index) - 1
+            if start < 0 or blocks[start].index != index:
+                raise KeyError(after)
+            skip = position + 1
+        return self._iter_blocks(blocks[start:], skip)
+
+    def _iter_blocks(self, blocks: List[ArchiveBlock], skip: int) -> Iterator[Tuple[str, JobRecord]]:
+        for block in blocks:
+            for position, job in enumerate(self._read_block(block)):
+                if position >= skip:
+                    yield f"{block.index}.{position}", job
+            skip = 0
+
+
+class Archiver:
+    # Retention policy, run on every node and acting only while it leads:
+    # every interval it names up to batch_size of the oldest Done and
+    # Cancelled jobs beyond the newest `keep` of each status and proposes
+    # archive_jobs for them. The leader names the jobs because each replica
+    # may hold its status indexes in a different order.
+    def __init__(self, node, keep: int, batch_size: int = 10000, interval: float = 60.0):
+        self.node = node
+        self.keep = keep
+        self.batch_size = batch_size
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="archiver", daemon=True)
+        self.thread.start()
+        logger.info("Job archiver started, keeping %s finished jobs per status", self.keep)
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def candidates(self) -> List[str]:
+        fsm = self.node.fsm
+        job_ids: List[str] = []
+        with fsm.archive_lock:
+            for status in TERMINAL_STATUSES:
+                jobs = fsm.jobs_by_status.get(status, ())
+                excess = min(len(jobs) - self.keep, self.batch_size - len(job_ids))
+                if excess > 0:
+                    job_ids.extend(islice(jobs, excess))
+        return job_ids
+
+    def run(self):
+        raft = self.node.raft
+        while not self.stopped.wait(self.interval):
+            while raft.is_leader and not self.stopped.is_set():
+                job_ids = self.candidates()
+                if not job_ids:
+                    break
+                command = json.dumps({"op": "archive_jobs", "value": {"job_ids": job_ids}})
+                future = asyncio.run_coroutine_threadsafe(raft.propose([command]), raft.loop)
+                try:
+                    result = future.result(timeout=raft.apply_timeout)[0]
+                except Exception as e:
+                    future.cancel()
+                    result = e
+                if not isinstance(result, int) or isinstance(result, bool):
+                    logger.warning("Archiving %s jobs failed: %s", len(job_ids), result)
+                    break
+                logger.info("Archived %s finished jobs", result)
+                if result < len(job_ids) or len(job_ids) < self.batch_size:
+                    break
@@ -1,74 +1,576 @@
+import sys
 import json
-from typing import Dict, Any
+import time
+from collections import OrderedDict
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from threading import Lock
-from app.models.printer import Printer, Filament
-from app.models.printjob import PrintJob
+from app.monitoring.metrics import fsm_apply_duration_seconds, fsm_lock_wait_seconds, fsm_lock_hold_seconds
+from app.raft.records import PrinterRecord, FilamentRecord, JobRecord, DedupRecord, UsageRecord, STATUS_CODES
+from app.raft.scheduler import PrinterQueues
+
+# Job states that still hold their filament weight
+ACTIVE_STATUSES = ("Queued", "Running")
+# Job states a job never leaves, and which archive_jobs moves out of the FSM
+TERMINAL_STATUSES = ("Done", "Cancelled")
+QUEUED = STATUS_CODES["Queued"]
+RUNNING = STATUS_CODES["Running"]
+DONE = STATUS_CODES["Done"]
+
+# Allowed status transitions, by status code
+VALID_TRANSITIONS = {
+    STATUS_CODES["Queued"]: (STATUS_CODES["Running"], STATUS_CODES["Cancelled"]),
+    STATUS_CODES["Running"]: (STATUS_CODES["Done"], STATUS_CODES["Cancelled"]),
+    STATUS_CODES["Done"]: (),
+    STATUS_CODES["Cancelled"]: (),
+}
+
+# Reasons submit_print_job refuses a job; the API answers these with a 400
+JOB_EXISTS = "Print job ID already exists"
+INVALID_PRINTER = "Invalid printer ID"
+INVALID_FILAMENT = "Invalid filament ID"
+INSUFFICIENT_WEIGHT = "Insufficient filament weight"
+ADMISSION_ERRORS = (JOB_EXISTS, INVALID_PRINTER, INVALID_FILAMENT, INSUFFICIENT_WEIGHT)
+# Reasons transition_print_job refuses a status change
+JOB_NOT_FOUND = "Print job not found"
+INVALID_TRANSITION = "Invalid status transition"
+PRINTER_BUSY = "Printer is already running a job"
+FILAMENT_IN_USE = "Filament is already running on another printer"
+# An Idempotency-Key seen before with a different request
+IDEMPOTENCY_MISMATCH = "Idempotency-Key was already used for a different request"
+
+# Bounds of the idempotency table. Eviction changes what later commands do,
+# so these are fixed here rather than configured per node.
+IDEMPOTENCY_TTL_MS = 24 * 3600 * 1000
+IDEMPOTENCY_MAX_KEYS = 100000
+
+
+# Insertion order of one entity dict with O(1) lookup of a key's position, so
+# list endpoints can resume after a cursor without walking the records before
+# it. discard() forgets a key; retire() leaves its position behind, so a
+# cursor naming a key that has since left the sequence still resumes in place.
+class KeySequence:
+    __slots__ = ("keys", "positions", "holes")
+
+    def __init__(self, keys=()):
+        self.keys: List[Optional[str]] = []
+        self.positions: Dict[str, int] = {}
+        # Slots of keys discarded or retired
+        self.holes = 0
+        for key in keys:
+            self.add(key)
+
+    def __len__(self) -> int:
+        return len(self.keys) - self.holes
+
+    def __iter__(self) -> Iterator[str]:
+        return _present(self.keys, 0)
+
+    def _holds(self, key: str, position: Optional[int]) -> bool:
+        # Retired keys keep a position that no longer holds them
+        return position is not None and 0 <= position < len(self.keys) and self.keys[position] == key
+
+    def add(self, key: str):
+        # A retired key comes back at the end
+        if not self._holds(key, self.positions.get(key)):
+            self.positions[key] = len(self.keys)
+            self.keys.append(key)
+
+    def discard(self, key: str):
+        position = self.positions.pop(key, None)
+        if self._holds(key, position):
+            self.keys[position] = None
+            self.holes += 1
+
+    def retire(self, key: str):
+        position = self.positions.get(key)
+        if self._holds(key, position):
+            self.keys[position] = None
+            self.holes += 1
+
+    def compacted(self) -> "KeySequence":
+        # A copy without the holes, for the owner to swap in so lock-free
+        # readers keep a consistent sequence. Keys retired since the last
+        # compaction still resume where they left; older ones are forgotten.
+        compact = KeySequence()
+        # Keys still present before each slot
+        before = []
+        for key in self.keys:
+            before.append(len(compact.keys))
+            if key is not None:
+                compact.positions[key] = len(compact.keys)
+                compact.keys.append(key)
+        before.append(len(compact.keys))
+        for key, position in self.positions.items():
+            if 0 <= position < len(self.keys) and self.keys[position] is None:
+                compact.positions[key] = before[position + 1] - 1
+        return compact
+
+    def start(self, after: Optional[str]) -> int:
+        # Raises KeyError for a cursor that names no known record
+        return self.positions[after] + 1 if after is not None else 0
+
+    def iter_from(self, start: int) -> Iterator[str]:
+        return _present(self.keys, start)
+
+
+def _present(keys: List[Optional[str]], start: int) -> Iterator[str]:
+    for position in range(start, len(keys)):
+        key = keys[position]
+        if key is not None:
+            yield key
+
+
+class TimedLock:
+    # Context manager around the FSM lock that records how long the caller
+    # waited for it and how long it held it. One instance per call site; the
+    # acquire time is only written and read while the lock is held, so an
+    # instance can be shared between threads.
+    __slots__ = ("lock", "wait", "hold", "acquired")
+
+    def __init__(self, lock: Lock, caller: str):
+        self.lock = lock
+        self.wait = fsm_lock_wait_seconds.labels(caller=caller)
+        self.hold = fsm_lock_hold_seconds.labels(caller=caller)
+        self.acquired = 0.0
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.acquired = time.perf_counter()
+        self.wait.observe(self.acquired - start)
+        return self
+
+    def __exit__(self, *exc):
+        held = time.perf_counter() - self.acquired
+        self.lock.release()
+        self.hold.observe(held)
+
+
+# Per-op apply histograms, bound once per op name
+_apply_timers: Dict[Any, Any] = {}
+
+
+def _apply_timer(op: Any):
+    timer = _apply_timers.get(op)
+    if timer is None:
+        timer = _apply_timers[op] = fsm_apply_duration_seconds.labels(op=str(op))
+    return timer
+
+
+def _estimate_bytes(records: Dict[str, Any], sample: int = 64) -> int:
+    # Dict table plus the average size of a few records and their strings,
+    # scaled to the whole dict. Interned strings (companies, colors, foreign
+    # keys) are shared and counted once per record anyway, so this errs high.
+    size = sys.getsizeof(records)
+    if not records:
+        return size
+    picked = list(islice(records.values(), sample))
+    per_record = sum(sys.getsizeof(r) + sum(sys.getsizeof(getattr(r, f)) for f in r.__slots__)
+                     for r in picked) / len(picked)
+    return size + int(per_record * len(records))
+
+
+def _records(records: Dict[str, Any], keys: Iterator[str]) -> Iterator[Any]:
+    for key in keys:
+        record = records.get(key)
+        if record is not None:
+            yield record
+
 
 class Raft3DFSM:
     def __init__(self):
-        self.printers: Dict[str, Printer] = {}
-        self.filaments: Dict[str, Filament] = {}
-        self.print_jobs: Dict[str, PrintJob] = {}
+        self.printers: Dict[str, PrinterRecord] = {}
+        self.filaments: Dict[str, FilamentRecord] = {}
+        self.print_jobs: Dict[str, JobRecord] = {}
+        # Secondary indexes, kept in step with print_jobs by _apply. Dicts with
+        # None values serve as insertion-ordered sets of job IDs; jobs of a
+        # status are kept in the order they entered it, so a filtered listing
+        # resumes after a cursor without sorting (see iter_print_jobs).
+        self.jobs_by_status: Dict[str, KeySequence] = {}
+        self.jobs_by_filament: Dict[str, Dict[str, None]] = {}
+        self.jobs_by_printer: Dict[str, Dict[str, None]] = {}
+        # Filament ledger: grams held by Queued and Running jobs and grams
+        # used by Done jobs, per filament. A job moves its weight from
+        # reserved to consumed when it finishes and releases it when cancelled.
+        self.reserved_grams: Dict[str, int] = {}
+        self.consumed_grams: Dict[str, int] = {}
+        # The part of consumed_grams used by Done jobs since archived
+        self.archived_grams: Dict[str, int] = {}
+        # Per-printer queues of Queued jobs and the running job on each
+        # printer, for the dispatch op
+        self.queues = PrinterQueues()
+        # Results of writes sent with an Idempotency-Key, oldest first. The
+        # clock is the newest proposer timestamp among them, so expiry
+        # depends only on the log and not on any node's own clock.
+        self.idempotency: "OrderedDict[str, DedupRecord]" = OrderedDict()
+        self.idempotency_clock = 0
+        self.printer_order = KeySequence()
+        self.filament_order = KeySequence()
+        self.job_order = KeySequence()
+        # Raft index and term of the last entry reflected in this state
+        self.applied_index = 0
+        self.applied_term = 0
         self.lock = Lock()
+        self.apply_lock = TimedLock(self.lock, "apply")
+        self.snapshot_lock = TimedLock(self.lock, "snapshot")
+        self.restore_lock = TimedLock(self.lock, "restore")
+        self.dispatch_lock = TimedLock(self.lock, "dispatch")
+        self.archive_lock = TimedLock(self.lock, "archive")
+        # Called under the lock with (entries, index, term) after every applied
+        # batch, and with entries None after a restore replaces the state
+        self.subscribers: List[Callable[[Optional[List[bytes]], int, int], None]] = []
+        # Once track_changes() is called, the mutations of the batch being
+        # applied, as (log index, kind, op, record); subscribers read them
+        # from their callback
+        self.changes: Optional[List[Tuple[int, str, str, Any]]] = None
+        # Log index of the entry being applied
+        self.change_index = 0
+        # Set by RaftNode: called under the lock with the log index and the
+        # records of every archive_jobs command, to queue them for this
+        # node's archive (app/raft/archive.py)
+        self.archive_sink: Optional[Callable[[int, List[JobRecord]], None]] = None
 
     def apply(self, log_entry: bytes) -> Any:
+        with self.apply_lock:
+            return self._apply(log_entry)
+
+    def apply_batch(self, log_entries: List[bytes], index: Optional[int] = None,
+                    term: Optional[int] = None) -> List[Any]:
+        # One lock acquisition for a whole committed batch
+        with self.apply_lock:
+            if self.changes is not None:
+                self.changes = []
+            # Entries are consecutive log entries ending at index
+            first = (index if index is not None else self.applied_index + len(log_entries)) - len(log_entries) + 1
+            results = []
+            for position, entry in enumerate(log_entries):
+                self.change_index = first + position
+                results.append(self._apply(entry))
+            if index is not None:
+                self.applied_index = index
+                self.applied_term = term
+            for callback in self.subscribers:
+                callback(log_entries, self.applied_index, self.applied_term)
+            return results
+
+    def subscribe(self, callback: Callable[[Optional[List[bytes]], int, int], None]) -> Dict[str, Any]:
+        # Registers callback and returns the state it starts from, taken
+        # under the same lock so no batch is missed or seen twice
+        with self.snapshot_lock:
+            self.subscribers.append(callback)
+            return self._state()
+
+    def track_changes(self):
+        # Starts recording mutations in self.changes; see app/raft/watch.py
         with self.lock:
-            try:
-                cmd = json.loads(log_entry.decode())
-                op = cmd.get("op")
-                value = cmd.get("value")
-
-                if op == "add_printer":
-                    printer = Printer(**value)
-                    self.printers[printer.id] = printer
-                    return True
-                elif op == "add_filament":
-                    filament = Filament(**value)
-                    self.filaments[filament.id] = filament
-                    return True
-                elif op == "add_print_job":
-                    job = PrintJob(**value)
-                    self.print_jobs[job.id] = job
-                    return True
-                elif op == "update_print_job_status":
-                    job_id = value.get("job_id")
-                    new_status = value.get("status")
-                    job = self.print_jobs.get(job_id)
-                    if not job:
-                        return False
-
-                    # Validate status transitions
-                    valid_transitions = {
-                        "Queued": ["Running", "Cancelled"],
-                        "Running": ["Done", "Cancelled"],
-                        "Done": [],
-                        "Cancelled": []
-                    }
-                    if new_status not in valid_transitions[job.status]:
-                        return False
-
-                    job.status = new_status
-                    if new_status == "Done":
-                        filament = self.filaments.get(job.filament_id)
-                        if filament:
-                            filament.remaining_weight_in_grams -= job.print_weight_in_grams
-                    return True
-                return False
-            except Exception as e:
-                return str(e)
-
-    def snapshot(self) -> bytes:
-        with self.lock:
-            state = {
-                "printers": {k: v.dict() for k, v in self.printers.items()},
-                "filaments": {k: v.dict() for k, v in self.filaments.items()},
-                "print_jobs": {k: v.dict() for k, v in self.print_jobs.items()}
-            }
-            return json.dumps(state).encode()
-
-    def restore(self, snapshot: bytes) -> None:
+            if self.changes is None:
+                self.changes = []
+
+    def _changed(self, kind: str, op: str, record: Any):
+        if self.changes is not None:
+            self.changes.append((self.change_index, kind, op, record))
+
+    def unsubscribe(self, callback: Callable[[Optional[List[bytes]], int, int], None]):
         with self.lock:
-            state = json.loads(snapshot.decode())
-            self.printers = {k: Printer(**v) for k, v in state.get("printers", {}).items()}
-            self.filaments = {k: Filament(**v) for k, v in state.get("filaments", {}).items()}
-            self.print_jobs = {k: PrintJob(**v) for k, v in state.get("print_jobs", {}).items()}
\ No newline at end of file
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def _apply(self, log_entry: bytes) -> Any:
+        if not log_entry:
+            # No-op entry from a leader election
+            return True
+        start = time.perf_counter()
+        try:
+            cmd = json.loads(log_entry.decode())
+        except Exception as e:
+            return str(e)
+        if isinstance(cmd, dict) and cmd.get("key") is not None:
+            result = self._apply_once(cmd)
+        else:
+            result = self._apply_command(cmd)
+        _apply_timer(cmd.get("op") if isinstance(cmd, dict) else None).observe(time.perf_counter() - start)
+        return result
+
+    def _apply_command(self, cmd: Dict[str, Any]) -> Any:
+        try:
+            op = cmd.get("op")
+            value = cmd.get("value")
+
+            if op == "batch":
+                # Several commands replicated as one log entry; each one
+                # succeeds or fails on its own
+                return [self._apply_command(sub) for sub in value]
+            elif op == "add_printer":
+                printer = PrinterRecord.from_value(value)
+                self.printers[printer.id] = printer
+                self.printer_order.add(printer.id)
+                self._changed("printer", op, printer)
+                return True
+            elif op == "add_filament":
+                filament = FilamentRecord.from_value(value)
+                self.filaments[filament.id] = filament
+                self.filament_order.add(filament.id)
+                self._changed("filament", op, filament)
+                return True
+            elif op == "add_print_job":
+                job = JobRecord.from_value(value)
+                old = self.print_jobs.get(job.id)
+                if old is not None:
+                    self._unindex_job(old)
+                self.print_jobs[job.id] = job
+                self.job_order.add(job.id)
+                self._index_job(job)
+                self._changed("print_job", op, job)
+                return True
+            elif op == "submit_print_job":
+                # Conditional add: the job is admitted against the state at
+                # its place in the log, so every replica reaches the same
+                # verdict and concurrent submissions cannot oversubscribe a
+                # filament between a check and the write
+                job = JobRecord.from_value(value)
+                if job.id in self.print_jobs:
+                    return JOB_EXISTS
+                if job.printer_id not in self.printers:
+                    return INVALID_PRINTER
+                filament = self.filaments.get(job.filament_id)
+                if filament is None:
+                    return INVALID_FILAMENT
+                available = filament.remaining_weight_in_grams - self.reserved_grams.get(job.filament_id, 0)
+                if job.print_weight_in_grams > available:
+                    return INSUFFICIENT_WEIGHT
+                if job.status_code != QUEUED:
+                    job = job.with_status(QUEUED)
+                self.print_jobs[job.id] = job
+                self.job_order.add(job.id)
+                self._index_job(job)
+                self._changed("print_job", op, job)
+                return True
+            elif op == "update_print_job_status":
+                job_id = value.get("job_id")
+                new_status = STATUS_CODES.get(value.get("status"))
+                job = self.print_jobs.get(job_id)
+                if not job:
+                    return False
+
+                # Validate status transitions
+                if new_status not in VALID_TRANSITIONS[job.status_code]:
+                    return False
+                self._transition(job, new_status, op)
+                return True
+            elif op == "transition_print_job":
+                # update_print_job_status that also keeps a printer to one
+                # running job and a spool to one printer, as dispatch does,
+                # and says why it refused a change
+                job = self.print_jobs.get(value.get("job_id"))
+                if job is None:
+                    return JOB_NOT_FOUND
+                new_status = STATUS_CODES.get(value.get("status"))
+                if new_status not in VALID_TRANSITIONS[job.status_code]:
+                    return INVALID_TRANSITION
+                if new_status == RUNNING and self.queues.busy(job.printer_id):
+                    return PRINTER_BUSY
+                if new_status == RUNNING and self.queues.in_use(job.filament_id):
+                    return FILAMENT_IN_USE
+                self._transition(job, new_status, op)
+                return True
+            elif op == "dispatch":
+                # Starts the next queued job on each named printer that is
+                # idle and whose job's filament is not loaded elsewhere;
+                # returns the [printer_id, job_id] pairs started
+                started = []
+                for printer_id in value["printers"]:
+                    job = self.queues.next_job(printer_id, self.print_jobs)
+                    if job is not None:
+                        self._transition(job, RUNNING, op)
+                        started.append([printer_id, job.id])
+                return started
+            elif op == "archive_jobs":
+                # Moves the named jobs out of the FSM if they have finished;
+                # the leader picks them (see app/raft/archive.py). Returns
+                # the number archived.
+                archived = []
+                for job_id in value["job_ids"]:
+                    job = self.print_jobs.get(job_id)
+                    if job is None or job.status not in TERMINAL_STATUSES:
+                        continue
+                    self._unindex_job(job)
+                    self.jobs_by_status[job.status].discard(job_id)
+                    if job.status_code == DONE:
+                        # The filament's ledger still counts the grams
+                        grams = job.print_weight_in_grams
+                        self.consumed_grams[job.filament_id] += grams
+                        self.archived_grams[job.filament_id] = self.archived_grams.get(job.filament_id, 0) + grams
+                    del self.print_jobs[job_id]
+                    self.job_order.discard(job_id)
+                    self._changed("print_job", op, job)
+                    archived.append(job)
+                if archived and self.archive_sink is not None:
+                    self.archive_sink(self.change_index, archived)
+                return len(archived)
+            return False
+        except Exception as e:
+            return str(e)
+
+    def _apply_once(self, cmd: Dict[str, Any]) -> Any:
+        # A command carrying an Idempotency-Key is applied the first time its
+        # key is seen; a retry gets the stored result back instead. Entries
+        # expire only when a new key is stored, so every replica evicts at
+        # the same point in the log.
+        key = cmd["key"]
+        entry = self.idempotency.get(key)
+        if entry is not None:
+            if entry.fingerprint != cmd.get("fp"):
+                return IDEMPOTENCY_MISMATCH
+            return json.loads(entry.result)
+        result = self._apply_command(cmd)
+        clock = max(self.idempotency_clock, int(cmd.get("ts", 0)))
+        self.idempotency_clock = clock
+        self.idempotency[key] = DedupRecord(key, cmd.get("fp", ""), json.dumps(result), clock)
+        table = self.idempotency
+        while len(table) > IDEMPOTENCY_MAX_KEYS or next(iter(table.values())).created_ms < clock - IDEMPOTENCY_TTL_MS:
+            table.popitem(last=False)
+        return result
+
+    def _transition(self, job: JobRecord, new_status: int, op: str):
+        # Records are replaced rather than mutated so a snapshot can keep
+        # reading the previous versions without holding the lock
+        updated = job.with_status(new_status)
+        self._unindex_job(job)
+        self.print_jobs[job.id] = updated
+        self._index_job(updated)
+        self._changed("print_job", op, updated)
+        if new_status == DONE:
+            filament = self.filaments.get(job.filament_id)
+            if filament:
+                filament = filament.with_remaining(
+                    filament.remaining_weight_in_grams - job.print_weight_in_grams
+                )
+                self.filaments[filament.id] = filament
+                self._changed("filament", op, filament)
+
+    def _index_job(self, job: JobRecord):
+        statuses = self.jobs_by_status.get(job.status)
+        if statuses is None:
+            statuses = self.jobs_by_status[job.status] = KeySequence()
+        statuses.add(job.id)
+        self.jobs_by_filament.setdefault(job.filament_id, {})[job.id] = None
+        self.jobs_by_printer.setdefault(job.printer_id, {})[job.id] = None
+        if job.status in ACTIVE_STATUSES:
+            self.reserved_grams[job.filament_id] = self.reserved_grams.get(job.filament_id, 0) + job.print_weight_in_grams
+            if job.status_code == QUEUED:
+                self.queues.add(job, self.job_order.positions[job.id])
+            else:
+                self.queues.start(job)
+        elif job.status_code == DONE:
+            self.consumed_grams[job.filament_id] = self.consumed_grams.get(job.filament_id, 0) + job.print_weight_in_grams
+
+    def _unindex_job(self, job: JobRecord):
+        # The job stays a valid cursor into the status it leaves
+        statuses = self.jobs_by_status.get(job.status)
+        if statuses is not None:
+            statuses.retire(job.id)
+            if statuses.holes > 2 * len(statuses) + 1024:
+                self.jobs_by_status[job.status] = statuses.compacted()
+        self.jobs_by_filament.get(job.filament_id, {}).pop(job.id, None)
+        self.jobs_by_printer.get(job.printer_id, {}).pop(job.id, None)
+        if job.status in ACTIVE_STATUSES:
+            self.reserved_grams[job.filament_id] -= job.print_weight_in_grams
+            if job.status_code == QUEUED:
+                self.queues.remove(job, self.print_jobs)
+            else:
+                self.queues.finish(job)
+        elif job.status_code == DONE:
+            self.consumed_grams[job.filament_id] -= job.print_weight_in_grams
+
+    def _rebuild_indexes(self):
+        self.jobs_by_status = {}
+        self.jobs_by_filament = {}
+        self.jobs_by_printer = {}
+        self.reserved_grams = {}
+        self.consumed_grams = dict(self.archived_grams)
+        self.queues = PrinterQueues()
+        for job in self.print_jobs.values():
+            self._index_job(job)
+
+    def _select(self, index: Dict[str, Any], key: str) -> Dict[str, JobRecord]:
+        # Read without the FSM lock, like every other read path; list() copies
+        # the ID set in one step so a concurrent apply cannot break iteration
+        jobs = self.print_jobs
+        return {job_id: jobs[job_id] for job_id in list(index.get(key, ())) if job_id in jobs}
+
+    def jobs_with_status(self, status: str) -> Dict[str, JobRecord]:
+        return self._select(self.jobs_by_status, status)
+
+    def jobs_for_filament(self, filament_id: str) -> Dict[str, JobRecord]:
+        return self._select(self.jobs_by_filament, filament_id)
+
+    def jobs_for_printer(self, printer_id: str) -> Dict[str, JobRecord]:
+        return self._select(self.jobs_by_printer, printer_id)
+
+    def iter_printers(self, after: Optional[str] = None) -> Iterator[PrinterRecord]:
+        return _records(self.printers, self.printer_order.iter_from(self.printer_order.start(after)))
+
+    def iter_filaments(self, after: Optional[str] = None) -> Iterator[FilamentRecord]:
+        return _records(self.filaments, self.filament_order.iter_from(self.filament_order.start(after)))
+
+    def iter_print_jobs(self, status: Optional[str] = None, after: Optional[str] = None) -> Iterator[JobRecord]:
+        # Jobs in submission order, resuming after the job named by `after`.
+        # With a status filter, jobs come in the order they entered that
+        # status and `after` may name a job that has since left it; a page
+        # then costs its own size rather than the size of the status.
+        if status is None:
+            return _records(self.print_jobs, self.job_order.iter_from(self.job_order.start(after)))
+        statuses = self.jobs_by_status.get(status)
+        if statuses is None:
+            statuses = KeySequence()
+        start = statuses.start(after)
+        return (job for job in _records(self.print_jobs, statuses.iter_from(start)) if job.status == status)
+
+    def stats(self) -> Dict[str, Tuple[int, int]]:
+        # Record count and estimated bytes per entity kind, read without the
+        # lock like the other read paths
+        return {kind: (len(records), _estimate_bytes(records))
+                for kind, records in (("printers", self.printers), ("filaments", self.filaments),
+                                      ("print_jobs", self.print_jobs), ("idempotency_keys", self.idempotency))}
+
+    def snapshot(self) -> Dict[str, Any]:
+        # Only shallow copies are taken under the lock; records are never
+        # mutated in place, so the caller can serialize them at leisure
+        with self.snapshot_lock:
+            return self._state()
+
+    def _state(self) -> Dict[str, Any]:
+        return {
+            "index": self.applied_index,
+            "term": self.applied_term,
+            "printers": list(self.printers.values()),
+            "filaments": list(self.filaments.values()),
+            "print_jobs": list(self.print_jobs.values()),
+            "idempotency": list(self.idempotency.values()),
+            "archived_grams": [UsageRecord(filament_id, grams) for filament_id, grams in self.archived_grams.items()],
+        }
+
+    def restore(self, state: Dict[str, Any]) -> None:
+        # Entities arrive as records from the snapshot decoder; nothing is
+        # validated again here
+        printers = {r.id: r for r in state.get("printers", [])}
+        filaments = {r.id: r for r in state.get("filaments", [])}
+        print_jobs = {r.id: r for r in state.get("print_jobs", [])}
+        idempotency = OrderedDict((r.key, r) for r in state.get("idempotency", []))
+        archived_grams = {r.filament_id: r.grams for r in state.get("archived_grams", [])}
+        with self.restore_lock:
+            self.applied_index = state.get("index", 0)
+            self.applied_term = state.get("term", 0)
+            self.printers = printers
+            self.filaments = filaments
+            self.print_jobs = print_jobs
+            self.idempotency = idempotency
+            self.idempotency_clock = max((r.created_ms for r in idempotency.values()), default=0)
+            self.archived_grams = archived_grams
+            self.printer_order = KeySequence(printers)
+            self.filament_order = KeySequence(filaments)
+            self.job_order = KeySequence(print_jobs)
+            self._rebuild_indexes()
+            for callback in self.subscribers:
+                callback(None, self.applied_index, self.applied_term)
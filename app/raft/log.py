@@ -0,0 +1,94 @@
+import os
+import json
+import logging
+from typing import Any, Dict, List, Optional
+from app.raft.wal import WriteAheadLog
+
+logger = logging.getLogger("raft3d")
+
+
+# Raft log backed by the segmented WAL in raft_dir/wal. Entries since the last
+# compaction are kept in memory as {"t": term, "c": command}; base_index and
+# base_term describe the entry just before the first one held. Term and vote
+# live in raft_state.json, replaced atomically.
+class RaftLog:
+    def __init__(self, raft_dir: str, segment_bytes: int = 16 * 1024 * 1024):
+        self.raft_dir = raft_dir
+        os.makedirs(raft_dir, exist_ok=True)
+        self.state_path = os.path.join(raft_dir, "raft_state.json")
+        self.term = 0
+        self.voted_for: Optional[str] = None
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+            self.term = state.get("term", 0)
+            self.voted_for = state.get("voted_for")
+        self.wal = WriteAheadLog(os.path.join(raft_dir, "wal"), segment_bytes)
+        self.base_index, self.base_term, self.entries, self.commit_index = self.wal.load()
+        logger.info("Loaded raft log with entries %s..%s, commit index %s", self.base_index + 1, self.last_index, self.commit_index)
+
+    def save_state(self, term: int, voted_for: Optional[str]):
+        self.term = term
+        self.voted_for = voted_for
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"term": term, "voted_for": voted_for}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    @property
+    def last_index(self) -> int:
+        return self.base_index + len(self.entries)
+
+    @property
+    def last_term(self) -> int:
+        return self.entries[-1]["t"] if self.entries else self.base_term
+
+    def term_at(self, index: int) -> int:
+        if index == self.base_index:
+            return self.base_term
+        if index < self.base_index or index > self.last_index:
+            return 0
+        return self.entries[index - self.base_index - 1]["t"]
+
+    def entry(self, index: int) -> Dict[str, Any]:
+        return self.entries[index - self.base_index - 1]
+
+    def slice(self, start: int, max_entries: int) -> List[Dict[str, Any]]:
+        offset = start - self.base_index - 1
+        return self.entries[offset:offset + max_entries]
+
+    def append(self, entries: List[Dict[str, Any]], commit_index: int = 0):
+        if not entries:
+            return
+        self.wal.append(entries, commit_index)
+        self.entries.extend(entries)
+
+    def truncate_from(self, index: int):
+        # Drop entries at index and after; only happens when a follower's log
+        # conflicts with a new leader's
+        if index > self.last_index:
+            return
+        self.wal.truncate_from(index, self.term_at(index - 1))
+        del self.entries[index - self.base_index - 1:]
+
+    def compact(self, index: int):
+        # Forget entries up to index (already covered by a snapshot), at the
+        # granularity of whole WAL segments
+        first = self.wal.remove_before(index)
+        if first - 1 > self.base_index:
+            self.base_term = self.term_at(first - 1)
+            del self.entries[:first - 1 - self.base_index]
+            self.base_index = first - 1
+            logger.info("Compacted raft log through index %s", self.base_index)
+
+    def reset(self, index: int, term: int):
+        self.wal.reset(index, term)
+        self.entries = []
+        self.base_index = index
+        self.base_term = term
+        self.commit_index = index
+
+    def close(self):
+        self.wal.close()
@@ -0,0 +1,1036 @@
+import os
+import zlib
+import base64
+import asyncio
+import random
+import threading
+import time
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from app.monitoring.metrics import (is_leader, log_append_duration_seconds, proposal_batch_size, elections_total,
+                                    leader_changes_total, time_to_elect_seconds, raft_term,
+                                    snapshot_send_duration_seconds)
+from app.raft.log import RaftLog
+from app.raft.transport import RaftTransport
+
+logger = logging.getLogger("raft3d")
+
+FOLLOWER = "follower"
+CANDIDATE = "candidate"
+LEADER = "leader"
+
+
+class Completion:
+    __slots__ = ("loop", "future")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, future: asyncio.Future):
+        self.loop = loop
+        self.future = future
+
+
+def _set_results(pairs: List[Tuple[asyncio.Future, Any]]):
+    for future, result in pairs:
+        if not future.done():
+            future.set_result(result)
+
+
+class Raft:
+    def __init__(self, node_id: str, addr: str, peers: List[str], fsm: Any, raft_dir: str,
+                 raft_port: int, bind_host: str = "0.0.0.0",
+                 election_timeout: Tuple[float, float] = (0.3, 0.6),
+                 heartbeat_interval: float = 0.05, max_batch: int = 512,
+                 batch_delay: float = 0.002, max_inflight: int = 8,
+                 apply_timeout: float = 5.0, compact_margin: int = 10000,
+                 max_batch_bytes: int = 1024 * 1024):
+        self.node_id = node_id
+        self.addr = addr
+        self.peers = [p for p in peers if p != addr]
+        self.fsm = fsm
+        self.raft_dir = raft_dir
+        self.raft_port = raft_port
+        self.bind_host = bind_host
+        self.election_timeout = election_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.max_batch = max_batch
+        self.batch_delay = batch_delay
+        self.max_inflight = max_inflight
+        self.apply_timeout = apply_timeout
+        self.compact_margin = compact_margin
+        self.max_batch_bytes = max_batch_bytes
+        self.apply_slice = 64
+        self.apply_slice_bytes = 256 * 1024
+        self.apply_budget = 0.02
+        self.apply_scheduled = False
+        # SnapshotManager of this node, set by RaftNode; without one a peer
+        # behind the compacted log cannot be caught up
+        self.snapshots: Optional[Any] = None
+        self.snapshot_chunk_bytes = 1024 * 1024
+        # JobArchive of this node, set by RaftNode; its blocks go to a peer
+        # ahead of a snapshot, which no longer holds their jobs
+        self.archive: Optional[Any] = None
+        # Set while a snapshot from the leader is being loaded into the FSM
+        self.installing = False
+        # Followers ignore vote requests for at least the minimum election
+        # timeout after hearing from a leader, so a leader backed by a quorum
+        # within that window cannot have been replaced; the margin covers
+        # clock rate drift between nodes
+        self.lease_duration = election_timeout[0] * 0.9
+
+        self.log = RaftLog(raft_dir)
+        self.term = self.log.term
+        raft_term.set(self.term)
+        self.voted_for = self.log.voted_for
+        self.role = FOLLOWER
+        self.is_leader = False
+        self.leader_addr: Optional[str] = None
+        self.commit_index = 0
+        self.last_applied = 0
+
+        # Leader-only replication state, reset on every election win
+        self.next_index: Dict[str, int] = {}
+        self.match_index: Dict[str, int] = {}
+        self.inflight: Dict[str, int] = {}
+        self.epoch: Dict[str, int] = {p: 0 for p in self.peers}
+        self.last_ack: Dict[str, float] = {}
+        # Send time of the newest AppendEntries each peer has answered in this term
+        self.lease_ack: Dict[str, float] = {}
+
+        # Follower freshness: when a leader last contacted us, and when our
+        # commit index last matched the one the leader reported
+        self.last_contact = 0.0
+        self.caught_up_at = 0.0
+        # Highest commit index the leader reported back for forwarded writes
+        self.forwarded_commit = 0
+
+        self.votes = set()
+        # Pre-vote round in progress: peers that would vote for us at term + 1
+        self.pre_votes = set()
+        # Peer we are handing leadership to; proposals and lease reads pause
+        self.transfer_target: Optional[str] = None
+        # Once TimeoutNow has gone out the target may win an election its
+        # voters grant despite our lease, so lease reads stay off until then
+        self.lease_blocked_until = 0.0
+        # Published by the raft loop for readers on other threads, replaced
+        # whole so one read sees a consistent pair: the monotonic time the
+        # lease holds until (0 without one) and the commit index a read
+        # under it must wait for
+        self.read_state: Tuple[float, int] = (0.0, 0)
+        # When this node last lost track of the leader, for time_to_elect_seconds
+        self.leaderless_since: Optional[float] = time.monotonic()
+        self.waiters: Dict[int, Any] = {}
+        self.forward_waiters: Dict[str, asyncio.Future] = {}
+        self.forward_seq = 0
+        # Leader: the pending reply to the snapshot chunk, and to the archive
+        # block sent ahead of it, for each peer
+        self.snapshot_acks: Dict[str, asyncio.Future] = {}
+        self.archive_acks: Dict[str, asyncio.Future] = {}
+        self.proposals: List[Tuple[str, Any]] = []
+        self.submitted: List[Tuple[str, Completion]] = []
+        self.submit_lock = threading.Lock()
+
+        self.running = False
+        self.thread = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.transport: Optional[RaftTransport] = None
+        self.tasks: List[asyncio.Task] = []
+        self.replicators: Dict[str, asyncio.Task] = {}
+        self._recover()
+
+    def _recover(self):
+        # The FSM may already hold a restored snapshot; replay the committed
+        # WAL tail on top of it so the node serves current state right away
+        self.last_applied = self.fsm.applied_index
+        if self.log.base_index > self.last_applied or self.log.last_index < self.last_applied or \
+                self.log.term_at(self.last_applied) != self.fsm.applied_term:
+            logger.info("Raft log does not continue snapshot index %s; starting a fresh log", self.last_applied)
+            self.log.reset(self.last_applied, self.fsm.applied_term)
+        elif self.log.base_index < self.last_applied:
+            self.log.compact(self.last_applied)
+        self.commit_index = max(self.log.commit_index, self.last_applied)
+        replay = self.commit_index - self.last_applied
+        self._apply_committed()
+        if replay:
+            logger.info("Replayed %s committed log entries on node %s up to index %s", replay, self.node_id, self.commit_index)
+
+    def compact(self, index: int):
+        # Called by the snapshot manager once a snapshot through index is on
+        # disk; a trailing margin is kept so slightly lagging followers can
+        # still be caught up from the log
+        if self.loop is None or not self.running:
+            return
+        self.loop.call_soon_threadsafe(self._compact, index)
+
+    def _compact(self, index: int):
+        upto = min(index, self.last_applied) - self.compact_margin
+        if upto > self.log.base_index:
+            self.log.compact(upto)
+
+    @property
+    def quorum(self) -> int:
+        return (len(self.peers) + 1) // 2 + 1
+
+    def start(self):
+        self.running = True
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,))
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+        logger.info("Raft node %s started on %s with peers %s", self.node_id, self.addr, self.peers)
+
+    def _run(self, ready: threading.Event):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self._start())
+        finally:
+            ready.set()
+        self.loop.run_forever()
+
+    async def _start(self):
+        self.heartbeat = asyncio.Event()
+        self.leader_known = asyncio.Event()
+        self.proposal_event = asyncio.Event()
+        self.batch_full = asyncio.Event()
+        self.replicate_events = {p: asyncio.Event() for p in self.peers}
+        self.transport = RaftTransport(self.bind_host, self.raft_port, self.peers, self._handle)
+        await self.transport.start()
+        self.tasks = [
+            asyncio.ensure_future(self._election_loop()),
+            asyncio.ensure_future(self._proposer()),
+        ]
+
+    def stop(self):
+        if not self.running:
+            return
+        if self.is_leader and self.peers:
+            # Planned shutdown: hand leadership to a caught-up peer so the
+            # cluster does not wait out an election timeout
+            try:
+                asyncio.run_coroutine_threadsafe(self.transfer_leadership(), self.loop).result(timeout=5)
+            except Exception as e:
+                logger.error("Leadership transfer on stop failed: %s", e)
+        self.running = False
+        try:
+            asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result(timeout=5)
+        except Exception as e:
+            logger.error("Raft node %s stop error: %s", self.node_id, e)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.thread:
+            self.thread.join()
+        self.log.close()
+        is_leader.labels(node_id=self.node_id).set(0)
+        logger.info("Raft node %s stopped", self.node_id)
+
+    async def _stop(self):
+        tasks = self.tasks + list(self.replicators.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._fail_pending()
+        await self.transport.stop()
+
+    # ---- public API -------------------------------------------------------
+
+    def apply(self, log_entry: bytes) -> bool:
+        future = asyncio.run_coroutine_threadsafe(self.propose([log_entry.decode()]), self.loop)
+        try:
+            result = future.result(timeout=self.apply_timeout)[0]
+        except Exception as e:
+            future.cancel()
+            logger.error("Raft apply failed on node %s: %s", self.node_id, e)
+            return False
+        logger.debug("Applied log entry to FSM for node %s, result: %s", self.node_id, result)
+        return isinstance(result, bool) and result
+
+    async def apply_async(self, log_entry: bytes) -> Any:
+        # Called from another event loop (uvicorn's). Submissions are queued and
+        # the raft loop is woken once per batch rather than once per request
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.submit_lock:
+            self.submitted.append((log_entry.decode(), Completion(loop, future)))
+            wake = len(self.submitted) == 1
+        if wake:
+            self.loop.call_soon_threadsafe(self._take_submitted)
+        try:
+            return await asyncio.wait_for(future, self.apply_timeout)
+        except asyncio.TimeoutError:
+            logger.error("Raft apply timed out on node %s", self.node_id)
+            return False
+
+    async def propose(self, commands: List[str]) -> List[Any]:
+        futures = [self.loop.create_future() for _ in commands]
+        self._queue(list(zip(commands, futures)))
+        try:
+            return await asyncio.wait_for(asyncio.gather(*futures), self.apply_timeout)
+        except asyncio.TimeoutError:
+            return [False] * len(commands)
+
+    def _take_submitted(self):
+        with self.submit_lock:
+            batch, self.submitted = self.submitted, []
+        self._queue(batch)
+
+    def _queue(self, batch: List[Tuple[str, Any]]):
+        self.proposals.extend(batch)
+        self.proposal_event.set()
+        if len(self.proposals) >= self.max_batch:
+            self.batch_full.set()
+
+    def _resolve(self, items: List[Tuple[Any, Any]]):
+        # Futures owned by other event loops are completed with one
+        # call_soon_threadsafe per loop for the whole batch
+        remote: Dict[asyncio.AbstractEventLoop, List[Tuple[asyncio.Future, Any]]] = {}
+        for waiter, result in items:
+            if isinstance(waiter, Completion):
+                remote.setdefault(waiter.loop, []).append((waiter.future, result))
+            elif not waiter.done():
+                waiter.set_result(result)
+        for loop, pairs in remote.items():
+            try:
+                loop.call_soon_threadsafe(_set_results, pairs)
+            except RuntimeError:
+                pass
+
+    # ---- read freshness ---------------------------------------------------
+
+    def _publish_read_state(self):
+        # Called on the raft loop whenever the lease or the commit index may
+        # have moved. The lease holds while a quorum acknowledged this leader
+        # within lease_duration and an entry from its own term has committed.
+        if self.role != LEADER or self.transfer_target is not None or \
+                self.log.term_at(self.commit_index) != self.term or time.monotonic() < self.lease_blocked_until:
+            lease_until = 0.0
+        elif not self.peers:
+            lease_until = float("inf")
+        else:
+            acks = sorted((self.lease_ack.get(p, 0.0) for p in self.peers), reverse=True)
+            lease_until = acks[self.quorum - 2] + self.lease_duration
+        self.read_state = (lease_until, self.commit_index)
+
+    def lease_valid(self) -> bool:
+        # True while this leader may serve reads once it has applied through
+        # the read index published with the lease. Safe from any thread.
+        return time.monotonic() < self.read_state[0]
+
+    def staleness(self) -> float:
+        # Upper bound on how far local state may trail the leader, in
+        # seconds. Safe from any thread.
+        lease_until, read_index = self.read_state
+        if time.monotonic() < lease_until and self.last_applied >= read_index:
+            return 0.0
+        if self.role != FOLLOWER or not self.caught_up_at:
+            return float("inf")
+        return time.monotonic() - self.caught_up_at
+
+    def _leader_recent(self) -> bool:
+        if self.role == LEADER:
+            return self.lease_valid()
+        return self.leader_addr is not None and time.monotonic() - self.last_contact < self.election_timeout[0]
+
+    # ---- elections --------------------------------------------------------
+
+    async def _election_loop(self):
+        while self.running:
+            self.heartbeat.clear()
+            timeout = random.uniform(*self.election_timeout)
+            try:
+                await asyncio.wait_for(self.heartbeat.wait(), timeout)
+            except asyncio.TimeoutError:
+                # After a long stall of this process (a big apply, a GC pause)
+                # the timer can fire before heartbeats already sitting in the
+                # socket are read; give them one loop pass first
+                await asyncio.sleep(0)
+                if self.role != LEADER and not self.installing and time.monotonic() - self.last_contact >= timeout:
+                    if self.leaderless_since is None:
+                        self.leaderless_since = self.last_contact
+                    self._start_pre_vote()
+
+    def _start_pre_vote(self):
+        # Pre-vote (Raft thesis 9.6): ask whether peers would vote for us at
+        # term + 1 without changing any term. Only a node that could win goes
+        # on to a real election, so a node cut off or stalled for a while
+        # cannot come back with a higher term and depose a healthy leader.
+        # A candidate whose election failed (a split vote, lost requests)
+        # campaigns again as a follower.
+        if self.role == CANDIDATE:
+            self.role = FOLLOWER
+        self.pre_votes = {self.addr}
+        elections_total.labels(kind="pre_vote").inc()
+        if len(self.pre_votes) >= self.quorum:
+            self._start_election()
+            return
+        msg = {
+            "type": "pre_vote",
+            "term": self.term + 1,
+            "from": self.addr,
+            "last_log_index": self.log.last_index,
+            "last_log_term": self.log.last_term,
+        }
+        for peer in self.peers:
+            asyncio.ensure_future(self.transport.send(peer, msg))
+
+    def _start_election(self, transfer: bool = False):
+        self.pre_votes = set()
+        self.role = CANDIDATE
+        self._set_leader(None)
+        self._persist_state(self.term + 1, self.addr)
+        self.votes = {self.addr}
+        elections_total.labels(kind="transfer" if transfer else "election").inc()
+        logger.info("Node %s starting election for term %s", self.node_id, self.term)
+        if len(self.votes) >= self.quorum:
+            self._become_leader()
+            return
+        msg = {
+            "type": "request_vote",
+            "term": self.term,
+            "from": self.addr,
+            "last_log_index": self.log.last_index,
+            "last_log_term": self.log.last_term,
+            # Set when the leader asked us to take over; voters then skip
+            # their leader stickiness check
+            "transfer": transfer,
+        }
+        for peer in self.peers:
+            asyncio.ensure_future(self.transport.send(peer, msg))
+
+    def _become_leader(self):
+        self.role = LEADER
+        self._set_leader(self.addr)
+        now = time.monotonic()
+        for peer in self.peers:
+            self.next_index[peer] = self.log.last_index + 1
+            self.match_index[peer] = 0
+            self.inflight[peer] = 0
+            self.epoch[peer] += 1
+            self.last_ack[peer] = now
+            self.lease_ack[peer] = 0.0
+        # A no-op in the new term lets entries from earlier terms commit
+        self.log.append([{"t": self.term, "c": None}])
+        for peer in self.peers:
+            self.replicators[peer] = asyncio.ensure_future(self._replicate(peer, self.term))
+        logger.info("Node %s elected leader for term %s", self.node_id, self.term)
+        self._publish_read_state()
+        self._advance_commit()
+
+    def _step_down(self, term: int):
+        if term > self.term:
+            self._persist_state(term, None)
+            self._set_leader(None)
+            self.pre_votes = set()
+        if self.role == LEADER:
+            logger.info("Node %s stepping down as leader in term %s", self.node_id, self.term)
+            for task in self.replicators.values():
+                task.cancel()
+            self.replicators = {}
+            self.leaderless_since = time.monotonic()
+            self._fail_pending()
+        self.role = FOLLOWER
+        self._publish_read_state()
+
+    def _set_leader(self, addr: Optional[str]):
+        if addr is not None and addr != self.leader_addr:
+            leader_changes_total.inc()
+            if self.leaderless_since is not None:
+                time_to_elect_seconds.observe(time.monotonic() - self.leaderless_since)
+                self.leaderless_since = None
+        self.leader_addr = addr
+        leading = addr is not None and addr == self.addr
+        if leading != self.is_leader:
+            self.is_leader = leading
+            is_leader.labels(node_id=self.node_id).set(1 if leading else 0)
+        if addr is None:
+            self.leader_known.clear()
+        else:
+            self.leader_known.set()
+
+    def _persist_state(self, term: int, voted_for: Optional[str]):
+        if term != self.term:
+            raft_term.set(term)
+        self.term = term
+        self.voted_for = voted_for
+        self.log.save_state(term, voted_for)
+
+    def _fail_pending(self):
+        # Appended entries may or may not commit under the next leader, so
+        # their waiters fail. Proposals not yet in the log are kept; the
+        # proposer forwards them once a new leader is known. They are only
+        # failed when the node is shutting down.
+        pending = [(waiter, False) for waiter in self.waiters.values()]
+        self.waiters = {}
+        if not self.running:
+            pending += [(waiter, False) for _, waiter in self.proposals]
+            self.proposals = []
+        elif self.proposals:
+            self.proposal_event.set()
+        self._resolve(pending)
+
+    # ---- message handling -------------------------------------------------
+
+    def _handle(self, msg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if msg.get("type") == "pre_vote":
+            # Carries the term the sender would campaign at, not its own, so
+            # it must not move our term
+            return self._on_pre_vote(msg)
+        if msg.get("type") == "request_vote" and not msg.get("transfer") and self._leader_recent():
+            # Leader stickiness: keep our term and deny the vote while the
+            # current leader is alive, which is what makes leases safe
+            return {"type": "request_vote_resp", "term": self.term, "from": self.addr, "granted": False}
+        if msg.get("term", 0) > self.term:
+            self._step_down(msg["term"])
+        handler = getattr(self, "_on_" + msg.get("type", ""), None)
+        if handler is None:
+            logger.error("Node %s received unknown raft message %s", self.node_id, msg.get('type'))
+            return None
+        return handler(msg)
+
+    def _on_pre_vote(self, msg: Dict[str, Any]) -> Dict[str, Any]:
+        up_to_date = (msg["last_log_term"], msg["last_log_index"]) >= (self.log.last_term, self.log.last_index)
+        granted = msg["term"] > self.term and up_to_date and not self._leader_recent()
+        return {"type": "pre_vote_resp", "term": self.term, "from": self.addr, "granted": granted}
+
+    def _on_pre_vote_resp(self, msg: Dict[str, Any]):
+        # A reply with a higher term has already moved us to it in _handle,
+        # which ends the round
+        if not self.pre_votes or self.role != FOLLOWER or not msg["granted"]:
+            return None
+        self.pre_votes.add(msg["from"])
+        if len(self.pre_votes) >= self.quorum:
+            self._start_election()
+        return None
+
+    def _on_timeout_now(self, msg: Dict[str, Any]):
+        # The leader has brought us up to date and wants us to take over
+        if msg["term"] == self.term and self.role == FOLLOWER:
+            logger.info("Node %s taking over leadership from %s", self.node_id, msg["from"])
+            self._start_election(transfer=True)
+        return None
+
+    def _on_request_vote(self, msg: Dict[str, Any]) -> Dict[str, Any]:
+        granted = False
+        up_to_date = (msg["last_log_term"], msg["last_log_index"]) >= (self.log.last_term, self.log.last_index)
+        if msg["term"] == self.term and self.voted_for in (None, msg["from"]) and up_to_date:
+            self._persist_state(self.term, msg["from"])
+            self.heartbeat.set()
+            granted = True
+        return {"type": "request_vote_resp", "term": self.term, "from": self.addr, "granted": granted}
+
+    def _on_request_vote_resp(self, msg: Dict[str, Any]):
+        if self.role != CANDIDATE or msg["term"] != self.term or not msg["granted"]:
+            return None
+        self.votes.add(msg["from"])
+        if len(self.votes) >= self.quorum:
+            self._become_leader()
+        return None
+
+    def _follow(self, msg: Dict[str, Any]):
+        # A message from the leader of our current term
+        if self.role != FOLLOWER:
+            self._step_down(msg["term"])
+        if self.leader_addr != msg["from"]:
+            self._set_leader(msg["from"])
+        self.pre_votes = set()
+        self.heartbeat.set()
+        self.last_contact = time.monotonic()
+
+    def _on_append_entries(self, msg: Dict[str, Any]) -> Dict[str, Any]:
+        reply = {"type": "append_entries_resp", "term": self.term, "from": self.addr,
+                 "epoch": msg["epoch"], "sent": msg.get("sent", 0.0), "success": False,
+                 "match_index": 0, "hint": 0}
+        if msg["term"] < self.term:
+            return reply
+        self._follow(msg)
+        if self.installing:
+            # The log is replaced once the snapshot is loaded
+            reply["hint"] = self.log.last_index + 1
+            return reply
+
+        prev = msg["prev_log_index"]
+        entries = msg["entries"]
+        if prev < self.log.base_index:
+            # Everything up to base_index is committed and compacted here, so it
+            # matches the leader by definition
+            entries = entries[self.log.base_index - prev:]
+            prev = self.log.base_index
+            msg["prev_log_term"] = self.log.base_term
+        if prev > self.log.last_index:
+            reply["hint"] = self.log.last_index + 1
+            return reply
+        if self.log.term_at(prev) != msg["prev_log_term"]:
+            # Skip back over the whole conflicting term in one round trip
+            conflict_term = self.log.term_at(prev)
+            hint = prev
+            while hint > 1 and self.log.term_at(hint - 1) == conflict_term:
+                hint -= 1
+            reply["hint"] = hint
+            return reply
+
+        match = prev + len(entries)
+        commit = min(msg["leader_commit"], match)
+        for i, entry in enumerate(entries):
+            index = prev + 1 + i
+            if index <= self.log.last_index:
+                if self.log.term_at(index) == entry["t"]:
+                    continue
+                self.log.truncate_from(index)
+            self.log.append(entries[i:], commit)
+            break
+
+        if commit > self.commit_index:
+            self.commit_index = commit
+            self._apply_committed()
+        if self.last_applied >= msg["leader_commit"]:
+            self.caught_up_at = self.last_contact
+        reply["success"] = True
+        reply["match_index"] = match
+        return reply
+
+    def _on_append_entries_resp(self, msg: Dict[str, Any]):
+        peer = msg["from"]
+        if self.role != LEADER or msg["term"] != self.term or peer not in self.match_index:
+            return None
+        self.last_ack[peer] = time.monotonic()
+        self.lease_ack[peer] = max(self.lease_ack.get(peer, 0.0), msg.get("sent", 0.0))
+        self._publish_read_state()
+        current = msg["epoch"] == self.epoch[peer]
+        if msg["success"]:
+            if current:
+                self.inflight[peer] = max(0, self.inflight[peer] - 1)
+            if msg["match_index"] > self.match_index[peer]:
+                self.match_index[peer] = msg["match_index"]
+                self._advance_commit()
+        elif current:
+            self._reset_peer(peer, max(1, msg["hint"]))
+        self.replicate_events[peer].set()
+        return None
+
+    def _on_install_snapshot(self, msg: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        reply = {"type": "install_snapshot_resp", "term": self.term, "from": self.addr,
+                 "sent": msg.get("sent", 0.0), "offset": 0, "match_index": 0}
+        if msg["term"] < self.term:
+            return reply
+        self._follow(msg)
+        index = msg["last_index"]
+        if self.last_applied >= index:
+            # Already loaded, or caught up some other way
+            reply["match_index"] = index
+            return reply
+        if self.installing or self.snapshots is None:
+            return None
+        data = base64.b64decode(msg["data"])
+        if zlib.crc32(data) != msg["crc"]:
+            # Damaged on the way; the reply asks for the same offset again
+            data = b""
+        reply["offset"] = self.snapshots.receive_chunk(index, msg["last_term"], msg["offset"], data)
+        # Jobs archived up to the snapshot are not in it; the leader sends
+        # the archive blocks we lack before we load it
+        reply["archive_index"] = self._archive_held(msg.get("archive_index", 0))
+        if reply["offset"] < msg["size"] or reply["archive_index"] < msg.get("archive_index", 0):
+            return reply
+        asyncio.ensure_future(self._install_snapshot(msg, reply))
+        return None
+
+    async def _install_snapshot(self, msg: Dict[str, Any], reply: Dict[str, Any]):
+        # Decoding a large snapshot takes a while, so it runs off the raft
+        # loop; the loop keeps answering the leader, refusing entries until
+        # the log is reset to the snapshot
+        index, term = msg["last_index"], msg["last_term"]
+        self.installing = True
+        try:
+            installed = await self.loop.run_in_executor(None, self.snapshots.install, index, term)
+        finally:
+            self.installing = False
+            self.last_contact = time.monotonic()
+        if installed:
+            if index < self.log.last_index and self.log.term_at(index) == term:
+                # Our log continues the snapshot; keep the entries after it
+                if self.log.base_index < index:
+                    self.log.compact(index)
+            else:
+                self.log.reset(index, term)
+                self.commit_index = index
+            self.last_applied = index
+            self.commit_index = max(self.commit_index, index)
+            self._apply_committed()
+            reply["match_index"] = index
+            logger.info("Node %s installed snapshot at index %s from %s", self.node_id, index, msg["from"])
+        reply["offset"] = 0
+        await self.transport.send(msg["from"], reply)
+
+    def _on_install_archive(self, msg: Dict[str, Any]) -> Dict[str, Any]:
+        # An archive block the leader sends ahead of its snapshot
+        reply = {"type": "install_archive_resp", "term": self.term, "from": self.addr,
+                 "sent": msg.get("sent", 0.0), "archive_index": 0}
+        if msg["term"] < self.term:
+            return reply
+        self._follow(msg)
+        if self.archive is not None:
+            try:
+                self.archive.receive_block(msg["index"], base64.b64decode(msg["data"]), msg["count"],
+                                           base64.b64decode(msg["bloom"]))
+            except ValueError as e:
+                # The reply asks for the same block again
+                logger.warning("Node %s dropped an archive block from %s: %s", self.node_id, msg["from"], e)
+        reply["archive_index"] = self._archive_held(msg["index"])
+        return reply
+
+    def _archive_held(self, wanted: int) -> int:
+        # Newest archive block this node has written or queued; a node
+        # without an archive has nothing to catch up on
+        return self.archive.queued_index if self.archive is not None else wanted
+
+    def _on_install_archive_resp(self, msg: Dict[str, Any]):
+        return self._on_install_snapshot_resp(msg, self.archive_acks)
+
+    def _on_install_snapshot_resp(self, msg: Dict[str, Any], acks: Optional[Dict[str, asyncio.Future]] = None):
+        peer = msg["from"]
+        if self.role != LEADER or msg["term"] != self.term or peer not in self.match_index:
+            return None
+        self.last_ack[peer] = time.monotonic()
+        self.lease_ack[peer] = max(self.lease_ack.get(peer, 0.0), msg.get("sent", 0.0))
+        self._publish_read_state()
+        future = (self.snapshot_acks if acks is None else acks).get(peer)
+        if future is not None and not future.done():
+            future.set_result(msg)
+        return None
+
+    def _on_forward(self, msg: Dict[str, Any]):
+        asyncio.ensure_future(self._serve_forward(msg))
+        return None
+
+    def _on_forward_resp(self, msg: Dict[str, Any]):
+        self.forwarded_commit = max(self.forwarded_commit, msg.get("commit_index", 0))
+        future = self.forward_waiters.pop(msg["req_id"], None)
+        if future is not None and not future.done():
+            future.set_result(msg["results"])
+        return None
+
+    # ---- replication ------------------------------------------------------
+
+    def _reset_peer(self, peer: str, next_index: int):
+        # Anything still in flight was sent from a stale next_index; bump the
+        # epoch so its replies stop counting against the window
+        self.next_index[peer] = min(next_index, self.log.last_index + 1)
+        self.inflight[peer] = 0
+        self.epoch[peer] += 1
+
+    async def _replicate(self, peer: str, term: int):
+        event = self.replicate_events[peer]
+        last_sent = 0.0
+        while self.running and self.role == LEADER and self.term == term:
+            now = time.monotonic()
+            next_index = self.next_index[peer]
+            has_entries = next_index <= self.log.last_index and self.inflight[peer] < self.max_inflight
+            if not has_entries and now - last_sent < self.heartbeat_interval:
+                event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), self.heartbeat_interval - (now - last_sent))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if self.inflight[peer] and now - self.last_ack[peer] > self.election_timeout[1]:
+                # Replies were lost (e.g. the connection dropped); resend from the last match
+                self._reset_peer(peer, self.match_index[peer] + 1)
+                continue
+
+            if next_index <= self.log.base_index:
+                # The entries this peer needs are compacted away; it gets the
+                # newest snapshot and carries on from the snapshot's index
+                await self._send_snapshot(peer, term)
+                continue
+
+            entries = self._bounded(self.log.slice(next_index, self.max_batch), self.max_batch_bytes) if has_entries else []
+            msg = {
+                "type": "append_entries",
+                "term": term,
+                "from": self.addr,
+                "epoch": self.epoch[peer],
+                "prev_log_index": next_index - 1,
+                "prev_log_term": self.log.term_at(next_index - 1),
+                "entries": entries,
+                "leader_commit": self.commit_index,
+                "sent": now,
+            }
+            if entries:
+                self.next_index[peer] = next_index + len(entries)
+                self.inflight[peer] += 1
+            last_sent = now
+            if not await self.transport.send(peer, msg):
+                if self.role == LEADER and self.term == term:
+                    self._reset_peer(peer, self.match_index[peer] + 1)
+                await asyncio.sleep(self.heartbeat_interval)
+
+    async def _send_snapshot(self, peer: str, term: int):
+        # InstallSnapshot (Raft paper section 7), streamed in chunks of
+        # snapshot_chunk_bytes. Each chunk carries its offset and CRC32 and
+        # the follower answers with the bytes it holds, so a lost or damaged
+        # chunk, a dropped connection or a restart resumes from there. The
+        # reply to the last chunk comes once the follower has loaded it; a
+        # follower holding fewer archive blocks than the snapshot covers says
+        # so in its replies and is sent them first.
+        latest = self.snapshots.latest() if self.snapshots is not None else None
+        if latest is None or latest[1] < self.log.base_index:
+            logger.error("Peer %s needs entries before %s, which are compacted, and no snapshot covers them",
+                         peer, self.log.base_index + 1)
+            self._reset_peer(peer, self.log.base_index + 1)
+            await asyncio.sleep(self.election_timeout[1])
+            return
+        path, index, snapshot_term = latest
+        archived = self.archive.blocks_between(0, index) if self.archive is not None else []
+        archive_index = archived[-1].index if archived else 0
+        logger.info("Sending snapshot at index %s to peer %s", index, peer)
+        start = time.monotonic()
+        offset = 0
+        # The open file stays readable if the snapshot manager prunes it meanwhile
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            while self.running and self.role == LEADER and self.term == term:
+                f.seek(offset)
+                data = f.read(self.snapshot_chunk_bytes)
+                msg = {
+                    "type": "install_snapshot",
+                    "term": term,
+                    "from": self.addr,
+                    "last_index": index,
+                    "last_term": snapshot_term,
+                    "offset": offset,
+                    "size": size,
+                    "data": base64.b64encode(data).decode(),
+                    "crc": zlib.crc32(data),
+                    "archive_index": archive_index,
+                    "sent": time.monotonic(),
+                }
+                future = self.loop.create_future()
+                self.snapshot_acks[peer] = future
+                try:
+                    if not await self.transport.send(peer, msg):
+                        await asyncio.sleep(self.heartbeat_interval)
+                        continue
+                    try:
+                        ack = await asyncio.wait_for(future, self.election_timeout[1])
+                    except asyncio.TimeoutError:
+                        continue
+                finally:
+                    self.snapshot_acks.pop(peer, None)
+                if ack["match_index"] >= index:
+                    self.match_index[peer] = max(self.match_index[peer], ack["match_index"])
+                    self._reset_peer(peer, self.match_index[peer] + 1)
+                    snapshot_send_duration_seconds.observe(time.monotonic() - start)
+                    logger.info("Peer %s loaded snapshot at index %s (%s bytes)", peer, index, size)
+                    self._advance_commit()
+                    return
+                offset = min(ack["offset"], size)
+                if ack.get("archive_index", archive_index) < archive_index:
+                    if not await self._send_archive(peer, term, ack["archive_index"], index):
+                        return
+
+    async def _send_archive(self, peer: str, term: int, held: int, index: int) -> bool:
+        # The archive blocks after held up to the snapshot's index, one per
+        # message, each acknowledged with the newest block the peer then
+        # holds. Returns False if leadership was lost on the way or a block
+        # cannot be read.
+        logger.info("Sending archive blocks after index %s to peer %s", held, peer)
+        while self.running and self.role == LEADER and self.term == term:
+            blocks = self.archive.blocks_between(held, index)
+            if not blocks:
+                return True
+            block = blocks[0]
+            try:
+                data = self.archive.read_raw(block)
+            except (OSError, ValueError) as e:
+                logger.error("Cannot send archive block at index %s to peer %s: %s", block.index, peer, e)
+                return False
+            msg = {
+                "type": "install_archive",
+                "term": term,
+                "from": self.addr,
+                "index": block.index,
+                "count": block.count,
+                "data": base64.b64encode(data).decode(),
+                "bloom": base64.b64encode(block.bloom).decode(),
+                "sent": time.monotonic(),
+            }
+            future = self.loop.create_future()
+            self.archive_acks[peer] = future
+            try:
+                if not await self.transport.send(peer, msg):
+                    await asyncio.sleep(self.heartbeat_interval)
+                    continue
+                try:
+                    ack = await asyncio.wait_for(future, self.election_timeout[1])
+                except asyncio.TimeoutError:
+                    continue
+            finally:
+                self.archive_acks.pop(peer, None)
+            held = max(held, ack["archive_index"])
+        return False
+
+    @staticmethod
+    def _bounded(entries: List[Dict[str, Any]], max_bytes: int) -> List[Dict[str, Any]]:
+        # Trim a run of entries to max_bytes of commands, keeping at least one;
+        # bulk writes make for large entries
+        size = 0
+        for i, entry in enumerate(entries):
+            size += len(entry["c"] or "")
+            if size > max_bytes and i:
+                return entries[:i]
+        return entries
+
+    def _advance_commit(self):
+        matches = sorted([self.log.last_index] + [self.match_index[p] for p in self.peers], reverse=True)
+        candidate = matches[self.quorum - 1]
+        if candidate > self.commit_index and self.log.term_at(candidate) == self.term:
+            self.commit_index = candidate
+            # Published before any waiter is resolved, so a read that
+            # starts after a write returns waits for that write
+            self._publish_read_state()
+            self._apply_committed()
+            # Push the new commit index out without waiting for the next heartbeat
+            for event in self.replicate_events.values():
+                event.set()
+
+    def _apply_committed(self):
+        # Applies in slices of at most apply_slice entries and apply_slice_bytes
+        # of commands, and hands the loop back once
+        # apply_budget has passed, so a run of large bulk entries cannot hold
+        # off heartbeats long enough to trigger an election
+        self.apply_scheduled = False
+        deadline = time.monotonic() + self.apply_budget
+        while self.last_applied < self.commit_index and not self.installing:
+            if self.running and time.monotonic() >= deadline:
+                if not self.apply_scheduled:
+                    self.apply_scheduled = True
+                    self.loop.call_soon(self._apply_committed)
+                return
+            first = self.last_applied + 1
+            entries = self._bounded(self.log.slice(first, min(self.apply_slice, self.commit_index - self.last_applied)),
+                                    self.apply_slice_bytes)
+            last = first + len(entries) - 1
+            # No-op entries from leader elections reach the FSM empty, so
+            # entry i of the batch is always log index first + i
+            results = self.fsm.apply_batch([e["c"].encode() if e["c"] is not None else b"" for e in entries],
+                                           last, self.log.term_at(last))
+            self.last_applied = last
+            done = []
+            for index in range(first, last + 1):
+                waiter = self.waiters.pop(index, None)
+                if waiter is not None:
+                    done.append((waiter, results[index - first]))
+            self._resolve(done)
+
+    async def _proposer(self):
+        while self.running:
+            await self.proposal_event.wait()
+            self.proposal_event.clear()
+            if not self.proposals or (self.role == LEADER and self.transfer_target is not None):
+                # During a leadership transfer proposals wait; they are
+                # forwarded to the new leader once it takes over
+                continue
+            if len(self.proposals) < self.max_batch and self.batch_delay > 0:
+                # Linger briefly so concurrent requests share one log append and fsync
+                self.batch_full.clear()
+                try:
+                    await asyncio.wait_for(self.batch_full.wait(), self.batch_delay)
+                except asyncio.TimeoutError:
+                    pass
+                if self.role == LEADER and self.transfer_target is not None:
+                    # A transfer began while we lingered; entries appended
+                    # now could miss the target and fail on step-down
+                    continue
+            batch, self.proposals = self.proposals[:self.max_batch], self.proposals[self.max_batch:]
+            if self.proposals:
+                self.proposal_event.set()
+            if self.role != LEADER:
+                asyncio.ensure_future(self._forward_batch(batch))
+                continue
+            first = self.log.last_index + 1
+            start = time.perf_counter()
+            self.log.append([{"t": self.term, "c": command} for command, _ in batch], self.commit_index)
+            log_append_duration_seconds.observe(time.perf_counter() - start)
+            proposal_batch_size.observe(len(batch))
+            for i, (_, waiter) in enumerate(batch):
+                self.waiters[first + i] = waiter
+            self._advance_commit()
+            for event in self.replicate_events.values():
+                event.set()
+
+    # ---- leadership transfer ----------------------------------------------
+
+    async def transfer_leadership(self, target: Optional[str] = None, timeout: Optional[float] = None) -> bool:
+        # Raft thesis 3.10: stop taking proposals, bring the target's log up
+        # to ours, then tell it to start an election at once. Runs on the raft
+        # loop; returns True once this node is no longer the leader.
+        if self.role != LEADER or not self.peers:
+            return False
+        if target is None:
+            target = max(self.peers, key=lambda peer: self.match_index.get(peer, 0))
+        if target not in self.peers:
+            return False
+        deadline = time.monotonic() + (timeout if timeout is not None else self.election_timeout[1] * 2)
+        term = self.term
+        self.transfer_target = target
+        self._publish_read_state()
+        timeout_now_sent = False
+        logger.info("Node %s transferring leadership to %s", self.node_id, target)
+        try:
+            while self.match_index.get(target, 0) < self.log.last_index:
+                if self.role != LEADER or self.term != term or time.monotonic() >= deadline:
+                    return False
+                self.replicate_events[target].set()
+                await asyncio.sleep(self.heartbeat_interval / 5)
+            timeout_now_sent = True
+            await self.transport.send(target, {"type": "timeout_now", "term": term, "from": self.addr})
+            while self.role == LEADER and self.term == term and time.monotonic() < deadline:
+                await asyncio.sleep(self.heartbeat_interval / 5)
+            return self.role != LEADER
+        finally:
+            if timeout_now_sent:
+                # Voters that heard from us within the lease may still elect
+                # the target, so a lease already held does not survive it
+                self.lease_blocked_until = time.monotonic() + self.lease_duration
+            self.transfer_target = None
+            self._publish_read_state()
+            self.proposal_event.set()
+
+    # ---- follower forwarding ----------------------------------------------
+
+    async def _forward_batch(self, batch: List[Tuple[str, Any]]):
+        results = await self._forward([command for command, _ in batch])
+        self._resolve([(waiter, result) for (_, waiter), result in zip(batch, results)])
+
+    async def _forward(self, commands: List[str]) -> List[Any]:
+        failed = [False] * len(commands)
+        try:
+            await asyncio.wait_for(self.leader_known.wait(), self.apply_timeout)
+        except asyncio.TimeoutError:
+            logger.error("Node %s has no leader to forward to", self.node_id)
+            return failed
+        if self.role == LEADER:
+            return await self.propose(commands)
+        self.forward_seq += 1
+        req_id = f"{self.addr}/{self.forward_seq}"
+        future = self.loop.create_future()
+        self.forward_waiters[req_id] = future
+        sent = await self.transport.send(self.leader_addr, {
+            "type": "forward", "from": self.addr, "req_id": req_id, "commands": commands
+        })
+        try:
+            if not sent:
+                return failed
+            return await asyncio.wait_for(future, self.apply_timeout)
+        except asyncio.TimeoutError:
+            return failed
+        finally:
+            self.forward_waiters.pop(req_id, None)
+
+    async def _serve_forward(self, msg: Dict[str, Any]):
+        if self.role == LEADER:
+            results = await self.propose(msg["commands"])
+        else:
+            results = [False] * len(msg["commands"])
+        await self.transport.send(msg["from"], {
+            "type": "forward_resp", "from": self.addr, "req_id": msg["req_id"], "results": results,
+            "commit_index": self.commit_index
+        })
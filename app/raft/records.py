@@ -0,0 +1,130 @@
+import sys
+from typing import Any, Dict
+
+# Compact in-memory records for FSM state. Pydantic models are only used at the
+# API boundary; commands reaching the FSM were validated there, so records are
+# built with plain key lookups. Records are never mutated once stored: updates
+# build a new record, which lets snapshots read the old ones without the lock.
+
+JOB_STATUSES = ("Queued", "Running", "Done", "Cancelled")
+STATUS_CODES = {status: code for code, status in enumerate(JOB_STATUSES)}
+
+_intern = sys.intern
+
+
+class PrinterRecord:
+    __slots__ = ("id", "company", "model")
+    # Field order used by the snapshot format and the positional constructor
+    FIELDS = ("id", "company", "model")
+
+    def __init__(self, id: str, company: str, model: str):
+        self.id = id
+        self.company = _intern(company)
+        self.model = _intern(model)
+
+    @classmethod
+    def from_value(cls, value: Dict[str, Any]) -> "PrinterRecord":
+        return cls(value["id"], value["company"], value["model"])
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"id": self.id, "company": self.company, "model": self.model}
+
+
+class FilamentRecord:
+    __slots__ = ("id", "type", "color", "total_weight_in_grams", "remaining_weight_in_grams")
+    FIELDS = __slots__
+
+    def __init__(self, id: str, type: str, color: str, total_weight_in_grams: int,
+                 remaining_weight_in_grams: int):
+        self.id = _intern(id)
+        self.type = _intern(type)
+        self.color = _intern(color)
+        self.total_weight_in_grams = total_weight_in_grams
+        self.remaining_weight_in_grams = remaining_weight_in_grams
+
+    @classmethod
+    def from_value(cls, value: Dict[str, Any]) -> "FilamentRecord":
+        return cls(value["id"], value["type"], value["color"], int(value["total_weight_in_grams"]),
+                   int(value["remaining_weight_in_grams"]))
+
+    def with_remaining(self, remaining: int) -> "FilamentRecord":
+        return FilamentRecord(self.id, self.type, self.color, self.total_weight_in_grams, remaining)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"id": self.id, "type": self.type, "color": self.color,
+                "total_weight_in_grams": self.total_weight_in_grams,
+                "remaining_weight_in_grams": self.remaining_weight_in_grams}
+
+
+class JobRecord:
+    __slots__ = ("id", "printer_id", "filament_id", "filepath", "print_weight_in_grams", "status_code", "priority")
+    FIELDS = __slots__
+
+    def __init__(self, id: str, printer_id: str, filament_id: str, filepath: str,
+                 print_weight_in_grams: int, status_code: int, priority: int = 0):
+        self.id = id
+        # Printer and filament IDs repeat across many jobs; share one copy
+        self.printer_id = _intern(printer_id)
+        self.filament_id = _intern(filament_id)
+        self.filepath = filepath
+        self.print_weight_in_grams = print_weight_in_grams
+        self.status_code = status_code
+        # Higher runs first on its printer; see Raft3DFSM's dispatch op
+        self.priority = priority
+
+    @property
+    def status(self) -> str:
+        return JOB_STATUSES[self.status_code]
+
+    @classmethod
+    def from_value(cls, value: Dict[str, Any]) -> "JobRecord":
+        return cls(value["id"], value["printer_id"], value["filament_id"], value["filepath"],
+                   int(value["print_weight_in_grams"]), STATUS_CODES[value["status"]], int(value.get("priority", 0)))
+
+    def with_status(self, status_code: int) -> "JobRecord":
+        return JobRecord(self.id, self.printer_id, self.filament_id, self.filepath,
+                         self.print_weight_in_grams, status_code, self.priority)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"id": self.id, "printer_id": self.printer_id, "filament_id": self.filament_id,
+                "filepath": self.filepath, "print_weight_in_grams": self.print_weight_in_grams,
+                "status": JOB_STATUSES[self.status_code], "priority": self.priority}
+
+
+class UsageRecord:
+    # Grams used by one filament's Done jobs that have since been archived;
+    # the ledger keeps counting them after the jobs leave the FSM
+    __slots__ = ("filament_id", "grams")
+    FIELDS = __slots__
+
+    def __init__(self, filament_id: str, grams: int):
+        self.filament_id = filament_id
+        self.grams = grams
+
+    @classmethod
+    def from_value(cls, value: Dict[str, Any]) -> "UsageRecord":
+        return cls(value["filament_id"], int(value["grams"]))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"filament_id": self.filament_id, "grams": self.grams}
+
+
+class DedupRecord:
+    # Outcome of a write sent with an Idempotency-Key: a fingerprint of the
+    # request, the FSM result as JSON and the dedup clock when it was applied
+    __slots__ = ("key", "fingerprint", "result", "created_ms")
+    FIELDS = __slots__
+
+    def __init__(self, key: str, fingerprint: str, result: str, created_ms: int):
+        self.key = key
+        self.fingerprint = fingerprint
+        self.result = result
+        self.created_ms = created_ms
+
+    @classmethod
+    def from_value(cls, value: Dict[str, Any]) -> "DedupRecord":
+        return cls(value["key"], value["fingerprint"], value["result"], int(value["created_ms"]))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"key": self.key, "fingerprint": self.fingerprint, "result": self.result,
+                "created_ms": self.created_ms}
@@ -0,0 +1,405 @@
+import io
+import os
+import json
+import time
+import struct
+import asyncio
+import threading
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from app.monitoring.metrics import apply_duration_seconds, owner_metrics, watch_fsm
+from app.raft.fsm import Raft3DFSM
+from app.raft.archive import JobArchive
+from app.raft.snapshot import encode_snapshot, restore_snapshot
+from app.raft.store import FSMView, RaftNode, make_command, pack_batch_entries, expand_batch_results
+
+logger = logging.getLogger("raft3d")
+
+# Multi-worker serving. The process that owns the RaftNode runs a
+# ReplicaServer on a Unix socket; each HTTP worker process holds a
+# ReplicaNode, a read-only copy of the FSM built from a snapshot and then kept
+# current by every batch the owner applies. Reads are served from the worker's
+# copy, so they scale with worker processes; writes and read barriers are
+# sent to the owner, which stays the only process proposing to Raft.
+#
+# Frames are a 4-byte length, a 1-byte kind and the payload. JSON frames carry
+# requests, replies and status; SNAPSHOT frames carry the binary snapshot
+# stream, ended by SNAPSHOT_END; APPLY frames carry one applied batch.
+FRAME = struct.Struct(">IB")
+APPLY_HEADER = struct.Struct(">QQI")
+ENTRY_LEN = struct.Struct(">I")
+
+JSON = 1
+SNAPSHOT = 2
+SNAPSHOT_END = 3
+APPLY = 4
+
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+
+def _frame(kind: int, payload: bytes) -> bytes:
+    return FRAME.pack(len(payload), kind) + payload
+
+
+def _json_frame(msg: Dict[str, Any]) -> bytes:
+    return _frame(JSON, json.dumps(msg, separators=(",", ":")).encode())
+
+
+def _apply_frame(entries: List[bytes], index: int, term: int) -> bytes:
+    parts = [APPLY_HEADER.pack(index, term, len(entries))]
+    for entry in entries:
+        parts.append(ENTRY_LEN.pack(len(entry)))
+        parts.append(entry)
+    return _frame(APPLY, b"".join(parts))
+
+
+def _decode_apply(payload: bytes) -> Tuple[List[bytes], int, int]:
+    index, term, count = APPLY_HEADER.unpack_from(payload)
+    offset = APPLY_HEADER.size
+    entries = []
+    for _ in range(count):
+        (length,) = ENTRY_LEN.unpack_from(payload, offset)
+        offset += ENTRY_LEN.size
+        entries.append(payload[offset:offset + length])
+        offset += length
+    return entries, index, term
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+    length, kind = FRAME.unpack(await reader.readexactly(FRAME.size))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Replica frame too large: {length} bytes")
+    return kind, await reader.readexactly(length)
+
+
+class _WorkerConnection:
+    # Apply frames published while the snapshot is still being written are
+    # held back and sent right after it, up to max_buffer bytes of them
+    def __init__(self, writer: asyncio.StreamWriter, max_buffer: int):
+        self.writer = writer
+        self.max_buffer = max_buffer
+        self.ready = False
+        self.held: List[bytes] = []
+        self.held_bytes = 0
+
+    def send(self, frame: bytes):
+        if self.writer.is_closing():
+            return
+        if not self.ready:
+            self.held.append(frame)
+            self.held_bytes += len(frame)
+            if self.held_bytes > self.max_buffer:
+                self._drop("Replica worker snapshot outlasted its buffer; dropping its connection")
+            return
+        self.writer.write(frame)
+        if self.writer.transport.get_write_buffer_size() > self.max_buffer:
+            self._drop("Replica worker fell behind; dropping its connection")
+
+    def _drop(self, reason: str):
+        # A worker this far behind is cut off; it reconnects and starts
+        # again from a fresh snapshot
+        logger.warning(reason)
+        self.held = []
+        self.held_bytes = 0
+        self.writer.close()
+
+    def publish(self, entries: List[bytes], index: int, term: int):
+        self.send(_apply_frame(entries, index, term))
+
+    def release(self):
+        self.ready = True
+        for frame in self.held:
+            self.writer.write(frame)
+        self.held = []
+        self.held_bytes = 0
+
+
+class ReplicaServer:
+    def __init__(self, node: RaftNode, path: str, max_buffer: int = 64 * 1024 * 1024,
+                 status_interval: float = 0.1):
+        self.node = node
+        self.path = path
+        self.max_buffer = max_buffer
+        self.status_interval = status_interval
+        self.connections: List[_WorkerConnection] = []
+        self.status: Dict[str, Any] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self):
+        ready = threading.Event()
+        thread = threading.Thread(target=self._run, args=(ready,), daemon=True)
+        thread.start()
+        ready.wait()
+        logger.info("Replica server listening on %s", self.path)
+
+    def _run(self, ready: threading.Event):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.loop.run_until_complete(asyncio.start_unix_server(self._serve, self.path))
+        self.loop.create_task(self._watch_status())
+        ready.set()
+        self.loop.run_forever()
+
+    def _current_status(self) -> Dict[str, Any]:
+        return {"type": "status", "leader": self.node.leader(), "is_leader": self.node.raft.is_leader}
+
+    async def _watch_status(self):
+        while True:
+            status = self._current_status()
+            if status != self.status:
+                self.status = status
+                for conn in self.connections:
+                    conn.send(_json_frame(status))
+            await asyncio.sleep(self.status_interval)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        conn = _WorkerConnection(writer, self.max_buffer)
+        loop = self.loop
+
+        def on_apply(entries: Optional[List[bytes]], index: int, term: int):
+            # Runs on the Raft thread under the FSM lock; encoding and writing
+            # happen on this server's loop. A restore replaced the whole state,
+            # so the worker is disconnected to resync from a new snapshot.
+            if entries is None:
+                loop.call_soon_threadsafe(writer.close)
+            else:
+                loop.call_soon_threadsafe(conn.publish, entries, index, term)
+
+        state = self.node.fsm.subscribe(on_apply)
+        self.connections.append(conn)
+        try:
+            for chunk in encode_snapshot(state):
+                if writer.is_closing():
+                    # Dropped by conn.send while the snapshot was streaming
+                    return
+                writer.write(_frame(SNAPSHOT, chunk))
+                await writer.drain()
+            del state
+            writer.write(_frame(SNAPSHOT_END, b""))
+            writer.write(_json_frame(self._current_status()))
+            conn.release()
+            while True:
+                kind, payload = await _read_frame(reader)
+                if kind == JSON:
+                    asyncio.ensure_future(self._request(conn, json.loads(payload)))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        except Exception as e:
+            logger.error("Error serving replica worker: %s", e)
+        finally:
+            self.node.fsm.unsubscribe(on_apply)
+            self.connections.remove(conn)
+            writer.close()
+
+    async def _request(self, conn: _WorkerConnection, msg: Dict[str, Any]):
+        node = self.node
+        method = msg.get("method")
+        try:
+            if method == "propose":
+                results = await asyncio.gather(*[node.raft.apply_async(c.encode()) for c in msg["commands"]])
+                reply = {"results": results, "index": node.write_index()}
+            elif method == "linearizable":
+                ok = await node.wait_linearizable(msg.get("timeout", 1.0))
+                reply = {"ok": ok, "index": node.fsm.applied_index}
+            elif method == "bounded":
+                ok = await node.wait_bounded(msg.get("min_index"), msg.get("max_staleness"), msg.get("timeout", 1.0))
+                reply = {"ok": ok, "index": node.fsm.applied_index}
+            elif method == "transfer":
+                reply = {"ok": await node.transfer_leadership(msg.get("target"))}
+            elif method == "metrics":
+                reply = {"text": owner_metrics().decode()}
+            else:
+                reply = {"error": f"Unknown method {method}"}
+        except Exception as e:
+            reply = {"error": str(e)}
+        reply["id"] = msg.get("id")
+        conn.send(_json_frame(reply))
+
+
+class ReplicaNode(FSMView):
+    # Stands in for RaftNode inside an HTTP worker process
+    def __init__(self, path: str, node_id: Optional[str] = None, timeout: float = 5.0,
+                 batch_entry_ops: int = 2000):
+        self.path = path
+        self.node_id = node_id
+        self.timeout = timeout
+        self.batch_entry_ops = batch_entry_ops
+        self.fsm = Raft3DFSM()
+        watch_fsm(self.fsm)
+        # The owner's archive, next to the socket in RAFT_DIR, read-only
+        self.archive = JobArchive(os.path.join(os.path.dirname(path), "archive"), writable=False)
+        self.leader_addr: Optional[str] = None
+        self.is_leader = False
+        self.last_write_index = 0
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.seq = 0
+        self.calls: Dict[int, asyncio.Future] = {}
+        self.index_waiters: List[Tuple[int, asyncio.Future]] = []
+        self.synced: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # Returns once the first snapshot from the owner is loaded
+        self.synced = asyncio.Event()
+        self.task = asyncio.ensure_future(self._run())
+        await self.synced.wait()
+        logger.info("Replica synced from %s at index %s", self.path, self.fsm.applied_index)
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    async def _run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=2 ** 20)
+            except OSError:
+                await asyncio.sleep(0.1)
+                continue
+            self.writer = writer
+            try:
+                await self._follow(reader)
+            except (asyncio.IncompleteReadError, ConnectionError, OSError):
+                logger.warning("Lost connection to the owner process; resyncing")
+            except Exception as e:
+                logger.error("Replica stream failed: %s", e)
+            finally:
+                self.writer = None
+                writer.close()
+                for future in self.calls.values():
+                    if not future.done():
+                        future.set_result(None)
+                self.calls = {}
+            await asyncio.sleep(0.1)
+
+    async def _follow(self, reader: asyncio.StreamReader):
+        snapshot = io.BytesIO()
+        while True:
+            kind, payload = await _read_frame(reader)
+            if kind == APPLY:
+                entries, index, term = _decode_apply(payload)
+                # Batches already covered by the snapshot are skipped
+                if index > self.fsm.applied_index:
+                    self.fsm.apply_batch(entries, index, term)
+                    self._wake_index_waiters()
+            elif kind == JSON:
+                msg = json.loads(payload)
+                if msg.get("type") == "status":
+                    self.leader_addr = msg["leader"]
+                    self.is_leader = msg["is_leader"]
+                else:
+                    future = self.calls.pop(msg.get("id"), None)
+                    if future is not None and not future.done():
+                        future.set_result(msg)
+            elif kind == SNAPSHOT:
+                snapshot.write(payload)
+            elif kind == SNAPSHOT_END:
+                snapshot.seek(0)
+                restore_snapshot(self.fsm, snapshot)
+                snapshot = io.BytesIO()
+                self._wake_index_waiters()
+                self.synced.set()
+
+    def _wake_index_waiters(self):
+        applied = self.fsm.applied_index
+        waiting = []
+        for index, future in self.index_waiters:
+            if index <= applied:
+                if not future.done():
+                    future.set_result(True)
+            else:
+                waiting.append((index, future))
+        self.index_waiters = waiting
+
+    async def _wait_applied(self, index: int, timeout: float) -> bool:
+        if self.fsm.applied_index >= index:
+            return True
+        future = asyncio.get_running_loop().create_future()
+        self.index_waiters.append((index, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    async def _call(self, msg: Dict[str, Any], timeout: float) -> Optional[Dict[str, Any]]:
+        # Returns None if the owner is unreachable or does not answer in time
+        if self.writer is None:
+            return None
+        self.seq += 1
+        msg["id"] = self.seq
+        future = asyncio.get_running_loop().create_future()
+        self.calls[self.seq] = future
+        try:
+            self.writer.write(_json_frame(msg))
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            return None
+        finally:
+            self.calls.pop(msg["id"], None)
+
+    async def _propose(self, commands: List[str]) -> List[Any]:
+        # Results come back once the owner has applied the commands; the
+        # reply is held until this worker's copy has them too, so a client
+        # reads its own write from whichever worker serves the next request
+        deadline = time.monotonic() + self.timeout
+        reply = await self._call({"method": "propose", "commands": commands}, self.timeout)
+        if reply is None or "results" not in reply:
+            return [False] * len(commands)
+        self.last_write_index = max(self.last_write_index, reply["index"])
+        await self._wait_applied(reply["index"], max(0.0, deadline - time.monotonic()))
+        return reply["results"]
+
+    async def apply_async(self, op: str, value: dict) -> bool:
+        result = await self.command_async(op, value)
+        return isinstance(result, bool) and result
+
+    async def command_async(self, op: str, value: dict, idempotency: Optional[Tuple[str, str]] = None) -> Any:
+        start = time.perf_counter()
+        result = (await self._propose([json.dumps(make_command(op, value, idempotency))]))[0]
+        apply_duration_seconds.labels(op=op).observe(time.perf_counter() - start)
+        return result
+
+    async def apply_batch_async(self, commands: List[Tuple[str, dict]]) -> List[Any]:
+        chunks, entries = pack_batch_entries(commands, self.batch_entry_ops)
+        start = time.perf_counter()
+        outcomes = await self._propose([entry.decode() for entry in entries])
+        apply_duration_seconds.labels(op="batch").observe(time.perf_counter() - start)
+        return expand_batch_results(chunks, outcomes)
+
+    def write_index(self) -> int:
+        return max(self.fsm.applied_index, self.last_write_index)
+
+    def leader(self) -> Optional[str]:
+        return self.leader_addr
+
+    async def _barrier(self, msg: Dict[str, Any], timeout: float) -> bool:
+        # The owner waits out the barrier, then this copy catches up to the
+        # index the owner had applied at that point
+        deadline = time.monotonic() + timeout
+        msg["timeout"] = timeout
+        reply = await self._call(msg, timeout + 0.5)
+        if reply is None or not reply.get("ok"):
+            return False
+        return await self._wait_applied(reply["index"], max(0.0, deadline - time.monotonic()))
+
+    async def wait_linearizable(self, timeout: float = 1.0) -> bool:
+        return await self._barrier({"method": "linearizable"}, timeout)
+
+    async def wait_bounded(self, min_index: Optional[int] = None, max_staleness: Optional[float] = None,
+                           timeout: float = 1.0) -> bool:
+        if max_staleness is None:
+            return min_index is None or await self._wait_applied(min_index, timeout)
+        return await self._barrier({"method": "bounded", "min_index": min_index,
+                                    "max_staleness": max_staleness}, timeout)
+
+    async def transfer_leadership(self, target: Optional[str] = None) -> bool:
+        reply = await self._call({"method": "transfer", "target": target}, self.timeout)
+        return bool(reply and reply.get("ok"))
+
+    async def owner_metrics(self) -> bytes:
+        reply = await self._call({"method": "metrics"}, self.timeout)
+        return reply["text"].encode() if reply and "text" in reply else b""
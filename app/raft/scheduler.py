@@ -0,0 +1,188 @@
+import json
+import heapq
+import asyncio
+import logging
+import threading
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
+from app.raft.records import JobRecord, STATUS_CODES
+
+logger = logging.getLogger("raft3d")
+
+QUEUED = STATUS_CODES["Queued"]
+
+
+def _queued_on(job: Optional[JobRecord], printer_id: str) -> bool:
+    return job is not None and job.status_code == QUEUED and job.printer_id == printer_id
+
+
+class PrinterQueues:
+    # Scheduling state kept by Raft3DFSM alongside its other job indexes.
+    # Each printer has a heap of its Queued jobs, highest priority first and
+    # oldest first within a priority; entries for jobs that left Queued some
+    # other way are dropped lazily when they reach the top. A printer runs one
+    # job at a time and a filament spool is loaded in one printer at a time.
+    #
+    # `ready` lists idle printers with queued work, for the leader to name in
+    # dispatch commands. It and `blocked` only steer which printers are
+    # proposed: next_job decides from the heaps and running jobs, which every
+    # replica has in the same state, so a restored replica that rebuilt them
+    # differently still reaches the same decisions.
+    def __init__(self):
+        self.heaps: Dict[str, List[Tuple[int, int, str]]] = {}
+        # Live Queued jobs per printer; the rest of its heap is stale entries
+        self.queued: Dict[str, int] = {}
+        self.running: Dict[str, str] = {}
+        self.filament_in_use: Dict[str, int] = {}
+        self.ready: Dict[str, None] = {}
+        # Idle printers whose next job waits for a filament in use elsewhere
+        self.blocked: Dict[str, Dict[str, None]] = {}
+        self.blocked_on: Dict[str, str] = {}
+
+    def add(self, job: JobRecord, position: int):
+        # job entered Queued; position is its submission order
+        printer_id = job.printer_id
+        heapq.heappush(self.heaps.setdefault(printer_id, []), (-job.priority, position, job.id))
+        self.queued[printer_id] = self.queued.get(printer_id, 0) + 1
+        if printer_id not in self.running:
+            # A new head of the queue may not need the filament it waited for
+            self._unblock(printer_id)
+            self.ready[printer_id] = None
+
+    def remove(self, job: JobRecord, jobs: Dict[str, JobRecord]):
+        # job left Queued (jobs still holds its Queued record). Its heap entry
+        # stays until it surfaces, unless stale entries come to outnumber
+        # live ones, as after a run of cancellations
+        printer_id = job.printer_id
+        count = self.queued[printer_id] - 1
+        self.queued[printer_id] = count
+        heap = self.heaps[printer_id]
+        if len(heap) > 2 * count + 64:
+            live = [entry for entry in heap if entry[2] != job.id and _queued_on(jobs.get(entry[2]), printer_id)]
+            heapq.heapify(live)
+            self.heaps[printer_id] = live
+
+    def start(self, job: JobRecord):
+        printer_id = job.printer_id
+        self.running[printer_id] = job.id
+        self.filament_in_use[job.filament_id] = self.filament_in_use.get(job.filament_id, 0) + 1
+        self.ready.pop(printer_id, None)
+        self._unblock(printer_id)
+
+    def finish(self, job: JobRecord):
+        # job left Running
+        printer_id = job.printer_id
+        if self.running.get(printer_id) == job.id:
+            del self.running[printer_id]
+        in_use = self.filament_in_use[job.filament_id] - 1
+        if in_use:
+            self.filament_in_use[job.filament_id] = in_use
+        else:
+            del self.filament_in_use[job.filament_id]
+            for waiting in self.blocked.pop(job.filament_id, ()):
+                del self.blocked_on[waiting]
+                if waiting not in self.running:
+                    self.ready[waiting] = None
+        if self.queued.get(printer_id) and printer_id not in self.running and printer_id not in self.blocked_on:
+            self.ready[printer_id] = None
+
+    def busy(self, printer_id: str) -> bool:
+        return printer_id in self.running
+
+    def in_use(self, filament_id: str) -> bool:
+        # The spool is loaded in a printer that is running a job from it
+        return filament_id in self.filament_in_use
+
+    def next_job(self, printer_id: str, jobs: Dict[str, JobRecord]) -> Optional[JobRecord]:
+        # Pops and returns the job printer_id should run now, or None when it
+        # is busy, has nothing queued or its next job's filament is in use
+        if printer_id in self.running:
+            self.ready.pop(printer_id, None)
+            return None
+        heap = self.heaps.get(printer_id)
+        while heap:
+            job = jobs.get(heap[0][2])
+            if _queued_on(job, printer_id):
+                break
+            heapq.heappop(heap)
+        else:
+            self.ready.pop(printer_id, None)
+            return None
+        if job.filament_id in self.filament_in_use:
+            self.ready.pop(printer_id, None)
+            self.blocked.setdefault(job.filament_id, {})[printer_id] = None
+            self.blocked_on[printer_id] = job.filament_id
+            return None
+        heapq.heappop(heap)
+        return job
+
+    def _unblock(self, printer_id: str):
+        filament_id = self.blocked_on.pop(printer_id, None)
+        if filament_id is not None:
+            waiting = self.blocked[filament_id]
+            del waiting[printer_id]
+            if not waiting:
+                del self.blocked[filament_id]
+
+    def take_ready(self, limit: int) -> List[str]:
+        return list(islice(self.ready, limit))
+
+
+class Dispatcher:
+    # Runs on every node and acts only while it leads: whenever the FSM
+    # reports idle printers with queued work, it proposes a dispatch command
+    # naming up to batch_size of them. Which job each one starts is decided
+    # when the command is applied, so the leader needs no lock of its own and
+    # a printer named twice, or already busy by then, is simply skipped.
+    def __init__(self, node, batch_size: int = 1000, interval: float = 1.0):
+        self.node = node
+        self.batch_size = batch_size
+        self.interval = interval
+        self.wake = threading.Event()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.node.fsm.subscribe(self._on_apply)
+        self.thread = threading.Thread(target=self.run, name="dispatcher", daemon=True)
+        self.thread.start()
+        logger.info("Job dispatcher started")
+
+    def stop(self):
+        self.running = False
+        self.node.fsm.unsubscribe(self._on_apply)
+        self.wake.set()
+        if self.thread:
+            self.thread.join()
+
+    def _on_apply(self, entries, index: int, term: int):
+        # Under the FSM lock on the apply thread
+        if self.node.fsm.queues.ready:
+            self.wake.set()
+
+    def run(self):
+        fsm = self.node.fsm
+        raft = self.node.raft
+        while self.running:
+            # The interval also covers gaining leadership with printers
+            # already waiting
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            while self.running and raft.is_leader:
+                with fsm.dispatch_lock:
+                    printers = fsm.queues.take_ready(self.batch_size)
+                if not printers:
+                    break
+                command = json.dumps({"op": "dispatch", "value": {"printers": printers}})
+                future = asyncio.run_coroutine_threadsafe(raft.propose([command]), raft.loop)
+                try:
+                    result = future.result(timeout=raft.apply_timeout)[0]
+                except Exception as e:
+                    future.cancel()
+                    result = e
+                if not isinstance(result, list):
+                    logger.warning("Dispatch of %s printers failed: %s", len(printers), result)
+                    break
+                if result:
+                    logger.debug("Dispatched %s jobs", len(result))
@@ -1,16 +1,215 @@
+import gc
 import os
+import json
 import time
+import struct
+import zlib
 import threading
 import logging
-from app.monitoring.metrics import snapshots_total
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+from app.monitoring.metrics import (snapshots_total, snapshot_duration_seconds, snapshot_bytes, restore_duration_seconds,
+                                    snapshot_installs_total)
+from app.raft.records import PrinterRecord, FilamentRecord, JobRecord, DedupRecord, UsageRecord
 
 logger = logging.getLogger("raft3d")
 
+SNAPSHOT_PREFIX = "snapshot_"
+SNAPSHOT_SUFFIX = ".snap"
+# A snapshot being received from the leader, until all of it has arrived
+INSTALL_SUFFIX = ".part"
+
+# Snapshot file layout: MAGIC, then a stream of records framed like the WAL
+# (payload length and CRC32, then the payload). Every payload starts with a
+# record type; the first record holds the applied index and term, and the
+# last one the number of entity records, so a truncated file is detected.
+MAGIC = b"R3DSNAP2"
+RECORD_HEADER = struct.Struct(">II")
+KIND = struct.Struct(">B")
+INDEX_TERM = struct.Struct(">QQ")
+COUNT = struct.Struct(">Q")
+STR_LEN = struct.Struct(">I")
+INT = struct.Struct(">q")
+
+HEADER = 1
+PRINTER = 2
+FILAMENT = 3
+PRINT_JOB = 4
+END = 5
+IDEMPOTENCY = 6
+ARCHIVED_USAGE = 7
+
+# Encoding of each record field, in the record class's FIELDS order: "s" is a
+# length-prefixed UTF-8 string, "i" a signed 64-bit integer and "b" one byte
+# (the job status code)
+ENTITY_FIELDS = {
+    PRINTER: ("printers", PrinterRecord, "sss"),
+    FILAMENT: ("filaments", FilamentRecord, "sssii"),
+    PRINT_JOB: ("print_jobs", JobRecord, "ssssibi"),
+    IDEMPOTENCY: ("idempotency", DedupRecord, "sssi"),
+    ARCHIVED_USAGE: ("archived_grams", UsageRecord, "si"),
+}
+# Version 1 files predate job priorities
+MAGIC_V1 = b"R3DSNAP1"
+ENTITY_FIELDS_V1 = {**ENTITY_FIELDS, PRINT_JOB: ("print_jobs", JobRecord, "ssssib")}
+
+CHUNK_BYTES = 256 * 1024
+
+
+def _frame(payload: bytes) -> bytes:
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _pack_entity(kind: int, cls, codes: str, record) -> bytes:
+    parts = [KIND.pack(kind)]
+    for name, code in zip(cls.FIELDS, codes):
+        value = getattr(record, name)
+        if code == "s":
+            data = value.encode()
+            parts.append(STR_LEN.pack(len(data)))
+            parts.append(data)
+        elif code == "i":
+            parts.append(INT.pack(value))
+        else:
+            parts.append(KIND.pack(value))
+    return b"".join(parts)
+
+
+def _unpack_entity(cls, codes: str, buf: bytes, offset: int):
+    # Fields start at offset (just past the record type byte) inside buf
+    values = []
+    unpack_len = STR_LEN.unpack_from
+    for code in codes:
+        if code == "s":
+            (length,) = unpack_len(buf, offset)
+            offset += 4
+            values.append(buf[offset:offset + length].decode())
+            offset += length
+        elif code == "i":
+            values.append(INT.unpack_from(buf, offset)[0])
+            offset += 8
+        else:
+            values.append(buf[offset])
+            offset += 1
+    return cls(*values)
+
+
+def encode_snapshot(state: Dict[str, Any]) -> Iterator[bytes]:
+    # Yields the snapshot in chunks of roughly CHUNK_BYTES so it can be written
+    # or sent without building the whole file in memory. Kinds missing from
+    # state (as in states built before they existed) are written as empty.
+    yield MAGIC + _frame(KIND.pack(HEADER) + INDEX_TERM.pack(state["index"], state["term"]))
+    count = 0
+    chunk: List[bytes] = []
+    size = 0
+    for kind, (key, cls, codes) in ENTITY_FIELDS.items():
+        for record in state.get(key, ()):
+            framed = _frame(_pack_entity(kind, cls, codes, record))
+            chunk.append(framed)
+            size += len(framed)
+            count += 1
+            if size >= CHUNK_BYTES:
+                yield b"".join(chunk)
+                chunk = []
+                size = 0
+    chunk.append(_frame(KIND.pack(END) + COUNT.pack(count)))
+    yield b"".join(chunk)
+
+
+def decode_snapshot(stream: BinaryIO) -> Dict[str, Any]:
+    # Reads a snapshot CHUNK_BYTES at a time and decodes the records in each
+    # chunk in place; returns the state in the shape Raft3DFSM.restore
+    # expects, with every entity already built as a record
+    magic = stream.read(len(MAGIC))
+    if magic == MAGIC:
+        fields = ENTITY_FIELDS
+    elif magic == MAGIC_V1:
+        fields = ENTITY_FIELDS_V1
+    else:
+        return _decode_legacy(magic + stream.read())
+    state: Dict[str, Any] = {key: [] for key, _, _ in fields.values()}
+    count = 0
+    buf = b""
+    offset = 0
+    while True:
+        chunk = stream.read(CHUNK_BYTES)
+        if not chunk:
+            raise ValueError("Snapshot is truncated")
+        buf = buf[offset:] + chunk
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(buf):
+            length, crc = RECORD_HEADER.unpack_from(buf, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + length
+            if end > len(buf):
+                break
+            if zlib.crc32(memoryview(buf)[start:end]) != crc:
+                raise ValueError("Snapshot record failed its CRC check")
+            kind = buf[start]
+            if kind in fields:
+                key, cls, codes = fields[kind]
+                state[key].append(_unpack_entity(cls, codes, buf, start + 1))
+                count += 1
+            elif kind == HEADER:
+                state["index"], state["term"] = INDEX_TERM.unpack_from(buf, start + 1)
+            elif kind == END:
+                (expected,) = COUNT.unpack_from(buf, start + 1)
+                if expected != count:
+                    raise ValueError(f"Snapshot holds {count} records, expected {expected}")
+                return state
+            else:
+                raise ValueError(f"Unknown snapshot record type {kind}")
+            offset = end
+
+
+def read_snapshot_header(path: str) -> Optional[Tuple[int, int]]:
+    # Index and term a binary snapshot file covers, from its first record
+    offset = len(MAGIC) + RECORD_HEADER.size
+    with open(path, "rb") as f:
+        head = f.read(offset + KIND.size + INDEX_TERM.size)
+    if head[:len(MAGIC)] not in (MAGIC, MAGIC_V1) or len(head) < offset + KIND.size + INDEX_TERM.size or \
+            head[offset] != HEADER:
+        return None
+    return INDEX_TERM.unpack_from(head, offset + KIND.size)
+
+
+def _decode_legacy(data: bytes) -> Dict[str, Any]:
+    # JSON snapshots written before the binary format, with entities keyed by id
+    state = json.loads(data.decode())
+    for key, cls, _ in ENTITY_FIELDS.values():
+        state[key] = [cls.from_value(value) for value in state.get(key, {}).values()]
+    return state
+
+
+def restore_snapshot(fsm, stream: BinaryIO):
+    # Decoding builds one object per entity; with the cyclic GC running, each
+    # full collection rescans everything built so far and restore time grows
+    # quadratically. The restored records live as long as the node, so they
+    # are frozen out of future collections as well.
+    start = time.monotonic()
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        fsm.restore(decode_snapshot(stream))
+    finally:
+        if enabled:
+            gc.enable()
+    gc.freeze()
+    restore_duration_seconds.observe(time.monotonic() - start)
+
+
 class SnapshotManager:
-    def __init__(self, fsm, raft_dir: str, interval: int = 300):
+    def __init__(self, fsm, raft_dir: str, interval: int = 300, retain: int = 3,
+                 on_snapshot: Optional[Callable[[int], None]] = None):
         self.fsm = fsm
         self.raft_dir = raft_dir
         self.interval = interval
+        self.retain = retain
+        self.on_snapshot = on_snapshot
+        # JobArchive of this node, set by RaftNode. Jobs archived up to a
+        # snapshot's index must be on disk before the snapshot that no
+        # longer holds them is written or installed.
+        self.archive: Optional[Any] = None
+        self.last_index = 0
         self.running = False
         self.thread = None
 
@@ -31,13 +230,128 @@ class SnapshotManager:
             time.sleep(self.interval)
             self.take_snapshot()
 
+    def _snapshot_files(self):
+        names = [n for n in os.listdir(self.raft_dir)
+                 if n.startswith(SNAPSHOT_PREFIX) and n.endswith(SNAPSHOT_SUFFIX)]
+        return sorted(names, key=lambda n: os.path.getmtime(os.path.join(self.raft_dir, n)))
+
+    def load_latest(self) -> bool:
+        # Restore the FSM from the newest readable snapshot, falling back to
+        # older ones if the newest is damaged
+        for name in reversed(self._snapshot_files()):
+            path = os.path.join(self.raft_dir, name)
+            try:
+                with open(path, "rb") as f:
+                    restore_snapshot(self.fsm, f)
+            except Exception as e:
+                logger.error("Failed to restore snapshot %s: %s", path, e)
+                continue
+            self.last_index = self.fsm.applied_index
+            logger.info("Restored snapshot %s at index %s", path, self.last_index)
+            return True
+        return False
+
+    def latest(self) -> Optional[Tuple[str, int, int]]:
+        # Path, index and term of the newest snapshot, for sending to a
+        # follower the log no longer reaches back to. JSON snapshots from
+        # before the binary format are not sent; the next snapshot replaces
+        # them.
+        for name in reversed(self._snapshot_files()):
+            path = os.path.join(self.raft_dir, name)
+            try:
+                header = read_snapshot_header(path)
+            except OSError:
+                continue
+            if header is not None:
+                return (path,) + header
+        return None
+
+    def _install_path(self, index: int, term: int) -> str:
+        return os.path.join(self.raft_dir, f"{SNAPSHOT_PREFIX}{index:020d}-{term}{SNAPSHOT_SUFFIX}{INSTALL_SUFFIX}")
+
+    def receive_chunk(self, index: int, term: int, offset: int, data: bytes) -> int:
+        # Appends a chunk of the snapshot the leader is sending to the partial
+        # file for (index, term) and returns the bytes now held, which is
+        # where the leader carries on. A chunk that does not start there is
+        # dropped, so after a reconnect or a restart of either node the
+        # transfer resumes instead of starting over.
+        path = self._install_path(index, term)
+        for name in os.listdir(self.raft_dir):
+            if name.endswith(INSTALL_SUFFIX) and os.path.join(self.raft_dir, name) != path:
+                os.remove(os.path.join(self.raft_dir, name))
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if offset != size or not data:
+            return size
+        with open(path, "ab") as f:
+            f.write(data)
+        return size + len(data)
+
+    def install(self, index: int, term: int) -> bool:
+        # Loads a fully received snapshot into the FSM and keeps it as this
+        # node's newest snapshot. A file that fails to decode is deleted, so
+        # the leader sends it again from the start.
+        path = self._install_path(index, term)
+        try:
+            if read_snapshot_header(path) != (index, term):
+                raise ValueError(f"Received snapshot does not cover index {index} at term {term}")
+            if self.archive is not None:
+                # Blocks the leader sent ahead of the snapshot
+                self.archive.flush()
+            with open(path, "rb") as f:
+                os.fsync(f.fileno())
+                restore_snapshot(self.fsm, f)
+        except Exception as e:
+            logger.error("Failed to install snapshot at index %s: %s", index, e)
+            if os.path.exists(path):
+                os.remove(path)
+            return False
+        snapshot_path = os.path.join(self.raft_dir, f"{SNAPSHOT_PREFIX}{index:020d}{SNAPSHOT_SUFFIX}")
+        os.replace(path, snapshot_path)
+        self.last_index = index
+        snapshot_installs_total.inc()
+        logger.info("Installed snapshot %s at index %s", snapshot_path, index)
+        self._prune(os.path.basename(snapshot_path))
+        return True
+
     def take_snapshot(self):
         try:
-            snapshot_data = self.fsm.snapshot()
-            snapshot_path = os.path.join(self.raft_dir, f"snapshot_{int(time.time())}.snap")
-            with open(snapshot_path, "wb") as f:
-                f.write(snapshot_data)
+            start = time.monotonic()
+            # Only this call touches the FSM lock; encoding and writing run on
+            # the snapshot thread while writes keep flowing
+            state = self.fsm.snapshot()
+            index = state["index"]
+            if index and index == self.last_index:
+                return
+            if self.archive is not None:
+                self.archive.flush(index)
+            snapshot_path = os.path.join(self.raft_dir, f"{SNAPSHOT_PREFIX}{index:020d}{SNAPSHOT_SUFFIX}")
+            tmp_path = snapshot_path + ".tmp"
+            written = 0
+            with open(tmp_path, "wb") as f:
+                for chunk in encode_snapshot(state):
+                    f.write(chunk)
+                    written += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, snapshot_path)
+            self.last_index = index
             snapshots_total.inc()  # Increment snapshot counter
-            logger.info(f"Snapshot saved to {snapshot_path}")
+            snapshot_duration_seconds.observe(time.monotonic() - start)
+            snapshot_bytes.set(written)
+            logger.info("Snapshot saved to %s (%s bytes)", snapshot_path, written)
+            self._prune(os.path.basename(snapshot_path))
+            if self.on_snapshot:
+                self.on_snapshot(index)
         except Exception as e:
-            logger.error(f"Failed to take snapshot: {str(e)}")
\ No newline at end of file
+            logger.error("Failed to take snapshot: %s", e)
+
+    def _prune(self, keep: str):
+        # Keep the newest `retain` snapshots (always including the one just
+        # written) and clear out temp files left by an interrupted write
+        names = [n for n in self._snapshot_files() if n != keep]
+        for name in names[:max(0, len(names) - (self.retain - 1))]:
+            os.remove(os.path.join(self.raft_dir, name))
+            logger.info("Removed old snapshot %s", name)
+        for name in os.listdir(self.raft_dir):
+            if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX + ".tmp"):
+                os.remove(os.path.join(self.raft_dir, name))
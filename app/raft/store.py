@@ -1,21 +1,101 @@
 import os
 import json
+import time
+import asyncio
 import logging
-from typing import Dict, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from app.raft.fsm import Raft3DFSM
+from app.raft.records import PrinterRecord, FilamentRecord, JobRecord, DedupRecord
 from app.raft.snapshot import SnapshotManager
-from app.raft.mock_raft import MockRaft
+from app.raft.raft import Raft
+from app.raft.scheduler import Dispatcher
+from app.raft.archive import JobArchive, Archiver
+from app.monitoring.metrics import apply_duration_seconds, watch_fsm
 
 logger = logging.getLogger("raft3d")
 
-class RaftNode:
+
+def make_command(op: str, value: dict, idempotency: Optional[Tuple[str, str]] = None) -> Dict[str, Any]:
+    cmd: Dict[str, Any] = {"op": op, "value": value}
+    if idempotency is not None:
+        # The proposer's clock drives expiry of the FSM's idempotency table
+        cmd["key"], cmd["fp"] = idempotency
+        cmd["ts"] = int(time.time() * 1000)
+    return cmd
+
+
+def pack_batch_entries(commands: List[Tuple[str, dict]], size: int) -> Tuple[List[list], List[bytes]]:
+    # Splits bulk commands into chunks of at most `size` and encodes each
+    # chunk as one multi-op log entry
+    chunks = [commands[i:i + size] for i in range(0, len(commands), size)]
+    entries = [json.dumps({"op": "batch", "value": [{"op": op, "value": value} for op, value in chunk]}).encode()
+               for chunk in chunks]
+    return chunks, entries
+
+
+def expand_batch_results(chunks: List[list], outcomes: List[Any]) -> List[Any]:
+    # One result per command; an entry that failed as a whole fails every
+    # command in it
+    results: List[Any] = []
+    for chunk, outcome in zip(chunks, outcomes):
+        results.extend(outcome if isinstance(outcome, list) else [False] * len(chunk))
+    return results
+
+
+# Read paths shared by RaftNode and the worker-side ReplicaNode; both serve
+# reads from a local Raft3DFSM in self.fsm
+class FSMView:
+    fsm: Raft3DFSM
+    archive: JobArchive
+
+    def get_printers(self) -> Dict[str, PrinterRecord]:
+        return self.fsm.printers
+
+    def get_filaments(self) -> Dict[str, FilamentRecord]:
+        return self.fsm.filaments
+
+    def get_print_jobs(self, status: Optional[str] = None) -> Dict[str, JobRecord]:
+        if status:
+            return self.fsm.jobs_with_status(status)
+        return self.fsm.print_jobs
+
+    def iter_printers(self, after: Optional[str] = None) -> Iterator[PrinterRecord]:
+        return self.fsm.iter_printers(after)
+
+    def iter_filaments(self, after: Optional[str] = None) -> Iterator[FilamentRecord]:
+        return self.fsm.iter_filaments(after)
+
+    def iter_print_jobs(self, status: Optional[str] = None, after: Optional[str] = None) -> Iterator[JobRecord]:
+        return self.fsm.iter_print_jobs(status, after)
+
+    def get_reserved_weight(self, filament_id: str) -> int:
+        # Grams already claimed on this filament by Queued and Running jobs
+        return self.fsm.reserved_grams.get(filament_id, 0)
+
+    def get_idempotent_result(self, key: str) -> Optional[DedupRecord]:
+        return self.fsm.idempotency.get(key)
+
+    def get_consumed_weight(self, filament_id: str) -> int:
+        # Grams used up on this filament by Done jobs, archived ones included
+        return self.fsm.consumed_grams.get(filament_id, 0)
+
+    def get_archived_job(self, job_id: str) -> Optional[JobRecord]:
+        return self.archive.get(job_id)
+
+    def iter_archived_jobs(self, after: Optional[str] = None) -> Iterator[Tuple[str, JobRecord]]:
+        return self.archive.iter_jobs(after)
+
+
+class RaftNode(FSMView):
     def __init__(self, node_id: str, raft_port: int, raft_dir: str, cluster: str):
         self.node_id = node_id
         self.fsm = Raft3DFSM()
+        watch_fsm(self.fsm)
+        self.batch_entry_ops = 2000
         self.raft_dir = raft_dir
         os.makedirs(raft_dir, exist_ok=True)
 
-        # Initialize mock Raft
+        # Initialize Raft
         try:
             if not cluster or "=" not in cluster:
                 raise ValueError(f"Invalid CLUSTER format: {cluster}")
@@ -24,29 +104,135 @@ class RaftNode:
             peers = [p.strip() for p in peers_str.split(",") if p.strip()]
             if not peers:
                 raise ValueError("No valid peers found in CLUSTER")
-            logger.info(f"Parsed peers for node {node_id}: {peers}")
+            logger.info("Parsed peers for node %s: %s", node_id, peers)
         except Exception as e:
-            logger.error(f"Failed to parse CLUSTER '{cluster}': {str(e)}")
+            logger.error("Failed to parse CLUSTER '%s': %s", cluster, e)
             raise
 
-        self.raft = MockRaft(node_id, peers, self.fsm, raft_dir)
-        self.raft.start()
+        # Finished jobs moved out of the FSM; entries replayed below that the
+        # archive already holds are skipped
+        self.archive = JobArchive(os.path.join(raft_dir, "archive"))
+        self.fsm.archive_sink = self.archive.append
 
-        # Start snapshot manager
+        # Recover from the newest snapshot; Raft then replays the WAL tail on top
         self.snapshot_manager = SnapshotManager(self.fsm, raft_dir)
+        self.snapshot_manager.archive = self.archive
+        self.snapshot_manager.load_latest()
+
+        self_addr = self._find_self(node_id, raft_port, peers)
+        self.raft = Raft(node_id, self_addr, peers, self.fsm, raft_dir, raft_port)
+        # Followers the log no longer reaches back to are sent a snapshot,
+        self.raft.snapshots = self.snapshot_manager
+        # and the archive blocks they lack along with it
+        self.raft.archive = self.archive
+        self.raft.start()
+
+        # Start snapshot manager; each snapshot lets Raft drop the WAL segments it covers
+        self.snapshot_manager.on_snapshot = self.raft.compact
         self.snapshot_manager.start()
 
+        # Leader-side dispatch of queued jobs to idle printers (ENABLE_SCHEDULER)
+        self.dispatcher = None
+        if os.getenv("ENABLE_SCHEDULER", "").lower() in ("1", "true", "yes"):
+            self.dispatcher = Dispatcher(self, int(os.getenv("DISPATCH_BATCH", "1000")))
+            self.dispatcher.start()
+
+        # Leader-side archiving of finished jobs beyond the newest ARCHIVE_KEEP
+        # of each terminal status
+        self.archiver = None
+        if os.getenv("ARCHIVE_KEEP"):
+            self.archiver = Archiver(self, int(os.getenv("ARCHIVE_KEEP")), int(os.getenv("ARCHIVE_BATCH", "10000")),
+                                     float(os.getenv("ARCHIVE_INTERVAL", "60")))
+            self.archiver.start()
+
+    @staticmethod
+    def _find_self(node_id: str, raft_port: int, peers: List[str]) -> str:
+        # Peers are host:port; match our NODE_ID against the host name (raft3d-node1
+        # for node1), falling back to our RAFT_PORT for single-host clusters
+        for peer in peers:
+            host = peer.rpartition(":")[0]
+            if host == node_id or host.endswith("-" + node_id):
+                return peer
+        for peer in peers:
+            if peer.rpartition(":")[2] == str(raft_port):
+                return peer
+        raise ValueError(f"Node {node_id} not found in CLUSTER peers {peers}")
+
     def apply(self, op: str, value: dict) -> bool:
         cmd = {"op": op, "value": value}
-        return self.raft.apply(json.dumps(cmd).encode())
+        with apply_duration_seconds.labels(op=op).time():
+            return self.raft.apply(json.dumps(cmd).encode())
 
-    def get_printers(self) -> Dict[str, 'Printer']:
-        return self.fsm.printers
+    async def apply_async(self, op: str, value: dict) -> bool:
+        result = await self.command_async(op, value)
+        return isinstance(result, bool) and result
 
-    def get_filaments(self) -> Dict[str, 'Filament']:
-        return self.fsm.filaments
+    async def command_async(self, op: str, value: dict, idempotency: Optional[Tuple[str, str]] = None) -> Any:
+        # The FSM's result as is: True, or a reason string for conditional
+        # commands the FSM refused. idempotency is an (Idempotency-Key,
+        # request fingerprint) pair; see Raft3DFSM._apply_once.
+        cmd = make_command(op, value, idempotency)
+        start = time.perf_counter()
+        result = await self.raft.apply_async(json.dumps(cmd).encode())
+        apply_duration_seconds.labels(op=op).observe(time.perf_counter() - start)
+        return result
 
-    def get_print_jobs(self, status: Optional[str] = None) -> Dict[str, 'PrintJob']:
-        if status:
-            return {k: v for k, v in self.fsm.print_jobs.items() if v.status == status}
-        return self.fsm.print_jobs
\ No newline at end of file
+    async def apply_batch_async(self, commands: List[Tuple[str, dict]]) -> List[Any]:
+        # Bulk writes: commands are packed into multi-op log entries of up to
+        # batch_entry_ops each, and the entries are submitted together so the
+        # group-commit path appends and replicates them in one go
+        chunks, entries = pack_batch_entries(commands, self.batch_entry_ops)
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*[self.raft.apply_async(entry) for entry in entries])
+        apply_duration_seconds.labels(op="batch").observe(time.perf_counter() - start)
+        return expand_batch_results(chunks, outcomes)
+
+    def leader(self) -> Optional[str]:
+        return self.raft.leader_addr
+
+    async def transfer_leadership(self, target: Optional[str] = None) -> bool:
+        future = asyncio.run_coroutine_threadsafe(self.raft.transfer_leadership(target), self.raft.loop)
+        return await asyncio.wrap_future(future)
+
+    def stop(self):
+        # Raft hands off leadership, if held, before it stops
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        if self.archiver is not None:
+            self.archiver.stop()
+        self.raft.stop()
+        self.archive.close()
+
+    def write_index(self) -> int:
+        # A log index at or after every write this node has completed, for
+        # clients that want to read their own writes from another node
+        return max(self.fsm.applied_index, self.raft.forwarded_commit)
+
+    async def wait_linearizable(self, timeout: float = 1.0) -> bool:
+        # Leader reads are served from local state under the lease; if it has
+        # lapsed, wait for the next heartbeat round to renew it. The lease and
+        # read index come from the one pair the raft loop publishes; its log
+        # and commit index are not read from this thread.
+        deadline = time.monotonic() + timeout
+        while True:
+            lease_until, read_index = self.raft.read_state
+            if time.monotonic() < lease_until:
+                break
+            if not self.raft.is_leader or time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(self.raft.heartbeat_interval / 2)
+        # Wait for the read index to be applied, which matters only while a
+        # large batch is in progress
+        return await self.wait_bounded(read_index, None, max(0.0, deadline - time.monotonic()))
+
+    async def wait_bounded(self, min_index: Optional[int] = None, max_staleness: Optional[float] = None,
+                           timeout: float = 1.0) -> bool:
+        # Wait until this node has applied min_index and trails the leader by
+        # at most max_staleness seconds
+        deadline = time.monotonic() + timeout
+        while (min_index is not None and self.fsm.applied_index < min_index) or \
+                (max_staleness is not None and self.raft.staleness() > max_staleness):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.005)
+        return True
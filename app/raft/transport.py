@@ -0,0 +1,153 @@
+import asyncio
+import json
+import struct
+import logging
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger("raft3d")
+
+# Every message on the raft port is a 4-byte big-endian length followed by a JSON body
+HEADER = struct.Struct(">I")
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+def encode_message(msg: Dict[str, Any]) -> bytes:
+    body = json.dumps(msg, separators=(",", ":")).encode()
+    return HEADER.pack(len(body)) + body
+
+
+async def read_message(reader: asyncio.StreamReader) -> Dict[str, Any]:
+    header = await reader.readexactly(HEADER.size)
+    (length,) = HEADER.unpack(header)
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError(f"Raft message too large: {length} bytes")
+    body = await reader.readexactly(length)
+    return json.loads(body)
+
+
+def parse_address(addr: str):
+    host, _, port = addr.rpartition(":")
+    return host, int(port)
+
+
+# Outgoing connection to one peer. Messages are written without waiting for a
+# reply so several AppendEntries batches can be in flight at once; replies come
+# back on the same connection and are handed to on_message.
+class PeerClient:
+    def __init__(self, addr: str, on_message: Callable[[Dict[str, Any]], None],
+                 connect_timeout: float = 0.5):
+        self.addr = addr
+        self.host, self.port = parse_address(addr)
+        self.on_message = on_message
+        self.connect_timeout = connect_timeout
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        self.connecting: Optional[asyncio.Task] = None
+        self.write_lock = asyncio.Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def _connect(self):
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.connect_timeout
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            logger.debug("Connection to peer %s failed: %s", self.addr, e)
+            return
+        self.writer = writer
+        self.reader_task = asyncio.ensure_future(self._read_loop(reader, writer))
+
+    async def _read_loop(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                msg = await read_message(reader)
+                self.on_message(msg)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        except Exception as e:
+            logger.error("Error reading from peer %s: %s", self.addr, e)
+        finally:
+            if self.writer is writer:
+                self.writer = None
+            writer.close()
+
+    async def send(self, msg: Dict[str, Any]) -> bool:
+        if not self.connected:
+            if self.connecting is None or self.connecting.done():
+                self.connecting = asyncio.ensure_future(self._connect())
+            await self.connecting
+            if not self.connected:
+                return False
+        try:
+            async with self.write_lock:
+                self.writer.write(encode_message(msg))
+                await self.writer.drain()
+            return True
+        except (ConnectionError, OSError, AttributeError) as e:
+            logger.debug("Send to peer %s failed: %s", self.addr, e)
+            self.close()
+            return False
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            self.reader_task = None
+
+
+# Asyncio TCP server plus one PeerClient per peer. The handler is called for
+# every message received; if it returns a message for an incoming connection,
+# that message is written back as the reply.
+class RaftTransport:
+    def __init__(self, bind_host: str, bind_port: int, peers, handler: Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]):
+        self.bind_host = bind_host
+        self.bind_port = bind_port
+        self.handler = handler
+        self.clients: Dict[str, PeerClient] = {
+            addr: PeerClient(addr, self._on_reply) for addr in peers
+        }
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.connections = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.bind_host, self.bind_port)
+
+    async def stop(self):
+        for client in self.clients.values():
+            client.close()
+        for writer in list(self.connections):
+            writer.close()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def _on_reply(self, msg: Dict[str, Any]):
+        self.handler(msg)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections.add(writer)
+        try:
+            while True:
+                msg = await read_message(reader)
+                reply = self.handler(msg)
+                if reply is not None:
+                    writer.write(encode_message(reply))
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        except Exception as e:
+            logger.error("Error serving raft connection: %s", e)
+        finally:
+            self.connections.discard(writer)
+            writer.close()
+
+    async def send(self, addr: str, msg: Dict[str, Any]) -> bool:
+        client = self.clients.get(addr)
+        if client is None:
+            return False
+        return await client.send(msg)
@@ -0,0 +1,230 @@
+import os
+import struct
+import zlib
+import logging
+from typing import Any, Dict, List, Tuple
+
+logger = logging.getLogger("raft3d")
+
+# Record framing: payload length and CRC32 of the payload, then the payload
+# itself, which starts with a record type, a log index and a term
+RECORD_HEADER = struct.Struct(">II")
+PAYLOAD_HEADER = struct.Struct(">BQQ")
+
+ENTRY = 1   # log entry with a command
+NOOP = 2    # log entry without a command (leader election no-op)
+COMMIT = 3  # highest index known committed when the batch was written
+BASE = 4    # first record of every segment: index and term just before it
+
+SEGMENT_SUFFIX = ".wal"
+
+
+def _fsync_dir(path: str):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def encode_record(kind: int, index: int, term: int, data: bytes = b"") -> bytes:
+    payload = PAYLOAD_HEADER.pack(kind, index, term) + data
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(buf: bytes):
+    # Yields (offset, kind, index, term, data) and stops at the first torn or
+    # corrupt record; the caller learns where by the offset of the last yield
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(buf):
+        length, crc = RECORD_HEADER.unpack_from(buf, offset)
+        start = offset + RECORD_HEADER.size
+        end = start + length
+        if length < PAYLOAD_HEADER.size or end > len(buf):
+            return
+        payload = buf[start:end]
+        if zlib.crc32(payload) != crc:
+            return
+        kind, index, term = PAYLOAD_HEADER.unpack_from(payload)
+        yield offset, end, kind, index, term, payload[PAYLOAD_HEADER.size:]
+        offset = end
+
+
+# Segmented, CRC-checked write-ahead log. Segments are named after the first
+# index they hold and rotated once they exceed segment_bytes; whole segments
+# are deleted once a snapshot covers them.
+class WriteAheadLog:
+    def __init__(self, wal_dir: str, segment_bytes: int = 16 * 1024 * 1024):
+        self.wal_dir = wal_dir
+        self.segment_bytes = segment_bytes
+        os.makedirs(wal_dir, exist_ok=True)
+        self.segments: List[int] = []
+        self.file = None
+        self.size = 0
+        self.last_index = 0
+        self.last_term = 0
+
+    def _path(self, first_index: int) -> str:
+        return os.path.join(self.wal_dir, f"{first_index:020d}{SEGMENT_SUFFIX}")
+
+    def _list_segments(self) -> List[int]:
+        segments = []
+        for name in os.listdir(self.wal_dir):
+            if name.endswith(SEGMENT_SUFFIX):
+                try:
+                    segments.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                except ValueError:
+                    continue
+        return sorted(segments)
+
+    def load(self) -> Tuple[int, int, List[Dict[str, Any]], int]:
+        # Returns (base_index, base_term, entries, commit_index) where entries
+        # follow base_index contiguously
+        base_index, base_term = 0, 0
+        entries: List[Dict[str, Any]] = []
+        commit_index = 0
+        segments = self._list_segments()
+        kept: List[int] = []
+        for pos, first in enumerate(segments):
+            path = self._path(first)
+            with open(path, "rb") as f:
+                buf = f.read()
+            good = 0
+            broken = False
+            for offset, end, kind, index, term, data in read_records(buf):
+                if kind == BASE:
+                    if not kept and not entries:
+                        base_index, base_term = index, term
+                    elif index != base_index + len(entries):
+                        broken = True
+                        break
+                elif kind in (ENTRY, NOOP):
+                    if index != base_index + len(entries) + 1:
+                        broken = True
+                        break
+                    entries.append({"t": term, "c": data.decode() if kind == ENTRY else None})
+                elif kind == COMMIT:
+                    commit_index = max(commit_index, index)
+                good = end
+            if broken or good < len(buf) or good == 0:
+                logger.error("WAL segment %s is corrupt after byte %s; discarding the rest of the log", path, good)
+                if good == 0:
+                    # Not even the BASE record made it to disk
+                    os.remove(path)
+                else:
+                    kept.append(first)
+                    with open(path, "r+b") as f:
+                        f.truncate(good)
+                        f.flush()
+                        os.fsync(f.fileno())
+                for later in segments[pos + 1:]:
+                    os.remove(self._path(later))
+                break
+            kept.append(first)
+        self.segments = kept
+        self.last_index = base_index + len(entries)
+        self.last_term = entries[-1]["t"] if entries else base_term
+        commit_index = min(commit_index, self.last_index)
+        if self.segments:
+            path = self._path(self.segments[-1])
+            self.file = open(path, "ab")
+            self.size = os.path.getsize(path)
+        else:
+            self._open_segment(base_index, base_term)
+        return base_index, base_term, entries, commit_index
+
+    def _open_segment(self, base_index: int, base_term: int):
+        if self.file is not None:
+            self.file.close()
+        first = base_index + 1
+        path = self._path(first)
+        self.file = open(path, "wb")
+        header = encode_record(BASE, base_index, base_term)
+        self.file.write(header)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        _fsync_dir(self.wal_dir)
+        self.size = len(header)
+        self.segments.append(first)
+
+    def append(self, entries: List[Dict[str, Any]], commit_index: int = 0):
+        # One write and one fsync for the whole batch, plus a commit marker so
+        # restart can replay committed entries without waiting for a leader
+        if self.size >= self.segment_bytes:
+            self._open_segment(self.last_index, self.last_term)
+        chunks = []
+        index = self.last_index
+        for entry in entries:
+            index += 1
+            if entry["c"] is None:
+                chunks.append(encode_record(NOOP, index, entry["t"]))
+            else:
+                chunks.append(encode_record(ENTRY, index, entry["t"], entry["c"].encode()))
+        if commit_index:
+            chunks.append(encode_record(COMMIT, min(commit_index, index), 0))
+        data = b"".join(chunks)
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += len(data)
+        if entries:
+            self.last_index = index
+            self.last_term = entries[-1]["t"]
+
+    def truncate_from(self, index: int, prev_term: int):
+        # Remove entry index and everything after it
+        while len(self.segments) > 1 and self.segments[-1] > index:
+            self.file.close()
+            os.remove(self._path(self.segments.pop()))
+            self.file = open(self._path(self.segments[-1]), "ab")
+        path = self._path(self.segments[-1])
+        with open(path, "rb") as f:
+            buf = f.read()
+        cut = len(buf)
+        for offset, end, kind, rec_index, term, data in read_records(buf):
+            if kind in (ENTRY, NOOP) and rec_index >= index:
+                cut = offset
+                break
+        self.file.close()
+        with open(path, "r+b") as f:
+            f.truncate(cut)
+            f.flush()
+            os.fsync(f.fileno())
+        self.file = open(path, "ab")
+        self.size = cut
+        self.last_index = index - 1
+        self.last_term = prev_term
+
+    def remove_before(self, index: int) -> int:
+        # Delete segments whose entries are all <= index; the active segment is
+        # always kept. Returns the first index still held on disk.
+        removed = False
+        while len(self.segments) > 1 and self.segments[1] - 1 <= index:
+            os.remove(self._path(self.segments.pop(0)))
+            removed = True
+        if removed:
+            _fsync_dir(self.wal_dir)
+        return self.segments[0]
+
+    def reset(self, base_index: int, base_term: int):
+        # Drop the whole log and start over after base_index, e.g. when a
+        # snapshot is newer than anything in the WAL
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for first in self.segments:
+            os.remove(self._path(first))
+        self.segments = []
+        self._open_segment(base_index, base_term)
+        self.last_index = base_index
+        self.last_term = base_term
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,175 @@
+import json
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Deque, Iterable, List, Optional, Set
+from app.raft.fsm import Raft3DFSM
+from app.monitoring.metrics import watch_subscribers, watch_overflows_total
+
+logger = logging.getLogger("raft3d")
+
+# Change feed behind GET /watch. The FSM records every mutation it applies
+# with the log index of its entry; the feed keeps the most recent ones so
+# clients can resume, and fans each applied batch out to the open streams on
+# the HTTP event loop. Events are encoded once, however many streams get them.
+
+WATCH_KINDS = ("printer", "filament", "print_job")
+
+
+class ChangeEvent:
+    __slots__ = ("index", "kind", "op", "record", "frame")
+
+    def __init__(self, index: int, kind: str, op: str, record: Any):
+        self.index = index
+        self.kind = kind
+        self.op = op
+        self.record = record
+        self.frame: Optional[bytes] = None
+
+    def encode(self) -> bytes:
+        # Server-Sent Events frame; the id lets a reconnecting EventSource
+        # resume through Last-Event-ID
+        if self.frame is None:
+            data = json.dumps({"index": self.index, "type": self.kind, "op": self.op, "data": self.record.to_dict()},
+                              separators=(",", ":"))
+            self.frame = f"id: {self.index}\nevent: {self.kind}\ndata: {data}\n\n".encode()
+        return self.frame
+
+
+class WatchFilter:
+    # Empty fields match everything. status only matches print jobs;
+    # printer_id matches that printer and the jobs sent to it.
+    __slots__ = ("kinds", "status", "printer_id")
+
+    def __init__(self, kinds: Iterable[str] = (), status: Optional[str] = None, printer_id: Optional[str] = None):
+        self.kinds = frozenset(kinds)
+        self.status = status
+        self.printer_id = printer_id
+
+    def matches(self, event: ChangeEvent) -> bool:
+        if self.kinds and event.kind not in self.kinds:
+            return False
+        record = event.record
+        if self.status is not None and (event.kind != "print_job" or record.status != self.status):
+            return False
+        if self.printer_id is not None:
+            if event.kind == "print_job":
+                return record.printer_id == self.printer_id
+            return event.kind == "printer" and record.id == self.printer_id
+        return True
+
+
+class Subscription:
+    # One open stream. Events wait in a buffer of at most max_buffer; a
+    # consumer that falls further behind is cut off with an overflow and
+    # resumes from the last index it received. Events at or below `after`
+    # were applied before the stream opened and are skipped.
+    def __init__(self, watch_filter: WatchFilter, max_buffer: int, after: int = 0):
+        self.filter = watch_filter
+        self.max_buffer = max_buffer
+        self.after = after
+        self.events: Deque[ChangeEvent] = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+        self.reset = False
+
+    def push(self, events: Iterable[ChangeEvent], bounded: bool = True):
+        if self.overflowed or self.reset:
+            return
+        matches = self.filter.matches
+        after = self.after
+        self.events.extend(event for event in events if event.index > after and matches(event))
+        if bounded and len(self.events) > self.max_buffer:
+            self.events.clear()
+            self.overflowed = True
+            watch_overflows_total.inc()
+        if self.events or self.overflowed:
+            self.ready.set()
+
+    def close(self):
+        # The FSM state was replaced, so the history no longer lines up
+        self.events.clear()
+        self.reset = True
+        self.ready.set()
+
+    async def next(self, timeout: float) -> List[ChangeEvent]:
+        # Buffered events, or an empty list once timeout passes without any
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self.ready.clear()
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+
+class ChangeFeed:
+    # Created on the event loop that serves HTTP. Applied batches arrive on
+    # the apply thread and are handed to the loop, where history and
+    # subscriptions are only ever touched, so they need no lock.
+    def __init__(self, fsm: Raft3DFSM, loop: asyncio.AbstractEventLoop, max_history: int = 10000,
+                 max_buffer: int = 1000):
+        self.fsm = fsm
+        self.loop = loop
+        self.max_history = max_history
+        self.max_buffer = max_buffer
+        # Every event with an index above floor is still in history
+        self.history: Deque[ChangeEvent] = deque()
+        self.subscriptions: Set[Subscription] = set()
+        fsm.track_changes()
+        self.floor = fsm.subscribe(self._on_apply)["index"]
+
+    def _on_apply(self, entries: Optional[List[bytes]], index: int, term: int):
+        # Runs under the FSM lock; records are immutable, so building the
+        # events is all that happens here
+        if entries is None:
+            self.loop.call_soon_threadsafe(self._reset, index)
+        elif self.fsm.changes:
+            events = [ChangeEvent(*change) for change in self.fsm.changes]
+            self.loop.call_soon_threadsafe(self._publish, events)
+
+    def _publish(self, events: List[ChangeEvent]):
+        history = self.history
+        history.extend(events)
+        while len(history) > self.max_history:
+            self.floor = history.popleft().index
+        for subscription in self.subscriptions:
+            subscription.push(events)
+
+    def _reset(self, index: int):
+        logger.info("FSM restored at index %s; closing %s watch streams", index, len(self.subscriptions))
+        self.history.clear()
+        self.floor = index
+        for subscription in self.subscriptions:
+            subscription.close()
+
+    def watch(self, since: Optional[int], watch_filter: WatchFilter) -> Optional[Subscription]:
+        # Streams events after index `since`, or only new ones when it is
+        # None. Returns None when events after `since` are no longer kept, and
+        # raises ValueError for a `since` this node has not applied yet.
+        if since is not None and since < self.floor:
+            return None
+        if since is not None and since > self.fsm.applied_index:
+            raise ValueError(f"Index {since} is ahead of this node's applied index {self.fsm.applied_index}")
+        subscription = Subscription(watch_filter, self.max_buffer, since or 0)
+        if since is not None:
+            backlog = []
+            for event in reversed(self.history):
+                if event.index <= since:
+                    break
+                backlog.append(event)
+            backlog.reverse()
+            subscription.push(backlog, bounded=False)
+        self.subscriptions.add(subscription)
+        watch_subscribers.set(len(self.subscriptions))
+        return subscription
+
+    def cancel(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+        watch_subscribers.set(len(self.subscriptions))
+
+    def close(self):
+        self.fsm.unsubscribe(self._on_apply)
+        for subscription in self.subscriptions:
+            subscription.close()
@@ -0,0 +1,85 @@
+"""Memory and restore time of FSM job storage: Pydantic models vs records.
+
+Builds N print jobs both ways and reports the memory held by the job dict
+(traced with tracemalloc) and the time to restore it from a snapshot. The old
+layout restores from a JSON snapshot with PrintJob(**value) per job; the new
+one decodes the binary snapshot straight into JobRecords.
+
+    python benchmarks/bench_fsm_layout.py --jobs 1000000
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.models.printjob import PrintJob  # noqa: E402
+from app.raft.fsm import Raft3DFSM  # noqa: E402
+from app.raft.records import JobRecord  # noqa: E402
+from app.raft.snapshot import encode_snapshot, restore_snapshot  # noqa: E402
+
+STATUSES = ("Queued", "Running", "Done", "Cancelled")
+
+
+def job_values(count: int):
+    return [{"id": f"job-{i:08d}", "printer_id": f"printer-{i % 1000}", "filament_id": f"filament-{i % 200}",
+             "filepath": f"prints/part-{i % 5000}.gcode", "print_weight_in_grams": 10 + i % 90,
+             "status": STATUSES[i % 4]} for i in range(count)]
+
+
+def traced(build):
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def timed(run):
+    # The cyclic GC is paused, as restore_snapshot does, so both layouts are
+    # measured without collection pauses
+    gc.collect()
+    gc.disable()
+    start = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - start
+    gc.enable()
+    return result, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=1000000)
+    args = parser.parse_args()
+    values = job_values(args.jobs)
+
+    # Old layout: dict of Pydantic models, snapshotted as JSON
+    old, old_bytes = traced(lambda: {v["id"]: PrintJob(**v) for v in values})
+    old_snapshot = json.dumps({"print_jobs": {k: v.dict() for k, v in old.items()}}).encode()
+    del old
+    _, old_restore = timed(lambda: {k: PrintJob(**v) for k, v in json.loads(old_snapshot)["print_jobs"].items()})
+    del old_snapshot
+
+    # New layout: dict of slotted records, snapshotted in the binary format
+    new, new_bytes = traced(lambda: {v["id"]: JobRecord.from_value(v) for v in values})
+    state = {"index": 1, "term": 1, "printers": [], "filaments": [], "print_jobs": list(new.values())}
+    new_snapshot = b"".join(encode_snapshot(state))
+    del new, state
+    fsm = Raft3DFSM()
+    _, new_restore = timed(lambda: restore_snapshot(fsm, io.BytesIO(new_snapshot)))
+    assert len(fsm.print_jobs) == args.jobs
+
+    print(f"{args.jobs} jobs")
+    print(f"  pydantic models: {old_bytes / args.jobs:7.1f} B/job  restore {old_restore:6.2f}s")
+    print(f"  slotted records: {new_bytes / args.jobs:7.1f} B/job  restore {new_restore:6.2f}s"
+          f"  (snapshot {len(new_snapshot) / args.jobs:.1f} B/job)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Print job submission latency against FSM history size.
+
+Starts a single-node RaftNode in a scratch directory, fills it with N
+finished and queued jobs, then times what create_print_job awaits per
+submission: submit_print_job through RaftNode.command_async, i.e. the WAL
+append and commit plus the FSM apply, which admits the job (existence and
+filament reservation checks) as it applies. With the secondary indexes this
+should stay flat as N grows; the old full scan is timed alongside for
+comparison.
+
+    python benchmarks/bench_job_submission.py --sizes 1000 100000 1000000
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.raft.fsm import Raft3DFSM  # noqa: E402
+from app.raft.store import RaftNode  # noqa: E402
+
+FILAMENTS = 100
+
+
+async def populate(node: RaftNode, size: int, batch: int = 10000):
+    await node.command_async("add_printer", {"id": "p1", "company": "Creality", "model": "Ender 3"})
+    await node.apply_batch_async([("add_filament", {
+        "id": f"f{f}", "type": "PLA", "color": "Blue",
+        "total_weight_in_grams": 10 ** 12, "remaining_weight_in_grams": 10 ** 12,
+    }) for f in range(FILAMENTS)])
+    for start in range(0, size, batch):
+        await node.apply_batch_async([("add_print_job", {
+            "id": f"j{i}", "printer_id": "p1", "filament_id": f"f{i % FILAMENTS}",
+            "filepath": "prints/part.gcode", "print_weight_in_grams": 1,
+            # Most of the history is finished work, as on a long-running farm
+            "status": "Queued" if i % 10 == 0 else "Done",
+        }) for i in range(start, min(start + batch, size))])
+
+
+def scan_reserved(fsm: Raft3DFSM, filament_id: str) -> int:
+    return sum(j.print_weight_in_grams for j in fsm.print_jobs.values()
+               if j.filament_id == filament_id and j.status in ["Queued", "Running"])
+
+
+async def submit_all(node: RaftNode, samples: int):
+    latencies = []
+    for i in range(samples):
+        job = {"id": f"new{i}", "printer_id": "p1", "filament_id": f"f{i % FILAMENTS}",
+               "filepath": "prints/part.gcode", "print_weight_in_grams": 1, "status": "Queued"}
+        t = time.perf_counter()
+        result = await node.command_async("submit_print_job", job)
+        latencies.append(time.perf_counter() - t)
+        assert result is True, result
+    return latencies
+
+
+def start_node(raft_dir: str, port: int) -> RaftNode:
+    node = RaftNode("node1", port, raft_dir, f"nodes=127.0.0.1:{port}")
+    deadline = time.monotonic() + 10
+    while not node.raft.is_leader:
+        if time.monotonic() >= deadline:
+            raise RuntimeError("Single-node cluster did not elect itself")
+        time.sleep(0.01)
+    return node
+
+
+def run(size: int, samples: int, scan_samples: int, port: int):
+    raft_dir = tempfile.mkdtemp(prefix="bench-submit-")
+    node = start_node(raft_dir, port)
+    try:
+        measure(node, size, samples, scan_samples)
+    finally:
+        node.stop()
+        shutil.rmtree(raft_dir, ignore_errors=True)
+
+
+def measure(node: RaftNode, size: int, samples: int, scan_samples: int):
+    fsm = node.fsm
+    start = time.perf_counter()
+    asyncio.run(populate(node, size))
+    fill = time.perf_counter() - start
+
+    latencies = asyncio.run(submit_all(node, samples))
+    assert fsm.reserved_grams["f0"] == scan_reserved(fsm, "f0")
+
+    scans = []
+    for i in range(scan_samples):
+        t = time.perf_counter()
+        scan_reserved(fsm, f"f{i % FILAMENTS}")
+        scans.append(time.perf_counter() - t)
+
+    latencies.sort()
+    print(f"{size:>9} jobs  fill {fill:7.2f}s  "
+          f"submit p50 {latencies[len(latencies) // 2] * 1e6:7.1f}us  "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:7.1f}us  "
+          f"old scan {statistics.median(scans) * 1e3:9.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--scan-samples", type=int, default=5)
+    parser.add_argument("--port", type=int, default=19190, help="Raft port of the benchmark node")
+    args = parser.parse_args()
+    for size in args.sizes:
+        run(size, args.samples, args.scan_samples, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Dispatch decision rate of the job scheduler.
+
+Fills a Raft3DFSM with P printers, P filaments and J queued jobs per
+printer (random priorities; every tenth job uses a filament shared with the
+neighbouring printer, so some dispatches wait for a spool), then runs the
+dispatch loop the leader drives: dispatch commands naming the ready printers,
+each followed by a command finishing every running job. Reports decisions
+(jobs started) per second and the apply time per decision; with per-printer
+heaps the latter should grow with log J, not with J or P.
+
+    python benchmarks/bench_scheduler.py --printers 10000 --depths 1 10 100
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from app.raft.fsm import Raft3DFSM  # noqa: E402
+
+
+def command(op: str, value: dict) -> bytes:
+    return json.dumps({"op": op, "value": value}).encode()
+
+
+def populate(fsm: Raft3DFSM, printers: int, depth: int, rng: random.Random, batch: int = 10000):
+    fsm.apply_batch([command("add_printer", {"id": f"p{p}", "company": "Prusa", "model": "MK4"})
+                     for p in range(printers)])
+    fsm.apply_batch([command("add_filament", {
+        "id": f"f{p}", "type": "PLA", "color": "Blue",
+        "total_weight_in_grams": 10 ** 12, "remaining_weight_in_grams": 10 ** 12,
+    }) for p in range(printers)])
+    jobs = [command("submit_print_job", {
+        "id": f"j{p}-{d}", "printer_id": f"p{p}",
+        "filament_id": f"f{(p + 1) % printers}" if d % 10 == 9 else f"f{p}",
+        "filepath": "prints/part.gcode", "print_weight_in_grams": 1, "status": "Queued",
+        "priority": rng.randrange(4),
+    }) for d in range(depth) for p in range(printers)]
+    for start in range(0, len(jobs), batch):
+        fsm.apply_batch(jobs[start:start + batch])
+
+
+def run(printers: int, depth: int, batch_size: int, seed: int):
+    fsm = Raft3DFSM()
+    populate(fsm, printers, depth, random.Random(seed))
+    total = printers * depth
+
+    decisions = 0
+    dispatch_time = 0.0
+    rounds = 0
+    start = time.perf_counter()
+    while decisions < total:
+        started = []
+        while True:
+            ready = fsm.queues.take_ready(batch_size)
+            if not ready:
+                break
+            t = time.perf_counter()
+            started.extend(fsm.apply(command("dispatch", {"printers": ready})))
+            dispatch_time += time.perf_counter() - t
+        if not started:
+            raise RuntimeError(f"Scheduler stalled after {decisions} of {total} jobs")
+        decisions += len(started)
+        rounds += 1
+        fsm.apply(command("batch", [{"op": "update_print_job_status",
+                                     "value": {"job_id": job_id, "status": "Done"}} for _, job_id in started]))
+    elapsed = time.perf_counter() - start
+
+    assert not fsm.queues.running and not fsm.queues.ready
+    print(f"{printers:>6} printers x {depth:>4} jobs  rounds {rounds:>5}  "
+          f"{decisions / dispatch_time:>10,.0f} decisions/s  "
+          f"{dispatch_time / decisions * 1e6:6.2f}us per decision  "
+          f"(with finishing jobs {decisions / elapsed:>9,.0f}/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--printers", type=int, default=10000)
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--batch-size", type=int, default=1000, help="printers named per dispatch command")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    for depth in args.depths:
+        run(args.printers, depth, args.batch_size, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+"""Load generator and benchmark harness for a Raft3D node or cluster.
+
+Either points at running nodes (--url, repeatable) or spawns --nodes N local
+node processes from app/main.py, each with its own RAFT_DIR. It then drives a
+workload at a fixed concurrency over keep-alive HTTP connections and reports
+throughput, latency percentiles per operation, errors and node memory.
+
+The workload is either synthesized from a weighted mix of operations
+(job creation, status transitions, list queries) or replayed from a JSONL
+file with one {"method", "path", "body"} object per line. Results are
+written as JSON with --output; pass an earlier file with --compare to print
+the change against it.
+
+    python benchmarks/loadgen.py --nodes 3 --concurrency 64 --duration 30 \\
+        --mix create=5,status=3,list=2 --output bench_output.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+API = "/api/v1"
+
+
+# ---- minimal keep-alive HTTP/1.1 client -----------------------------------
+
+class HttpConnection:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(self, method: str, path: str, body: Optional[bytes] = None,
+                      content_type: str = "application/json") -> Tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\n"
+        if body is not None:
+            head += f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+        try:
+            self.writer.write(head.encode() + b"\r\n" + (body or b""))
+            return await self._read_response()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.close()
+            raise
+
+    async def _read_response(self) -> Tuple[int, bytes]:
+        status = int((await self.reader.readline()).split()[1])
+        length = None
+        chunked = False
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode().partition(":")
+            name = name.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "transfer-encoding" and "chunked" in value:
+                chunked = True
+        if chunked:
+            parts = []
+            while True:
+                size = int((await self.reader.readline()).strip(), 16)
+                data = await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                parts.append(data[:-2])
+            return status, b"".join(parts)
+        return status, await self.reader.readexactly(length or 0)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def parse_url(url: str) -> Tuple[str, int]:
+    host, _, port = url.split("://", 1)[-1].rstrip("/").rpartition(":")
+    return host, int(port)
+
+
+async def fetch(url: str, path: str) -> Tuple[int, bytes]:
+    conn = HttpConnection(*parse_url(url))
+    try:
+        return await conn.request("GET", path)
+    finally:
+        conn.close()
+
+
+# ---- cluster under test ---------------------------------------------------
+
+class LocalCluster:
+    # N node processes on localhost, started from app/main.py
+    def __init__(self, nodes: int, http_base: int, raft_base: int, workers: int = 1):
+        self.dir = tempfile.mkdtemp(prefix="raft3d-bench-")
+        peers = ",".join(f"127.0.0.1:{raft_base + i}" for i in range(nodes))
+        self.urls = [f"http://127.0.0.1:{http_base + i}" for i in range(nodes)]
+        self.procs = []
+        for i in range(nodes):
+            env = dict(os.environ, NODE_ID=f"node{i + 1}", RAFT_PORT=str(raft_base + i),
+                       HTTP_PORT=str(http_base + i), RAFT_DIR=os.path.join(self.dir, f"node{i + 1}"),
+                       CLUSTER=f"nodes={peers}", HTTP_WORKERS=str(workers),
+                       LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"), PYTHONPATH=ROOT)
+            log = open(os.path.join(self.dir, f"node{i + 1}.log"), "wb")
+            self.procs.append(subprocess.Popen([sys.executable, os.path.join(ROOT, "app", "main.py")],
+                                               env=env, stdout=log, stderr=subprocess.STDOUT))
+
+    def stop(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            proc.wait()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+async def node_metrics(url: str) -> Dict[str, float]:
+    try:
+        status, body = await fetch(url, "/metrics")
+    except OSError:
+        return {}
+    values = {}
+    for line in body.decode().splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            try:
+                values[name] = float(value)
+            except ValueError:
+                pass
+    return values
+
+
+async def wait_for_leader(urls: List[str], timeout: float = 30.0) -> str:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for url in urls:
+            metrics = await node_metrics(url)
+            if any(k.startswith("raft3d_is_leader") and v == 1.0 for k, v in metrics.items()):
+                return url
+        await asyncio.sleep(0.2)
+    raise RuntimeError("No leader elected")
+
+
+# ---- workloads ------------------------------------------------------------
+
+class Workload:
+    # Synthesized mix. Jobs created here move Queued -> Running -> Done (or
+    # Cancelled) through the status operation, so transitions stay valid; a
+    # job is only started on a printer that is not running one already.
+    def __init__(self, mix: Dict[str, float], printers: int, filaments: int, seed: int):
+        self.ops = list(mix)
+        self.weights = [mix[op] for op in self.ops]
+        self.printers = printers
+        self.filaments = filaments
+        self.random = random.Random(seed)
+        self.prefix = f"bench{seed}-{int(time.time())}"
+        self.created = 0
+        # (job ID, printer ID) pairs
+        self.queued: List[Tuple[str, str]] = []
+        self.running: List[Tuple[str, str]] = []
+        self.busy: set = set()
+
+    def setup(self) -> List[Tuple[str, str, bytes, str]]:
+        printers = "\n".join(json.dumps({"id": f"{self.prefix}-p{i}", "company": "Creality", "model": "Ender 3"})
+                             for i in range(self.printers))
+        filaments = "\n".join(json.dumps({"id": f"{self.prefix}-f{i}", "type": "PLA", "color": "Blue",
+                                          "total_weight_in_grams": 10 ** 9, "remaining_weight_in_grams": 10 ** 9})
+                              for i in range(self.filaments))
+        return [("POST", f"{API}/printers/batch", printers.encode(), "application/x-ndjson"),
+                ("POST", f"{API}/filaments/batch", filaments.encode(), "application/x-ndjson")]
+
+    def next(self) -> Tuple[str, str, str, Optional[bytes], Any]:
+        op = self.random.choices(self.ops, self.weights)[0]
+        if op == "status" and not (self.queued or self.running):
+            op = "create"
+        startable = self._startable() if op == "status" and self.queued else None
+        if op == "status" and startable is None and not self.running:
+            op = "create"
+        if op == "create":
+            self.created += 1
+            job_id = f"{self.prefix}-j{self.created}"
+            printer_id = f"{self.prefix}-p{self.random.randrange(self.printers)}"
+            body = {"id": job_id, "printer_id": printer_id,
+                    "filament_id": f"{self.prefix}-f{self.random.randrange(self.filaments)}",
+                    "filepath": "prints/bench.gcode", "print_weight_in_grams": 1, "status": "Queued"}
+            return op, "POST", f"{API}/print_jobs", json.dumps(body).encode(), ("created", job_id, printer_id)
+        if op == "status":
+            if self.running and (startable is None or self.random.random() < 0.5):
+                job_id, printer_id = self.running.pop(self.random.randrange(len(self.running)))
+                status = "Done" if self.random.random() < 0.9 else "Cancelled"
+            else:
+                job_id, printer_id = self.queued.pop(startable)
+                self.busy.add(printer_id)
+                status = "Running"
+            return op, "POST", f"{API}/print_jobs/{job_id}/status?status={status}", None, (status, job_id, printer_id)
+        status = self.random.choice(("Queued", "Running"))
+        return op, "GET", f"{API}/print_jobs?status={status}&limit=100", None, None
+
+    def _startable(self) -> Optional[int]:
+        # Position of a queued job whose printer is idle, from a few random picks
+        for _ in range(8):
+            position = self.random.randrange(len(self.queued))
+            if self.queued[position][1] not in self.busy:
+                return position
+        return None
+
+    def done(self, tag: Any, ok: bool):
+        if tag is None:
+            return
+        outcome, job_id, printer_id = tag
+        if outcome == "created":
+            if ok:
+                self.queued.append((job_id, printer_id))
+        elif outcome == "Running":
+            if ok:
+                self.running.append((job_id, printer_id))
+            else:
+                self.busy.discard(printer_id)
+        else:
+            self.busy.discard(printer_id)
+
+
+class Replay:
+    # Requests from a JSONL file, replayed in order (and looped if the run
+    # outlasts the file)
+    def __init__(self, path: str):
+        with open(path) as f:
+            self.requests = [json.loads(line) for line in f if line.strip()]
+        if not self.requests:
+            raise ValueError(f"No requests in {path}")
+        self.position = 0
+
+    def setup(self):
+        return []
+
+    def next(self):
+        req = self.requests[self.position % len(self.requests)]
+        self.position += 1
+        body = req.get("body")
+        if body is not None and not isinstance(body, str):
+            body = json.dumps(body)
+        op = req.get("op") or f"{req['method'].upper()} {req['path'].split('?')[0]}"
+        return op, req["method"].upper(), req["path"], body.encode() if body is not None else None, None
+
+    def done(self, tag, ok):
+        pass
+
+
+# ---- driver ---------------------------------------------------------------
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict[str, float]:
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "p999_ms": percentile(latencies, 0.999) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+async def run(args) -> Dict[str, Any]:
+    cluster = None
+    urls = args.url
+    if not urls:
+        cluster = LocalCluster(args.nodes, args.http_port, args.raft_port, args.workers)
+        urls = cluster.urls
+    try:
+        leader = await wait_for_leader(urls)
+        targets = [leader] if args.leader_only else urls
+        workload = Replay(args.replay) if args.replay else Workload(
+            dict((k, float(v)) for k, v in (p.split("=") for p in args.mix.split(","))),
+            args.printers, args.filaments, args.seed)
+        setup = HttpConnection(*parse_url(leader))
+        for method, path, body, content_type in workload.setup():
+            status, _ = await setup.request(method, path, body, content_type)
+            if status != 200:
+                raise RuntimeError(f"Setup request {path} failed with {status}")
+        setup.close()
+
+        latencies: Dict[str, List[float]] = {}
+        errors: Dict[str, int] = {}
+        deadline = time.monotonic() + args.duration
+        remaining = [args.requests] if args.requests else None
+
+        async def worker(n: int):
+            conn = HttpConnection(*parse_url(targets[n % len(targets)]))
+            while time.monotonic() < deadline:
+                if remaining is not None:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+                op, method, path, body, tag = workload.next()
+                start = time.perf_counter()
+                try:
+                    status, _ = await conn.request(method, path, body)
+                    ok = status < 400
+                except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                    ok = False
+                latencies.setdefault(op, []).append(time.perf_counter() - start)
+                if not ok:
+                    errors[op] = errors.get(op, 0) + 1
+                workload.done(tag, ok)
+            conn.close()
+
+        started = time.monotonic()
+        await asyncio.gather(*[worker(n) for n in range(args.concurrency)])
+        elapsed = time.monotonic() - started
+
+        memory = {}
+        for url in urls:
+            metrics = await node_metrics(url)
+            memory[url] = metrics.get("process_resident_memory_bytes")
+        return {
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            "elapsed_s": elapsed,
+            "overall": summarize([x for values in latencies.values() for x in values],
+                                 sum(errors.values()), elapsed),
+            "operations": {op: summarize(values, errors.get(op, 0), elapsed) for op, values in latencies.items()},
+            "node_rss_bytes": memory,
+        }
+    finally:
+        if cluster is not None:
+            cluster.stop()
+
+
+def report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    print(f"{'operation':<28}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'p999 ms':>9}")
+    rows = sorted(result["operations"].items()) + [("overall", result["overall"])]
+    for op, s in rows:
+        line = (f"{op:<28}{s['requests']:>10}{s['errors']:>8}{s['throughput']:>10.1f}"
+                f"{s['p50_ms']:>9.2f}{s['p99_ms']:>9.2f}{s['p999_ms']:>9.2f}")
+        base = (baseline or {}).get("operations", {}).get(op) if op != "overall" else (baseline or {}).get("overall")
+        if base and base["throughput"]:
+            line += (f"   req/s {100 * (s['throughput'] / base['throughput'] - 1):+.1f}%"
+                     f"  p99 {100 * (s['p99_ms'] / base['p99_ms'] - 1) if base['p99_ms'] else 0:+.1f}%")
+        print(line)
+    for url, rss in result["node_rss_bytes"].items():
+        if rss:
+            print(f"{url} RSS {rss / 2 ** 20:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", action="append", default=[], help="node base URL; repeat for several nodes")
+    parser.add_argument("--nodes", type=int, default=3, help="local nodes to spawn when no --url is given")
+    parser.add_argument("--workers", type=int, default=1, help="HTTP worker processes per spawned node")
+    parser.add_argument("--http-port", type=int, default=18080)
+    parser.add_argument("--raft-port", type=int, default=19090)
+    parser.add_argument("--leader-only", action="store_true", help="send every request to the leader")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    parser.add_argument("--mix", default="create=5,status=3,list=2")
+    parser.add_argument("--replay", help="JSONL file of {method, path, body} requests to replay")
+    parser.add_argument("--printers", type=int, default=100)
+    parser.add_argument("--filaments", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
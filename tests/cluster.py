@@ -0,0 +1,74 @@
+import asyncio
+import json
+import socket
+import time
+from typing import List, Optional, Tuple
+
+from app.raft.fsm import Raft3DFSM
+from app.raft.raft import Raft
+
+
+# In-process Raft clusters for tests: every node runs its own raft loop on its
+# own thread and talks to the others over loopback TCP, as in production
+
+
+def free_ports(count: int) -> List[int]:
+    sockets = [socket.socket() for _ in range(count)]
+    for sock in sockets:
+        sock.bind(("127.0.0.1", 0))
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def make_nodes(raft_dir, size: int = 3, live: Optional[int] = None,
+               election_timeout: Tuple[float, float] = (0.3, 0.6)) -> List[Raft]:
+    # Unstarted nodes of a cluster of size, each with its own FSM and data
+    # directory under raft_dir; only the first live nodes are built, the
+    # others stay down
+    ports = free_ports(size)
+    peers = [f"127.0.0.1:{port}" for port in ports]
+    return [Raft(f"node{i + 1}", peers[i], peers, Raft3DFSM(), str(raft_dir / f"node{i + 1}"), ports[i],
+                 bind_host="127.0.0.1", election_timeout=election_timeout) for i in range(live or size)]
+
+
+def wait_for(condition, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def call(node: Raft, fn, *args):
+    # Runs fn on the node's raft loop and returns its result
+    async def run():
+        return fn(*args)
+    return asyncio.run_coroutine_threadsafe(run(), node.loop).result(timeout=5)
+
+
+def leader_of(nodes: List[Raft], timeout: float = 10.0) -> Raft:
+    # The one node leading, once all running nodes agree on it
+    running = [node for node in nodes if node.running]
+
+    def agreed():
+        leaders = [node for node in running if node.is_leader]
+        return len(leaders) == 1 and all(node.leader_addr == leaders[0].addr for node in running)
+
+    assert wait_for(agreed, timeout), "no leader elected"
+    return next(node for node in running if node.is_leader)
+
+
+def crash(node: Raft):
+    # Stops the node as if its process died: no leadership transfer first
+    async def no_transfer(*args, **kwargs):
+        return False
+    node.transfer_leadership = no_transfer
+    node.stop()
+
+
+def printer(printer_id: str) -> bytes:
+    return json.dumps({"op": "add_printer",
+                       "value": {"id": printer_id, "company": "Prusa", "model": "MK4"}}).encode()
@@ -0,0 +1,14 @@
+import pytest
+
+from tests.cluster import crash, make_nodes
+
+
+@pytest.fixture
+def cluster(tmp_path):
+    # A running three-node cluster with the default timeouts
+    nodes = make_nodes(tmp_path)
+    for node in nodes:
+        node.start()
+    yield nodes
+    for node in nodes:
+        crash(node)
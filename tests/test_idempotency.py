@@ -0,0 +1,143 @@
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import app.raft.fsm
+from app.api.handlers import router, set_raft_node
+from app.raft.fsm import IDEMPOTENCY_MISMATCH, IDEMPOTENCY_TTL_MS, Raft3DFSM
+from app.raft.store import FSMView, make_command
+
+HOUR_MS = 3600 * 1000
+
+
+def _printer(printer_id: str, model: str = "MK4") -> dict:
+    return {"id": printer_id, "company": "Prusa", "model": model}
+
+
+def _command(op: str, value: dict, key=None, fp="fp", ts=0) -> bytes:
+    cmd = {"op": op, "value": value}
+    if key is not None:
+        cmd.update(key=key, fp=fp, ts=ts)
+    return json.dumps(cmd).encode()
+
+
+def _apply(fsm: Raft3DFSM, command: bytes):
+    result, = fsm.apply_batch([command], fsm.applied_index + 1, 1)
+    return result
+
+
+def _table(fsm: Raft3DFSM):
+    return [(r.key, r.fingerprint, r.result, r.created_ms) for r in fsm.idempotency.values()]
+
+
+def test_retry_returns_the_stored_result_without_applying_again():
+    fsm = Raft3DFSM()
+    assert _apply(fsm, _command("add_printer", _printer("p1"), key="k1")) is True
+    # The FSM trusts the fingerprint; a body that changed would have been
+    # applied over the first one
+    assert _apply(fsm, _command("add_printer", _printer("p1", "XL"), key="k1")) is True
+    assert fsm.printers["p1"].model == "MK4"
+    assert fsm.applied_index == 2
+    assert _table(fsm) == [("k1", "fp", "true", 0)]
+
+
+def test_key_reused_for_a_different_request_is_refused():
+    fsm = Raft3DFSM()
+    assert _apply(fsm, _command("add_printer", _printer("p1"), key="k1", fp="a")) is True
+    assert _apply(fsm, _command("add_printer", _printer("p2"), key="k1", fp="b")) == IDEMPOTENCY_MISMATCH
+    assert list(fsm.printers) == ["p1"]
+    assert _table(fsm) == [("k1", "a", "true", 0)]
+
+
+def test_entries_expire_by_the_proposer_clock():
+    fsm = Raft3DFSM()
+    _apply(fsm, _command("add_printer", _printer("p1"), key="k1", ts=0))
+    _apply(fsm, _command("add_printer", _printer("p2"), key="k2", ts=HOUR_MS))
+    # A proposer with a clock behind the table's does not move it back
+    _apply(fsm, _command("add_printer", _printer("p3"), key="k3", ts=1))
+    assert [r.created_ms for r in fsm.idempotency.values()] == [0, HOUR_MS, HOUR_MS]
+    assert fsm.idempotency_clock == HOUR_MS
+
+    # Expiry happens when the next key is stored, never on a retry
+    assert _apply(fsm, _command("add_printer", _printer("p1"), key="k1", ts=IDEMPOTENCY_TTL_MS + 1)) is True
+    assert "k1" in fsm.idempotency
+    _apply(fsm, _command("add_printer", _printer("p4"), key="k4", ts=IDEMPOTENCY_TTL_MS + 1))
+    assert list(fsm.idempotency) == ["k2", "k3", "k4"]
+    # An expired key is a new request again
+    assert _apply(fsm, _command("add_printer", _printer("p5"), key="k1", fp="other",
+                                ts=IDEMPOTENCY_TTL_MS + 1)) is True
+    assert "p5" in fsm.printers
+
+
+def test_oldest_entries_are_evicted_past_the_key_limit(monkeypatch):
+    monkeypatch.setattr(app.raft.fsm, "IDEMPOTENCY_MAX_KEYS", 3)
+    fsm = Raft3DFSM()
+    for i in range(5):
+        _apply(fsm, _command("add_printer", _printer(f"p{i}"), key=f"k{i}", ts=i))
+    assert list(fsm.idempotency) == ["k2", "k3", "k4"]
+
+
+def test_replicas_fed_the_same_log_keep_the_same_table(monkeypatch):
+    monkeypatch.setattr(app.raft.fsm, "IDEMPOTENCY_MAX_KEYS", 4)
+    # Proposers on different nodes with skewed clocks, retries and reused keys
+    log = []
+    for i in range(12):
+        ts = (i * 7 % 5) * 7 * HOUR_MS
+        log.append(_command("add_printer", _printer(f"p{i}"), key=f"k{i % 6}", fp=f"fp{i % 6}", ts=ts))
+        if i % 3 == 0:
+            log.append(_command("add_printer", _printer(f"p{i}", "XL"), key=f"k{i % 6}", fp="other", ts=ts))
+        log.append(_command("add_printer", _printer(f"x{i}")))
+    replicas = [Raft3DFSM(), Raft3DFSM()]
+    results = [replica.apply_batch(log, len(log), 1) for replica in replicas]
+    assert results[0] == results[1]
+    assert IDEMPOTENCY_MISMATCH in results[0]
+    assert _table(replicas[0]) == _table(replicas[1])
+    assert replicas[0].idempotency_clock == replicas[1].idempotency_clock
+    assert replicas[0].printers.keys() == replicas[1].printers.keys()
+
+
+class _LocalNode(FSMView):
+    # Applies writes straight to an FSM of its own, as a one-node cluster
+    def __init__(self, fsm: Raft3DFSM):
+        self.fsm = fsm
+        self.proposed = 0
+
+    async def command_async(self, op: str, value: dict, idempotency=None):
+        self.proposed += 1
+        return _apply(self.fsm, json.dumps(make_command(op, value, idempotency)).encode())
+
+    def write_index(self) -> int:
+        return self.fsm.applied_index
+
+
+@pytest.fixture
+def node():
+    node = _LocalNode(Raft3DFSM())
+    set_raft_node(node)
+    try:
+        yield node
+    finally:
+        set_raft_node(None)
+
+
+def test_api_replays_a_retry_and_refuses_a_reused_key(node):
+    app_ = FastAPI()
+    app_.include_router(router, prefix="/api/v1")
+    client = TestClient(app_)
+    headers = {"Idempotency-Key": "k1"}
+
+    assert client.post("/api/v1/printers", json=_printer("p1"), headers=headers).status_code == 200
+    # The retry is answered from the table without another proposal, where
+    # without the key the duplicate id would be refused
+    response = client.post("/api/v1/printers", json=_printer("p1"), headers=headers)
+    assert response.status_code == 200
+    assert response.json()["id"] == "p1"
+    assert node.proposed == 1
+
+    response = client.post("/api/v1/printers", json=_printer("p2"), headers=headers)
+    assert response.status_code == 422
+    assert response.json()["detail"] == IDEMPOTENCY_MISMATCH
+    assert node.proposed == 1
+    assert list(node.fsm.printers) == ["p1"]
@@ -0,0 +1,106 @@
+import io
+import json
+
+import pytest
+
+from app.raft.fsm import FILAMENT_IN_USE, INSUFFICIENT_WEIGHT, Raft3DFSM
+from app.raft.snapshot import decode_snapshot, encode_snapshot
+
+
+def _command(op: str, value: dict) -> bytes:
+    return json.dumps({"op": op, "value": value}).encode()
+
+
+def _apply(fsm: Raft3DFSM, op: str, value: dict):
+    result, = fsm.apply_batch([_command(op, value)], fsm.applied_index + 1, 1)
+    return result
+
+
+def _submit(fsm: Raft3DFSM, job_id: str, grams: int, printer_id: str = "p1"):
+    return _apply(fsm, "submit_print_job", {"id": job_id, "printer_id": printer_id, "filament_id": "f1",
+                                            "filepath": "a.gcode", "print_weight_in_grams": grams,
+                                            "status": "Queued"})
+
+
+def _move(fsm: Raft3DFSM, job_id: str, *statuses: str):
+    for status in statuses:
+        assert _apply(fsm, "transition_print_job", {"job_id": job_id, "status": status}) is True
+
+
+def _ledger(fsm: Raft3DFSM):
+    return (fsm.reserved_grams.get("f1", 0), fsm.consumed_grams.get("f1", 0),
+            fsm.filaments["f1"].remaining_weight_in_grams)
+
+
+@pytest.fixture
+def fsm():
+    fsm = Raft3DFSM()
+    _apply(fsm, "add_printer", {"id": "p1", "company": "Prusa", "model": "MK4"})
+    _apply(fsm, "add_filament", {"id": "f1", "type": "PLA", "color": "red", "total_weight_in_grams": 1000,
+                                 "remaining_weight_in_grams": 1000})
+    assert _submit(fsm, "j1", 30) is True
+    assert _submit(fsm, "j2", 70) is True
+    return fsm
+
+
+def test_queued_jobs_reserve_their_weight(fsm):
+    assert _ledger(fsm) == (100, 0, 1000)
+    assert _submit(fsm, "big", 901) == INSUFFICIENT_WEIGHT
+    assert _submit(fsm, "fits", 900) is True
+    assert _ledger(fsm) == (1000, 0, 1000)
+
+
+def test_cancelled_releases_the_reservation(fsm):
+    _move(fsm, "j1", "Cancelled")
+    assert _ledger(fsm) == (70, 0, 1000)
+    # A running job holds its weight until it is cancelled too
+    _move(fsm, "j2", "Running")
+    assert _ledger(fsm) == (70, 0, 1000)
+    _move(fsm, "j2", "Cancelled")
+    assert _ledger(fsm) == (0, 0, 1000)
+
+
+def test_done_moves_the_reservation_to_consumed(fsm):
+    _move(fsm, "j1", "Running", "Done")
+    assert _ledger(fsm) == (70, 30, 970)
+    # The filament's remaining weight already excludes the consumed grams
+    assert _submit(fsm, "fits", 900) is True
+    assert _submit(fsm, "big", 1) == INSUFFICIENT_WEIGHT
+
+
+def test_archiving_keeps_the_ledger(fsm):
+    _move(fsm, "j1", "Running", "Done")
+    _move(fsm, "j2", "Cancelled")
+    assert _apply(fsm, "archive_jobs", {"job_ids": ["j1", "j2"]}) == 2
+    assert not fsm.print_jobs
+    assert _ledger(fsm) == (0, 30, 970)
+    assert fsm.archived_grams == {"f1": 30}
+
+
+def test_snapshot_restores_the_ledger(fsm):
+    _move(fsm, "j1", "Running", "Done")
+    assert _apply(fsm, "archive_jobs", {"job_ids": ["j1"]}) == 1
+    assert _submit(fsm, "j3", 50) is True
+    _move(fsm, "j3", "Running", "Done")
+    _move(fsm, "j2", "Running")
+    assert _ledger(fsm) == (70, 80, 920)
+
+    restored = Raft3DFSM()
+    restored.restore(decode_snapshot(io.BytesIO(b"".join(encode_snapshot(fsm.snapshot())))))
+    assert _ledger(restored) == (70, 80, 920)
+    assert restored.archived_grams == {"f1": 30}
+    # The restored ledger keeps working
+    _move(restored, "j2", "Done")
+    assert _ledger(restored) == (0, 150, 850)
+
+
+def test_spool_running_on_another_printer_cannot_start(fsm):
+    _apply(fsm, "add_printer", {"id": "p2", "company": "Prusa", "model": "MK4"})
+    assert _submit(fsm, "j3", 20, printer_id="p2") is True
+    _move(fsm, "j1", "Running")
+    # p2 is idle, but f1 is loaded in p1
+    assert _apply(fsm, "transition_print_job", {"job_id": "j3", "status": "Running"}) == FILAMENT_IN_USE
+    assert fsm.print_jobs["j3"].status == "Queued"
+    _move(fsm, "j1", "Done")
+    _move(fsm, "j3", "Running")
+    assert _ledger(fsm) == (90, 30, 970)
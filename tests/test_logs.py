@@ -0,0 +1,131 @@
+import json
+import queue
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from prometheus_client import REGISTRY
+
+from app.monitoring.logs import JSONFormatter, LokiShipper, RateLimitFilter, _NonBlockingQueueHandler
+
+
+def _dropped(reason: str) -> float:
+    return REGISTRY.get_sample_value("raft3d_log_dropped_total", {"reason": reason}) or 0.0
+
+
+def _record(message: str, level: int = logging.INFO) -> logging.LogRecord:
+    return logging.LogRecord("raft3d", level, __file__, 0, message, None, None)
+
+
+class StubLoki:
+    # Records the bodies POSTed to /loki/api/v1/push; answers with `status`
+    def __init__(self, status: int = 204):
+        self.pushes = []
+        self.status = status
+        self.received = threading.Event()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                stub.pushes.append((self.path, json.loads(body)))
+                self.send_response(stub.status)
+                self.end_headers()
+                stub.received.set()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def loki():
+    stub = StubLoki()
+    yield stub
+    stub.close()
+
+
+def test_loki_shipper_sends_full_batches(loki):
+    shipper = LokiShipper(loki.url, {"app": "raft3d", "node": "node1"}, batch_size=5, flush_interval=60)
+    shipper.setFormatter(JSONFormatter("node1"))
+    try:
+        for i in range(5):
+            shipper.handle(_record(f"record {i}"))
+        # A full batch goes out without waiting for the flush interval
+        assert loki.received.wait(5)
+        path, body = loki.pushes[0]
+        assert path == "/loki/api/v1/push"
+        stream, = body["streams"]
+        assert stream["stream"] == {"app": "raft3d", "node": "node1"}
+        assert [json.loads(line)["msg"] for _, line in stream["values"]] == [f"record {i}" for i in range(5)]
+
+        # A partial batch waits for the interval or, here, for close()
+        loki.received.clear()
+        for i in range(5, 8):
+            shipper.handle(_record(f"record {i}"))
+        assert not loki.received.wait(0.2)
+    finally:
+        shipper.close()
+    assert len(loki.pushes) == 2
+    assert [json.loads(line)["msg"] for _, line in loki.pushes[1][1]["streams"][0]["values"]] == \
+        ["record 5", "record 6", "record 7"]
+
+
+def test_loki_shipper_drops_oldest_past_max_pending():
+    stub = StubLoki(status=500)
+    shipper = LokiShipper(stub.url, {"app": "raft3d"}, batch_size=1000, flush_interval=60, max_pending=3)
+    shipper.setFormatter(JSONFormatter())
+    before = _dropped("loki")
+    try:
+        for i in range(5):
+            shipper.handle(_record(f"record {i}"))
+        shipper.flush()
+        assert _dropped("loki") - before == 2
+        assert [json.loads(line)["msg"] for _, line in shipper.pending] == ["record 2", "record 3", "record 4"]
+    finally:
+        shipper.running = False
+        shipper.wake.set()
+        shipper.thread.join()
+        stub.close()
+
+
+def test_full_queue_drops_instead_of_blocking():
+    # Nothing drains the queue, as when the listener thread is stuck behind
+    # a slow Loki push
+    handler = _NonBlockingQueueHandler(queue.Queue(3))
+    before = _dropped("queue_full")
+    start = time.monotonic()
+    for i in range(10):
+        handler.handle(_record(f"record {i}"))
+    assert time.monotonic() - start < 1
+    assert handler.queue.qsize() == 3
+    assert _dropped("queue_full") - before == 7
+
+
+def test_rate_limit_lets_warnings_and_errors_through():
+    limiter = RateLimitFilter(rate=0.001, burst=2, samples=[("noisy", 0.0)])
+    before = _dropped("rate_limited")
+    passed = [limiter.filter(_record("noisy %s")) for _ in range(5)]
+    # The sample probability of 0 drops every INFO record before the bucket
+    assert passed == [False] * 5
+    passed = [limiter.filter(_record("busy %s")) for _ in range(5)]
+    assert passed == [True, True, False, False, False]
+    assert _dropped("rate_limited") - before == 3
+
+    for level in (logging.WARNING, logging.ERROR):
+        for template in ("noisy %s", "busy %s"):
+            assert all(limiter.filter(_record(template, level)) for _ in range(50))
+    assert _dropped("rate_limited") - before == 3
@@ -0,0 +1,181 @@
+import json
+from itertools import islice
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.handlers import router, set_raft_node
+from app.raft.archive import JobArchive
+from app.raft.fsm import KeySequence, Raft3DFSM
+from app.raft.store import FSMView
+
+
+def _command(op: str, value: dict) -> bytes:
+    return json.dumps({"op": op, "value": value}).encode()
+
+
+def _apply(fsm: Raft3DFSM, *commands: bytes):
+    results = fsm.apply_batch(list(commands), fsm.applied_index + len(commands), 1)
+    assert all(result is True or isinstance(result, (int, list)) for result in results), results
+
+
+def _fsm(jobs: int) -> Raft3DFSM:
+    fsm = Raft3DFSM()
+    _apply(fsm,
+           _command("add_printer", {"id": "p1", "company": "Prusa", "model": "MK4"}),
+           _command("add_filament", {"id": "f1", "type": "PLA", "color": "red", "total_weight_in_grams": 100000,
+                                     "remaining_weight_in_grams": 100000}))
+    _apply(fsm, *[_command("add_print_job", {"id": f"j{i:03d}", "printer_id": "p1", "filament_id": "f1",
+                                             "filepath": "a.gcode", "print_weight_in_grams": 1,
+                                             "status": "Cancelled"})
+                  for i in range(jobs)])
+    return fsm
+
+
+def _page(fsm: Raft3DFSM, status=None, after=None, limit: int = 3):
+    return [job.id for job in islice(fsm.iter_print_jobs(status, after), limit)]
+
+
+def _archive(fsm: Raft3DFSM, *job_ids: str):
+    _apply(fsm, _command("archive_jobs", {"job_ids": list(job_ids)}))
+
+
+def test_key_sequence_discard_forgets_and_retire_keeps_position():
+    keys = KeySequence(["a", "b", "c", "d"])
+    keys.discard("b")
+    keys.retire("c")
+    assert list(keys) == ["a", "d"]
+    assert len(keys) == 2
+    with pytest.raises(KeyError):
+        keys.start("b")
+    assert list(keys.iter_from(keys.start("c"))) == ["d"]
+    # A retired key added back goes to the end
+    keys.add("c")
+    assert list(keys) == ["a", "d", "c"]
+
+
+def test_key_sequence_compaction_keeps_recent_cursors():
+    keys = KeySequence(["a", "b", "c", "d", "e"])
+    keys.retire("b")
+    keys.retire("d")
+    compact = keys.compacted()
+    assert compact.holes == 0
+    assert list(compact) == ["a", "c", "e"]
+    assert list(compact.iter_from(compact.start("b"))) == ["c", "e"]
+    assert list(compact.iter_from(compact.start("d"))) == ["e"]
+    # Keys retired before the previous compaction are forgotten
+    compact.retire("c")
+    again = compact.compacted()
+    assert list(again.iter_from(again.start("c"))) == ["e"]
+    with pytest.raises(KeyError):
+        again.start("b")
+
+
+def test_pages_skip_jobs_archived_between_them():
+    fsm = _fsm(10)
+    first = _page(fsm)
+    assert first == ["j000", "j001", "j002"]
+    _archive(fsm, "j003", "j004")
+    assert _page(fsm, after=first[-1]) == ["j005", "j006", "j007"]
+    assert _page(fsm, "Cancelled", after=first[-1]) == ["j005", "j006", "j007"]
+
+
+def test_cursor_naming_an_archived_job_is_unknown():
+    fsm = _fsm(5)
+    _archive(fsm, "j002")
+    with pytest.raises(KeyError):
+        fsm.iter_print_jobs(None, "j002")
+    with pytest.raises(KeyError):
+        fsm.iter_print_jobs("Cancelled", "j002")
+    with pytest.raises(KeyError):
+        fsm.iter_print_jobs(None, "nope")
+
+
+def test_status_cursor_survives_its_job_changing_status():
+    fsm = Raft3DFSM()
+    _apply(fsm,
+           _command("add_printer", {"id": "p1", "company": "Prusa", "model": "MK4"}),
+           _command("add_filament", {"id": "f1", "type": "PLA", "color": "red", "total_weight_in_grams": 1000,
+                                     "remaining_weight_in_grams": 1000}))
+    _apply(fsm, *[_command("submit_print_job", {"id": f"j{i}", "printer_id": "p1", "filament_id": "f1",
+                                                "filepath": "a.gcode", "print_weight_in_grams": 1,
+                                                "status": "Queued"})
+                  for i in range(6)])
+    first = _page(fsm, "Queued")
+    assert first == ["j0", "j1", "j2"]
+    # The cursor job and one ahead of it leave Queued before the next page
+    _apply(fsm, _command("transition_print_job", {"job_id": "j2", "status": "Cancelled"}),
+           _command("transition_print_job", {"job_id": "j4", "status": "Cancelled"}))
+    assert _page(fsm, "Queued", after="j2") == ["j3", "j5"]
+    assert _page(fsm, "Cancelled") == ["j2", "j4"]
+
+
+def test_status_cursor_survives_compaction():
+    fsm = _fsm(0)
+    count = 3000
+    _apply(fsm, *[_command("submit_print_job", {"id": f"j{i:04d}", "printer_id": "p1", "filament_id": "f1",
+                                                "filepath": "a.gcode", "print_weight_in_grams": 1,
+                                                "status": "Queued"})
+                  for i in range(count)])
+    # Cancelling most jobs leaves enough holes to compact the Queued sequence
+    before = fsm.jobs_by_status["Queued"]
+    _apply(fsm, *[_command("transition_print_job", {"job_id": f"j{i:04d}", "status": "Cancelled"})
+                  for i in range(count) if i % 10])
+    assert fsm.jobs_by_status["Queued"] is not before
+    assert fsm.jobs_by_status["Queued"].holes < before.holes
+    assert _page(fsm, "Queued", after="j1234") == ["j1240", "j1250", "j1260"]
+
+
+class _LocalNode(FSMView):
+    # Serves the read endpoints from an FSM and archive of its own
+    def __init__(self, fsm: Raft3DFSM, archive: JobArchive):
+        self.fsm = fsm
+        self.archive = archive
+
+
+@pytest.fixture
+def client(tmp_path):
+    fsm = _fsm(5)
+    archive = JobArchive(str(tmp_path / "archive"))
+    fsm.archive_sink = archive.append
+    _archive(fsm, "j000", "j001")
+    archive.flush()
+    app = FastAPI()
+    app.include_router(router, prefix="/api/v1")
+    set_raft_node(_LocalNode(fsm, archive))
+    try:
+        yield TestClient(app)
+    finally:
+        set_raft_node(None)
+        archive.close()
+
+
+def test_listing_follows_the_next_cursor(client):
+    response = client.get("/api/v1/print_jobs", params={"limit": 2})
+    assert [job["id"] for job in response.json()] == ["j002", "j003"]
+    assert response.headers["X-Next-After"] == "j003"
+    response = client.get("/api/v1/print_jobs", params={"limit": 2, "after": "j003"})
+    assert [job["id"] for job in response.json()] == ["j004"]
+    assert "X-Next-After" not in response.headers
+
+    response = client.get("/api/v1/archive/print_jobs", params={"limit": 1})
+    assert [job["id"] for job in response.json()] == ["j000"]
+    response = client.get("/api/v1/archive/print_jobs", params={"after": response.headers["X-Next-After"]})
+    assert [job["id"] for job in response.json()] == ["j001"]
+
+
+@pytest.mark.parametrize("path, params", [
+    ("/api/v1/print_jobs", {"after": "missing"}),
+    ("/api/v1/print_jobs", {"after": "j000"}),
+    ("/api/v1/print_jobs", {"status": "Cancelled", "after": "j001"}),
+    ("/api/v1/print_jobs", {"after": "missing", "format": "ndjson"}),
+    ("/api/v1/printers", {"after": "missing"}),
+    ("/api/v1/filaments", {"after": "missing"}),
+    ("/api/v1/archive/print_jobs", {"after": "not-a-cursor"}),
+    ("/api/v1/archive/print_jobs", {"after": "999.0"}),
+])
+def test_unknown_cursor_is_a_bad_request(client, path, params):
+    response = client.get(path, params=params)
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Unknown cursor in 'after'"
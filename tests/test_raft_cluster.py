@@ -0,0 +1,51 @@
+from tests.cluster import crash, leader_of, printer, wait_for
+
+
+def _converged(nodes, printer_ids) -> bool:
+    return all(set(node.fsm.printers) == set(printer_ids) for node in nodes)
+
+
+def test_writes_replicate_to_every_node(cluster):
+    leader = leader_of(cluster)
+    followers = [node for node in cluster if node is not leader]
+
+    assert leader.apply(printer("p1"))
+    # A follower forwards the write to the leader and answers once it commits
+    assert followers[0].apply(printer("p2"))
+    assert followers[1].apply(printer("p3"))
+
+    assert wait_for(lambda: _converged(cluster, ["p1", "p2", "p3"]))
+    assert len({node.fsm.applied_index for node in cluster}) == 1
+    assert len({node.log.last_index for node in cluster}) == 1
+
+
+def test_new_leader_commits_after_leader_stops(cluster):
+    leader = leader_of(cluster)
+    assert leader.apply(printer("p1"))
+    assert wait_for(lambda: _converged(cluster, ["p1"]))
+
+    crash(leader)
+    survivors = [node for node in cluster if node is not leader]
+    successor = leader_of(survivors)
+    assert successor.term > leader.term
+    follower = next(node for node in survivors if node is not successor)
+
+    # Two of three nodes are still a majority
+    assert successor.apply(printer("p2"))
+    assert follower.apply(printer("p3"))
+    assert wait_for(lambda: _converged(survivors, ["p1", "p2", "p3"]))
+    assert "p2" not in leader.fsm.printers
+
+
+def test_leader_publishes_its_lease_and_read_index(cluster):
+    leader = leader_of(cluster)
+    assert leader.apply(printer("p1"))
+    # Published before the write's waiter was resolved
+    assert leader.read_state[1] >= leader.fsm.applied_index
+    assert wait_for(leader.lease_valid)
+    assert all(node.read_state[0] == 0.0 for node in cluster if node is not leader)
+
+    crash(leader)
+    successor = leader_of([node for node in cluster if node is not leader])
+    assert wait_for(successor.lease_valid)
+    assert successor.read_state[1] >= successor.fsm.applied_index
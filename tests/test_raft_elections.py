@@ -0,0 +1,175 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app.raft.raft import CANDIDATE, FOLLOWER
+from tests.cluster import call, crash, leader_of, make_nodes, printer, wait_for
+
+
+@pytest.fixture
+def two_of_three(tmp_path):
+    # A three-node cluster with its third node down, so each election needs
+    # both live nodes. Timeouts start long enough that nobody campaigns
+    # before a test is ready.
+    nodes = make_nodes(tmp_path, live=2, election_timeout=(30.0, 31.0))
+    for node in nodes:
+        node.start()
+    yield nodes
+    for node in nodes:
+        node.stop()
+
+
+@pytest.fixture
+def one_of_three(tmp_path):
+    # A three-node cluster with only this node up, which can never win
+    node, = make_nodes(tmp_path, live=1, election_timeout=(30.0, 31.0))
+    node.start()
+    yield node
+    node.stop()
+
+
+def _resume_timers(nodes):
+    for node in nodes:
+        node.election_timeout = (0.3, 0.6)
+        node.lease_duration = 0.3 * 0.9
+        node.loop.call_soon_threadsafe(node.heartbeat.set)
+
+
+def test_split_vote_is_followed_by_a_new_election(two_of_three):
+    nodes = two_of_three
+    # Both campaign for the same term and vote for themselves before either
+    # loop can read the other's request, so neither can win it
+    barrier = threading.Barrier(len(nodes))
+
+    def campaign(node):
+        barrier.wait()
+        node._start_election()
+
+    for node in nodes:
+        node.loop.call_soon_threadsafe(campaign, node)
+    assert wait_for(lambda: all(node.role == CANDIDATE and node.term == 1 for node in nodes))
+    assert wait_for(lambda: all(node.votes == {node.addr} for node in nodes))
+    time.sleep(0.2)
+    assert not any(node.is_leader for node in nodes)
+
+    _resume_timers(nodes)
+    assert wait_for(lambda: sum(node.is_leader for node in nodes) == 1, timeout=10)
+    leader = next(node for node in nodes if node.is_leader)
+    assert leader.term > 1
+    assert wait_for(lambda: all(node.leader_addr == leader.addr for node in nodes))
+
+
+def test_lease_reads_stay_off_after_timeout_now(two_of_three):
+    nodes = two_of_three
+    _resume_timers(nodes)
+    assert wait_for(lambda: any(node.is_leader for node in nodes))
+    leader = next(node for node in nodes if node.is_leader)
+    follower = next(node for node in nodes if node is not leader)
+    assert wait_for(leader.lease_valid)
+
+    # The target receives TimeoutNow but does not act on it before the
+    # transfer gives up, so this node is still leading afterwards
+    follower._on_timeout_now = lambda msg: None
+    transfer = asyncio.run_coroutine_threadsafe(
+        leader.transfer_leadership(follower.addr, timeout=0.2), leader.loop)
+    assert transfer.result(timeout=5) is False
+    assert leader.is_leader
+    assert not call(leader, leader.lease_valid)
+    time.sleep(leader.lease_duration / 2)
+    assert not call(leader, leader.lease_valid)
+    assert wait_for(leader.lease_valid, timeout=5)
+
+
+def test_failed_candidate_campaigns_again_as_a_follower(one_of_three):
+    node = one_of_three
+    peer = node.peers[0]
+    call(node, node._start_election)
+    assert (node.role, node.term) == (CANDIDATE, 1)
+
+    # The election timer fires again with no winner
+    call(node, node._start_pre_vote)
+    assert node.role == FOLLOWER
+    assert node.pre_votes == {node.addr}
+    # A granted pre-vote is a majority with our own, so a real election
+    # follows; a node left as a candidate ignored it and stayed stuck
+    call(node, node._handle, {"type": "pre_vote_resp", "term": node.term, "from": peer, "granted": True})
+    assert (node.role, node.term) == (CANDIDATE, 2)
+
+
+def test_new_leader_soon_after_the_leader_crashes(cluster):
+    leader = leader_of(cluster)
+    assert leader.apply(printer("p1"))
+    survivors = [node for node in cluster if node is not leader]
+    start = time.monotonic()
+    crash(leader)
+    successor = leader_of(survivors)
+    # One election timeout (at most 0.6 s) plus a pre-vote and a vote round
+    assert time.monotonic() - start < 2.0
+    assert successor.term == leader.term + 1
+    assert successor.apply(printer("p2"))
+
+
+def _terms(nodes):
+    return [node.term for node in nodes]
+
+
+def test_stalled_follower_does_not_depose_the_leader(cluster):
+    leader = leader_of(cluster)
+    follower = next(node for node in cluster if node is not leader)
+    terms = _terms(cluster)
+    # A GC pause or a long apply: the follower's loop does nothing for 1.5 s,
+    # several election timeouts
+    follower.loop.call_soon_threadsafe(time.sleep, 1.5)
+    time.sleep(2.0)
+    assert leader_of(cluster) is leader
+    assert _terms(cluster) == terms
+    assert leader.apply(printer("p1"))
+    assert wait_for(lambda: "p1" in follower.fsm.printers)
+
+
+def test_partitioned_follower_does_not_depose_the_leader(cluster):
+    leader = leader_of(cluster)
+    follower = next(node for node in cluster if node is not leader)
+    terms = _terms(cluster)
+
+    async def unreachable(addr, msg):
+        return False
+
+    # Cut the follower off both ways for 2 s: what it receives is ignored
+    # and what it sends is lost. Its pre-votes go unanswered, so it never
+    # raises its term.
+    transport = follower.transport
+    send = transport.send
+    call(follower, setattr, transport, "handler", lambda msg: None)
+    call(follower, setattr, transport, "send", unreachable)
+    assert leader.apply(printer("p1"))
+    time.sleep(2.0)
+    assert follower.role == FOLLOWER
+    assert _terms(cluster) == terms
+    call(follower, setattr, transport, "handler", follower._handle)
+    call(follower, setattr, transport, "send", send)
+
+    assert wait_for(lambda: "p1" in follower.fsm.printers)
+    assert leader_of(cluster) is leader
+    assert _terms(cluster) == terms
+
+
+def test_writes_in_flight_during_a_transfer_all_succeed(cluster):
+    leader = leader_of(cluster)
+
+    async def writes():
+        first = [asyncio.ensure_future(leader.apply_async(printer(f"p{i}"))) for i in range(100)]
+        await asyncio.sleep(0)
+        transfer = asyncio.wrap_future(asyncio.run_coroutine_threadsafe(leader.transfer_leadership(), leader.loop))
+        # Proposals made during the transfer wait, then go to the new leader
+        rest = [asyncio.ensure_future(leader.apply_async(printer(f"p{i}"))) for i in range(100, 200)]
+        return await transfer, await asyncio.gather(*first, *rest)
+
+    transferred, results = asyncio.run(writes())
+    assert transferred
+    assert results == [True] * 200
+    successor = leader_of(cluster)
+    assert successor is not leader
+    assert wait_for(lambda: all(len(node.fsm.printers) == 200 for node in cluster))
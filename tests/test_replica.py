@@ -0,0 +1,43 @@
+import asyncio
+import socket
+
+from app.raft.replica import _WorkerConnection, _apply_frame
+
+
+async def _connection(max_buffer: int):
+    ours, theirs = socket.socketpair()
+    reader, writer = await asyncio.open_connection(sock=ours)
+    peer_reader, peer_writer = await asyncio.open_connection(sock=theirs)
+    return _WorkerConnection(writer, max_buffer), peer_reader, peer_writer
+
+
+def test_frames_held_during_the_snapshot_follow_it():
+    async def run():
+        conn, peer, peer_writer = await _connection(1024)
+        frames = [_apply_frame([b"x" * 10], index, 1) for index in (1, 2)]
+        for frame in frames:
+            conn.send(frame)
+        assert conn.held_bytes == sum(map(len, frames))
+        conn.release()
+        assert await peer.readexactly(sum(map(len, frames))) == b"".join(frames)
+        assert conn.held == [] and conn.held_bytes == 0
+        conn.writer.close()
+        peer_writer.close()
+    asyncio.run(run())
+
+
+def test_connection_is_dropped_once_held_frames_pass_the_cap():
+    async def run():
+        conn, peer, peer_writer = await _connection(100)
+        conn.send(_apply_frame([b"x" * 40], 1, 1))
+        assert not conn.writer.is_closing()
+        conn.send(_apply_frame([b"x" * 40], 2, 1))
+        # Nothing more is kept; the worker sees the connection close and
+        # resyncs from a new snapshot
+        assert conn.writer.is_closing()
+        assert conn.held == [] and conn.held_bytes == 0
+        conn.send(_apply_frame([b"x" * 40], 3, 1))
+        assert conn.held == []
+        assert await peer.read() == b""
+        peer_writer.close()
+    asyncio.run(run())
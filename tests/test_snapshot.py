@@ -0,0 +1,149 @@
+import base64
+import io
+import json
+import os
+import zlib
+
+import pytest
+
+from app.raft.fsm import Raft3DFSM
+from app.raft.snapshot import (COUNT, END, ENTITY_FIELDS_V1, HEADER, INDEX_TERM, KIND, MAGIC_V1, SnapshotManager,
+                               _frame, _pack_entity, decode_snapshot, encode_snapshot, read_snapshot_header)
+from tests.cluster import call, make_nodes, wait_for
+
+
+def _command(op: str, value: dict) -> bytes:
+    return json.dumps({"op": op, "value": value}).encode()
+
+
+def _fsm() -> Raft3DFSM:
+    fsm = Raft3DFSM()
+    fsm.apply_batch([
+        _command("add_printer", {"id": "p1", "company": "Prusa", "model": "MK4"}),
+        _command("add_filament", {"id": "f1", "type": "PLA", "color": "red", "total_weight_in_grams": 1000,
+                                  "remaining_weight_in_grams": 1000}),
+        _command("submit_print_job", {"id": "j1", "printer_id": "p1", "filament_id": "f1", "filepath": "a.gcode",
+                                      "print_weight_in_grams": 30, "status": "Queued", "priority": 5}),
+        _command("submit_print_job", {"id": "j2", "printer_id": "p1", "filament_id": "f1", "filepath": "b.gcode",
+                                      "print_weight_in_grams": 70, "status": "Queued"}),
+        _command("transition_print_job", {"job_id": "j1", "status": "Running"}),
+        _command("transition_print_job", {"job_id": "j1", "status": "Done"}),
+        json.dumps({"op": "add_printer", "value": {"id": "p2", "company": "Bambu", "model": "X1"},
+                    "key": "k1", "fp": "fp1", "ts": 1000}).encode(),
+        _command("archive_jobs", {"job_ids": ["j1"]}),
+    ], 8, 2)
+    return fsm
+
+
+def _dicts(records):
+    return [record.to_dict() for record in records]
+
+
+def _assert_same_state(fsm: Raft3DFSM, restored: Raft3DFSM):
+    assert (restored.applied_index, restored.applied_term) == (fsm.applied_index, fsm.applied_term)
+    for name in ("printers", "filaments", "print_jobs", "idempotency"):
+        assert _dicts(getattr(restored, name).values()) == _dicts(getattr(fsm, name).values())
+    assert restored.reserved_grams == fsm.reserved_grams
+    assert restored.consumed_grams == fsm.consumed_grams
+    assert restored.archived_grams == fsm.archived_grams
+
+
+def test_binary_snapshot_round_trip():
+    fsm = _fsm()
+    data = b"".join(encode_snapshot(fsm.snapshot()))
+    restored = Raft3DFSM()
+    restored.restore(decode_snapshot(io.BytesIO(data)))
+    _assert_same_state(fsm, restored)
+    assert restored.print_jobs["j2"].priority == 0
+    assert restored.archived_grams == {"f1": 30}
+
+
+def test_version_1_snapshot_loads_without_priorities():
+    fsm = _fsm()
+    state = fsm.snapshot()
+    # Written the way version 1 did, with no priority field on jobs
+    records = [_pack_entity(kind, cls, codes, record)
+               for kind, (key, cls, codes) in ENTITY_FIELDS_V1.items() for record in state[key]]
+    data = MAGIC_V1 + _frame(KIND.pack(HEADER) + INDEX_TERM.pack(state["index"], state["term"])) + \
+        b"".join(_frame(record) for record in records) + _frame(KIND.pack(END) + COUNT.pack(len(records)))
+
+    restored = Raft3DFSM()
+    restored.restore(decode_snapshot(io.BytesIO(data)))
+    assert _dicts(restored.print_jobs.values()) == _dicts(fsm.print_jobs.values())
+    assert _dicts(restored.printers.values()) == _dicts(fsm.printers.values())
+
+
+def test_legacy_json_snapshot_loads():
+    fsm = _fsm()
+    legacy = {
+        "index": fsm.applied_index,
+        "term": fsm.applied_term,
+        "printers": {r.id: r.to_dict() for r in fsm.printers.values()},
+        "filaments": {r.id: r.to_dict() for r in fsm.filaments.values()},
+        "print_jobs": {r.id: {k: v for k, v in r.to_dict().items() if k != "priority"}
+                       for r in fsm.print_jobs.values()},
+    }
+    restored = Raft3DFSM()
+    restored.restore(decode_snapshot(io.BytesIO(json.dumps(legacy).encode())))
+    assert (restored.applied_index, restored.applied_term) == (8, 2)
+    assert _dicts(restored.print_jobs.values()) == _dicts(fsm.print_jobs.values())
+    assert restored.reserved_grams == {"f1": 70}
+
+
+def test_truncated_or_corrupt_snapshot_is_rejected():
+    data = b"".join(encode_snapshot(_fsm().snapshot()))
+    with pytest.raises(ValueError, match="truncated"):
+        decode_snapshot(io.BytesIO(data[:-3]))
+    damaged = bytearray(data)
+    damaged[len(data) // 2] ^= 0xFF
+    with pytest.raises(ValueError):
+        decode_snapshot(io.BytesIO(bytes(damaged)))
+
+
+def test_old_snapshots_are_pruned(tmp_path):
+    fsm = _fsm()
+    manager = SnapshotManager(fsm, str(tmp_path), retain=3)
+    for step in range(5):
+        fsm.apply_batch([_command("add_printer", {"id": f"q{step}", "company": "Prusa", "model": "MK4"})],
+                        fsm.applied_index + 1, 2)
+        manager.take_snapshot()
+        # Snapshots are ordered by mtime, which may not tick between takes
+        os.utime(os.path.join(tmp_path, manager._snapshot_files()[-1]), (step, step))
+
+    assert [read_snapshot_header(os.path.join(tmp_path, name))[0] for name in manager._snapshot_files()] == \
+        [11, 12, 13]
+    restored = Raft3DFSM()
+    assert SnapshotManager(restored, str(tmp_path)).load_latest()
+    _assert_same_state(fsm, restored)
+
+
+def test_install_snapshot_rejects_a_damaged_chunk(tmp_path):
+    # One follower of a cluster whose leader never runs; messages are fed to
+    # its handler directly
+    node, = make_nodes(tmp_path, live=1, election_timeout=(30.0, 31.0))
+    node.snapshots = SnapshotManager(node.fsm, node.raft_dir)
+    node.start()
+    try:
+        fsm = _fsm()
+        data = b"".join(encode_snapshot(fsm.snapshot()))
+        half = len(data) // 2
+
+        def chunk(offset: int, body: bytes, crc: int) -> dict:
+            return {"type": "install_snapshot", "term": 2, "from": "127.0.0.1:1", "last_index": 8,
+                    "last_term": 2, "offset": offset, "size": len(data),
+                    "data": base64.b64encode(body).decode(), "crc": crc, "sent": 0.0}
+
+        damaged = bytes([data[0] ^ 0xFF]) + data[1:half]
+        assert call(node, node._handle, chunk(0, damaged, zlib.crc32(data[:half])))["offset"] == 0
+        assert call(node, node._handle, chunk(0, data[:half], zlib.crc32(data[:half])))["offset"] == half
+        # A damaged last chunk is asked for again rather than installed
+        rest = data[half:]
+        damaged = rest[:-1] + bytes([rest[-1] ^ 0xFF])
+        assert call(node, node._handle, chunk(half, damaged, zlib.crc32(rest)))["offset"] == half
+        assert call(node, node._handle, chunk(half, rest, zlib.crc32(rest))) is None
+
+        assert wait_for(lambda: node.last_applied == 8 and not node.installing)
+        _assert_same_state(fsm, node.fsm)
+        assert (node.log.base_index, node.log.base_term) == (8, 2)
+    finally:
+        node.stop()
@@ -0,0 +1,125 @@
+import os
+
+from app.raft.wal import RECORD_HEADER, WriteAheadLog
+
+
+def _entries(first: int, count: int, term: int = 1):
+    return [{"t": term, "c": f"command {i}"} for i in range(first, first + count)]
+
+
+def _segment_files(wal_dir):
+    return sorted(name for name in os.listdir(wal_dir) if name.endswith(".wal"))
+
+
+def _reopen(wal_dir, segment_bytes: int = 16 * 1024 * 1024):
+    wal = WriteAheadLog(str(wal_dir), segment_bytes)
+    return wal, wal.load()
+
+
+def _write(wal_dir, batches, segment_bytes: int = 16 * 1024 * 1024):
+    # Appends each batch with a commit marker through its last entry and
+    # returns the size of the newest segment after each batch
+    wal, _ = _reopen(wal_dir, segment_bytes)
+    sizes = []
+    for batch in batches:
+        wal.append(batch, wal.last_index + len(batch))
+        sizes.append(wal.size)
+    wal.close()
+    return sizes
+
+
+def test_reopen_returns_what_was_appended(tmp_path):
+    _write(tmp_path, [_entries(1, 3), [{"t": 2, "c": None}], _entries(5, 2, term=2)])
+    wal, (base_index, base_term, entries, commit_index) = _reopen(tmp_path)
+    assert (base_index, base_term, commit_index) == (0, 0, 6)
+    assert entries == _entries(1, 3) + [{"t": 2, "c": None}] + _entries(5, 2, term=2)
+    assert (wal.last_index, wal.last_term) == (6, 2)
+    wal.close()
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    sizes = _write(tmp_path, [_entries(1, 3), _entries(4, 3)])
+    path = os.path.join(tmp_path, _segment_files(tmp_path)[-1])
+    # The last record, the second batch's commit marker, only half made it
+    with open(path, "r+b") as f:
+        f.truncate(sizes[-1] - 5)
+
+    wal, (_, _, entries, commit_index) = _reopen(tmp_path)
+    assert entries == _entries(1, 6)
+    # Only the first batch's marker survived
+    assert commit_index == 3
+    # The torn bytes are cut off, so new records follow the valid prefix
+    wal.append(_entries(7, 1), 7)
+    wal.close()
+    _, (_, _, entries, commit_index) = _reopen(tmp_path)
+    assert entries == _entries(1, 7)
+    assert commit_index == 7
+
+
+def test_crc_mismatch_drops_the_record_and_everything_after_it(tmp_path):
+    sizes = _write(tmp_path, [_entries(1, 3), _entries(4, 3)])
+    path = os.path.join(tmp_path, _segment_files(tmp_path)[-1])
+    # Flip a byte inside the payload of the second batch's first entry
+    with open(path, "r+b") as f:
+        f.seek(sizes[0] + RECORD_HEADER.size + 20)
+        byte = f.read(1)
+        f.seek(-1, os.SEEK_CUR)
+        f.write(bytes([byte[0] ^ 0xFF]))
+
+    wal, (_, _, entries, commit_index) = _reopen(tmp_path)
+    assert entries == _entries(1, 3)
+    assert commit_index == 3
+    assert os.path.getsize(path) == sizes[0]
+    assert wal.last_index == 3
+    wal.close()
+
+
+def test_corrupt_segment_discards_later_segments(tmp_path):
+    # Each batch outgrows a 64-byte segment, so the next one starts a new one
+    _write(tmp_path, [_entries(1, 3), _entries(4, 3), _entries(7, 3)], segment_bytes=64)
+    names = _segment_files(tmp_path)
+    assert len(names) == 3
+    # The middle segment loses the end of its commit marker
+    with open(os.path.join(tmp_path, names[1]), "r+b") as f:
+        f.truncate(os.path.getsize(os.path.join(tmp_path, names[1])) - 1)
+
+    wal, (_, _, entries, commit_index) = _reopen(tmp_path, segment_bytes=64)
+    # Entries after a gap cannot be trusted, so the third segment goes too
+    assert entries == _entries(1, 6)
+    assert commit_index == 3
+    assert _segment_files(tmp_path) == names[:2]
+    wal.close()
+
+
+def test_segments_roll_over_and_compaction_deletes_covered_ones(tmp_path):
+    wal, _ = _reopen(tmp_path, segment_bytes=64)
+    for first in range(1, 13, 3):
+        wal.append(_entries(first, 3), first + 2)
+    # Segments are named after the first index they hold
+    assert wal.segments == [1, 4, 7, 10]
+    assert _segment_files(tmp_path) == [f"{first:020d}.wal" for first in (1, 4, 7, 10)]
+
+    # Only segments wholly at or below the index go
+    assert wal.remove_before(8) == 7
+    assert _segment_files(tmp_path) == [f"{first:020d}.wal" for first in (7, 10)]
+    # The active segment is never removed
+    assert wal.remove_before(100) == 10
+    wal.close()
+
+    wal, (base_index, base_term, entries, commit_index) = _reopen(tmp_path, segment_bytes=64)
+    assert (base_index, base_term, commit_index) == (9, 1, 12)
+    assert entries == _entries(10, 3)
+    wal.close()
+
+
+def test_truncate_from_removes_later_segments(tmp_path):
+    wal, _ = _reopen(tmp_path, segment_bytes=64)
+    for first in range(1, 10, 3):
+        wal.append(_entries(first, 3))
+    wal.truncate_from(5, 1)
+    wal.append(_entries(5, 1, term=2))
+    wal.close()
+
+    _, (_, _, entries, _) = _reopen(tmp_path, segment_bytes=64)
+    assert entries == _entries(1, 4) + _entries(5, 1, term=2)
+    assert _segment_files(tmp_path) == [f"{first:020d}.wal" for first in (1, 4)]
@@ -0,0 +1,122 @@
+import asyncio
+import io
+import json
+
+import pytest
+
+from app.raft.fsm import Raft3DFSM
+from app.raft.snapshot import decode_snapshot, encode_snapshot
+from app.raft.watch import ChangeFeed, WatchFilter
+
+
+def _add_printer(fsm: Raft3DFSM, printer_id: str):
+    command = json.dumps({"op": "add_printer", "value": {"id": printer_id, "company": "Prusa", "model": "MK4"}})
+    fsm.apply_batch([command.encode()], fsm.applied_index + 1, 1)
+
+
+def _watched(events):
+    return [(event.index, event.record.id) for event in events]
+
+
+def _run(test):
+    # Runs test(fsm, feed) on a fresh event loop; batches applied from the
+    # test reach the feed once the loop gets a turn
+    async def main():
+        fsm = Raft3DFSM()
+        feed = ChangeFeed(fsm, asyncio.get_running_loop(), max_history=5, max_buffer=3)
+        try:
+            await test(fsm, feed)
+        finally:
+            feed.close()
+    asyncio.run(main())
+
+
+def test_resume_from_since_replays_history_then_follows():
+    async def test(fsm, feed):
+        for i in range(4):
+            _add_printer(fsm, f"p{i}")
+        await asyncio.sleep(0)
+        subscription = feed.watch(2, WatchFilter())
+        assert _watched(await subscription.next(1)) == [(3, "p2"), (4, "p3")]
+        _add_printer(fsm, "p4")
+        assert _watched(await subscription.next(1)) == [(5, "p4")]
+        # Up to date: only new events, and none right now
+        assert await feed.watch(5, WatchFilter()).next(0.05) == []
+    _run(test)
+
+
+def test_events_applied_before_the_stream_opened_are_not_repeated():
+    async def test(fsm, feed):
+        _add_printer(fsm, "p0")
+        _add_printer(fsm, "p1")
+        # Both batches are still on their way to the feed when the client
+        # resumes after the first
+        subscription = feed.watch(1, WatchFilter())
+        await asyncio.sleep(0)
+        assert _watched(await subscription.next(1)) == [(2, "p1")]
+    _run(test)
+
+
+def test_since_older_than_history_is_gone():
+    async def test(fsm, feed):
+        for i in range(8):
+            _add_printer(fsm, f"p{i}")
+        await asyncio.sleep(0)
+        # History keeps the last 5 events, 4 to 8
+        assert feed.watch(2, WatchFilter()) is None
+        assert _watched(await feed.watch(3, WatchFilter()).next(1)) == [(4, "p3"), (5, "p4"), (6, "p5"),
+                                                                         (7, "p6"), (8, "p7")]
+    _run(test)
+
+
+def test_since_beyond_the_applied_index_is_refused():
+    async def test(fsm, feed):
+        _add_printer(fsm, "p0")
+        await asyncio.sleep(0)
+        with pytest.raises(ValueError, match="ahead of this node's applied index 1"):
+            feed.watch(2, WatchFilter())
+        assert feed.watch(1, WatchFilter()) is not None
+    _run(test)
+
+
+def test_a_subscriber_that_falls_behind_overflows():
+    async def test(fsm, feed):
+        subscription = feed.watch(None, WatchFilter())
+        for i in range(4):
+            _add_printer(fsm, f"p{i}")
+        await asyncio.sleep(0)
+        # Four events against a buffer of three: the buffer is dropped and
+        # the stream ends for the client to resume from its last id
+        assert subscription.overflowed
+        assert await subscription.next(1) == []
+        _add_printer(fsm, "p4")
+        await asyncio.sleep(0)
+        assert await subscription.next(0.05) == []
+        # The backlog of a resumed stream does not count against the buffer
+        resumed = feed.watch(0, WatchFilter())
+        assert not resumed.overflowed
+        assert len(await resumed.next(1)) == 5
+    _run(test)
+
+
+def test_filter_narrows_the_stream():
+    async def test(fsm, feed):
+        subscription = feed.watch(None, WatchFilter(["printer"], printer_id="p1"))
+        for i in range(3):
+            _add_printer(fsm, f"p{i}")
+        await asyncio.sleep(0)
+        assert _watched(await subscription.next(1)) == [(2, "p1")]
+    _run(test)
+
+
+def test_restore_resets_open_streams():
+    async def test(fsm, feed):
+        _add_printer(fsm, "p0")
+        subscription = feed.watch(None, WatchFilter())
+        state = fsm.snapshot()
+        fsm.restore(decode_snapshot(io.BytesIO(b"".join(encode_snapshot(state)))))
+        await asyncio.sleep(0)
+        assert subscription.reset
+        # History from before the restore cannot be resumed from
+        assert feed.watch(0, WatchFilter()) is None
+    _run(test)